@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Детерминированное извлечение полей документа из pages_data OCR
+ИНН берутся только с верными контрольными разрядами, роль стороны определяется
+по близости (bbox) к метке роли: Заказчик/Покупатель - заказчик,
+Исполнитель/Поставщик/Продавец - исполнитель. Реквизиты, извлеченные так,
+исправляют ответ LLM, а документ, у которого найдены все поля, в LLM не идет.
+"""
+import math
+import re
+
+from field_validation import is_valid_inn, is_valid_kpp
+from llm_schema import LLM_RESULT_FIELDS
+
+# Основы слов меток ролей (нижний регистр): покрывают падежи "покупателя", "продавца"
+ROLE_LABELS = {
+    "заказчика": ("заказчик", "покупател", "плательщик"),
+    "исполнителя": ("исполнител", "поставщик", "продав"),
+}
+
+# Метка после числа в порядке чтения (ниже или правее) - расстояние умножается
+LABEL_AFTER_PENALTY = 4.0
+# Метка перед числом в той же строке ("Покупатель: ..., ИНН ...") - расстояние уменьшается
+SAME_ROW_BONUS = 0.25
+# Число между метками разных ролей на почти равном расстоянии - роль не определена
+AMBIGUITY_RATIO = 1.2
+
+_REQUISITE_RE = re.compile(r'\b\d{9,12}\b')
+_HEADER_RE = re.compile(
+    r'(счет-фактура|счет на оплату|счет|акт\b[^№]*|договор\b[^№]*)\s*№\s*([^\s,]+)\s*от\s*'
+    r'(\d{1,2}[./]\d{1,2}[./]\d{2,4}|\d{1,2}\s+[а-я]+\s+\d{4})'
+)
+_ORG_RE = re.compile(r'\b(ООО|ОАО|ЗАО|ПАО|АО|ГУП|МУП|ФГУП|ИП|Индивидуальный предприниматель)\b')
+_NAME_END_RE = re.compile(r',?\s*(ИНН|КПП|адрес|р/с|\d{6},)', re.IGNORECASE)
+_ADDRESS_RE = re.compile(r'адрес[а-я ]*:?\s*(.+)', re.IGNORECASE)
+_POSTCODE_RE = re.compile(r'\b\d{6},.+')
+_MONTHS = {"января": 1, "февраля": 2, "марта": 3, "апреля": 4, "мая": 5, "июня": 6, "июля": 7,
+           "августа": 8, "сентября": 9, "октября": 10, "ноября": 11, "декабря": 12}
+
+
+def _lower(text):
+    return text.lower().replace('ё', 'е')
+
+
+def _span_point(line, start, end):
+    """Примерная точка подстроки [start, end) на странице: x по доле символов в строке, y - центр строки"""
+    x1, y1, x2, y2 = line['bbox']
+    length = max(len(line.get('text', '')), 1)
+    return x1 + (x2 - x1) * (start + end) / 2 / length, (y1 + y2) / 2
+
+
+def _distance(label, number):
+    """Расстояние от метки до числа: метка после числа - со штрафом, перед ним в той же строке - с бонусом"""
+    (lx, ly, lh), (nx, ny, nh) = label, number
+    dx, dy = nx - lx, ny - ly
+    distance = math.hypot(dx, dy)
+    tolerance = max(lh, nh) / 2
+    if dy < -tolerance or (abs(dy) <= tolerance and dx < 0):
+        distance *= LABEL_AFTER_PENALTY
+    elif abs(dy) <= tolerance:
+        distance *= SAME_ROW_BONUS
+    return distance
+
+
+def _page_lines(page):
+    return [line for line in page.get('text_lines', []) if line.get('text') and line.get('bbox')]
+
+
+def _find_labels(lines):
+    """Метки ролей страницы: (роль, x, y, высота строки, индекс строки, конец метки в строке)"""
+    labels = []
+    for line_index, line in enumerate(lines):
+        text = _lower(line['text'])
+        height = line['bbox'][3] - line['bbox'][1]
+        for role, stems in ROLE_LABELS.items():
+            for stem in stems:
+                for match in re.finditer(stem, text):
+                    word_end = match.end()
+                    while word_end < len(text) and text[word_end].isalpha():
+                        word_end += 1
+                    x, y = _span_point(line, match.start(), word_end)
+                    labels.append((role, x, y, height, line_index, word_end))
+    return labels
+
+
+def _nearest_role(labels, point):
+    """Ближайшая роль к точке (или None при неоднозначности) и расстояние до нее"""
+    best = {}
+    for role, x, y, height, _, _ in labels:
+        distance = _distance((x, y, height), point)
+        if distance < best.get(role, math.inf):
+            best[role] = distance
+    if not best:
+        return None, math.inf
+    ranked = sorted(best.items(), key=lambda item: item[1])
+    if len(ranked) > 1 and ranked[1][1] < ranked[0][1] * AMBIGUITY_RATIO:
+        return None, math.inf
+    return ranked[0]
+
+
+def extract_requisites(pages_data):
+    """
+    ИНН/КПП сторон по меткам ролей
+    Возвращает {"ИНН_заказчика": ..., "КПП_исполнителя": ...} - только найденные поля
+    """
+    best = {}  # поле -> (расстояние, значение)
+    for page in pages_data:
+        lines = _page_lines(page)
+        labels = _find_labels(lines)
+        if not labels:
+            continue
+        for line in lines:
+            text = line['text']
+            has_kpp_label = 'кпп' in _lower(text)
+            height = line['bbox'][3] - line['bbox'][1]
+            for match in _REQUISITE_RE.finditer(text):
+                value = match.group()
+                if is_valid_inn(value):
+                    prefix = "ИНН"
+                elif len(value) == 9 and has_kpp_label and is_valid_kpp(value):
+                    prefix = "КПП"
+                else:
+                    continue
+                x, y = _span_point(line, *match.span())
+                role, distance = _nearest_role(labels, (x, y, height))
+                if role is None:
+                    continue
+                field = f"{prefix}_{role}"
+                if distance < best.get(field, (math.inf, None))[0]:
+                    best[field] = (distance, value)
+
+    # Один и тот же ИНН у обеих сторон - оставляем стороне, к метке которой он ближе
+    customer, contractor = best.get("ИНН_заказчика"), best.get("ИНН_исполнителя")
+    if customer and contractor and customer[1] == contractor[1]:
+        del best["ИНН_заказчика" if customer[0] > contractor[0] else "ИНН_исполнителя"]
+    return {field: value for field, (distance, value) in best.items()}
+
+
+def _normalize_date(value):
+    """Дата "12.03.24" / "12 марта 2024" в виде ДД.ММ.ГГГГ (None - не разобрана)"""
+    parts = re.split(r'[./\s]+', value.strip())
+    if len(parts) != 3:
+        return None
+    day, month, year = parts
+    month = _MONTHS.get(month, month)
+    try:
+        day, month, year = int(day), int(month), int(year)
+    except ValueError:
+        return None
+    if year < 100:
+        year += 2000
+    if not (1 <= day <= 31 and 1 <= month <= 12):
+        return None
+    return f"{day:02d}.{month:02d}.{year}"
+
+
+def extract_header(pages_data):
+    """Тип, номер и дата документа из заголовка первой страницы"""
+    if not pages_data:
+        return {}
+    for line in _page_lines(pages_data[0]):
+        match = _HEADER_RE.search(_lower(line['text']))
+        if not match:
+            continue
+        title, number, date = match.groups()
+        date = _normalize_date(date)
+        if not date:
+            continue
+        if title.startswith("счет-фактура"):
+            doc_type = "счет-фактура"
+        elif title.startswith("счет"):
+            doc_type = "счет"
+        elif title.startswith("акт"):
+            doc_type = "акт"
+        else:
+            doc_type = "договор"
+        # Номер - в исходном регистре (буквенные серии номеров)
+        start = match.start(2)
+        return {"Тип_документа": doc_type,
+                "Номер_документа": line['text'][start:start + len(number)],
+                "Дата_документа": date}
+    return {}
+
+
+def extract_parties(pages_data):
+    """
+    Наименования и адреса сторон: наименование - текст строки метки после нее
+    (только с организационно-правовой формой), адрес - из той же строки после индекса
+    или из ближайшей следующей строки "Адрес"
+    """
+    fields = {}
+    for page in pages_data:
+        lines = _page_lines(page)
+        for role, x, y, height, line_index, label_end in _find_labels(lines):
+            name_field, address_field = f"Наименование_{role}", f"Адрес_{role}"
+            text = lines[line_index]['text']
+            rest = text[label_end:].lstrip(" :-")
+            if name_field not in fields:
+                name = rest[:_NAME_END_RE.search(rest).start()] if _NAME_END_RE.search(rest) else rest
+                name = name.strip(" ,;")
+                if name and _ORG_RE.match(name):
+                    fields[name_field] = name
+            if address_field not in fields:
+                postcode = _POSTCODE_RE.search(rest)
+                if postcode:
+                    fields[address_field] = postcode.group().strip(" ,;")
+                    continue
+                for next_line in lines[line_index + 1:line_index + 3]:
+                    address = _ADDRESS_RE.match(next_line['text'].strip())
+                    if address:
+                        fields[address_field] = address.group(1).strip(" ,;")
+                        break
+    return fields
+
+
+def _party_type(fields, role):
+    """юрлицо/ип по ИНН и форме в наименовании (физлицо по тексту не различить - None)"""
+    inn = fields.get(f"ИНН_{role}", "")
+    name = fields.get(f"Наименование_{role}", "")
+    form = _ORG_RE.match(name)
+    if not inn or not form:
+        return None
+    if form.group() in ("ИП", "Индивидуальный предприниматель"):
+        return "ип" if len(inn) == 12 else None
+    return "юрлицо" if len(inn) == 10 else None
+
+
+def extract_document_fields(pages_data, filename=None):
+    """Все поля, которые удалось извлечь без LLM (ключи как в LLM_RESULT_FIELDS)"""
+    fields = {}
+    if filename:
+        fields["Название_файла"] = filename
+    fields.update(extract_header(pages_data))
+    fields.update(extract_parties(pages_data))
+    fields.update(extract_requisites(pages_data))
+    for role in ROLE_LABELS:
+        party_type = _party_type(fields, role)
+        if party_type:
+            fields[f"Тип_{role}"] = party_type
+            if party_type == "ип":
+                fields.setdefault(f"КПП_{role}", "")  # У ИП нет КПП
+    return fields
+
+
+def covers_all_fields(fields):
+    """Все поля результата извлечены - запрос к LLM не нужен"""
+    return all(field in fields for field in LLM_RESULT_FIELDS)
+
+
+if __name__ == "__main__":
+    def line(text, x, y, width=400):
+        return {"text": text, "bbox": [x, y, x + width, y + 12], "confidence": 0.95}
+
+    invoice = [{"page": 1, "text_lines": [
+        line("Счет на оплату № 125 от 12 марта 2024 г.", 40, 20),
+        line("Поставщик: ООО \"Ромашка\", ИНН 7707083893, КПП 770701001, 125009, г. Москва, ул. Тверская, д. 1", 40, 60, 520),
+        line("Р/с 40702810900000012345 БИК 044525225", 40, 80),
+        line("Покупатель: ИП Иванов Иван Иванович, ИНН 500100732259, 141000, г. Мытищи, ул. Мира, д. 5", 40, 110, 520),
+        line("Итого: 1 250,00", 400, 300, 120),
+    ]}]
+    fields = extract_document_fields(invoice, "invoice.pdf")
+    for field in LLM_RESULT_FIELDS:
+        print(f"  {field}: {fields.get(field, '—')}")
+    print(f"Все поля извлечены: {covers_all_fields(fields)}")
+
+    # Две колонки в одной строке: роли по горизонтальной близости
+    columns = [{"page": 1, "text_lines": [
+        line("Исполнитель                          Заказчик", 40, 500, 520),
+        line("ИНН 7707083893                        ИНН 500100732259", 40, 520, 520),
+    ]}]
+    print(f"Колонки: {extract_requisites(columns)}")
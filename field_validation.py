@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Проверка реквизитов в результатах LLM
+Текст документа индексируется один раз (TextIndex): числовые токены по длине
+и вхождения ключевых слов типа документа. Индекс общий для обеих сторон и для
+последующих проверок; регулярные выражения компилируются при импорте модуля.
+"""
+import re
+from collections import defaultdict
+
+# Серии из 9+ цифр; границы слова проверяются для найденных серий (дешевле \b на каждой позиции).
+# Вместе дают то же, что прежние \b\d{10}\b|\b\d{12}\b и \b\d{9}\b, но за один проход
+_DIGIT_RUN_RE = re.compile(r'\d{9,}')
+REQUISITE_NUMBER_LENGTHS = (9, 10, 12)
+
+# Ключевые слова типа документа в порядке приоритета (поиск подстрокой, как прежде)
+DOC_TYPE_KEYWORDS = ("счет-фактура", "акт", "счет", "договор")
+
+# Очистка номера документа от даты и "от ..."
+_NUMBER_FROM_RE = re.compile(r'\s*от\s*\d+.*')
+_NUMBER_DATE_RE = re.compile(r'\s*\d{1,2}[./]\d{1,2}[./]\d{2,4}.*')
+
+# КПП: код налогового органа (4 цифры), причина постановки (2 цифры или заглавные латинские), номер (3 цифры)
+_KPP_RE = re.compile(r'\d{4}[\dA-Z]{2}\d{3}')
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == '_'
+
+# Весовые коэффициенты контрольных разрядов ИНН
+_INN10_WEIGHTS = (2, 4, 10, 3, 5, 9, 4, 6, 8)
+_INN12_WEIGHTS_11 = (7, 2, 4, 10, 3, 5, 9, 4, 6, 8)
+_INN12_WEIGHTS_12 = (3, 7, 2, 4, 10, 3, 5, 9, 4, 6, 8)
+
+
+def _control_digit(digits, weights):
+    return sum(digit * weight for digit, weight in zip(digits, weights)) % 11 % 10
+
+
+def is_valid_inn(value):
+    """ИНН: 10 цифр (юрлицо) или 12 цифр (ИП/физлицо) с верными контрольными разрядами"""
+    value = str(value or "")
+    if not value.isdigit():
+        return False
+    digits = [int(char) for char in value]
+    if len(digits) == 10:
+        return _control_digit(digits, _INN10_WEIGHTS) == digits[9]
+    if len(digits) == 12:
+        return (_control_digit(digits, _INN12_WEIGHTS_11) == digits[10]
+                and _control_digit(digits, _INN12_WEIGHTS_12) == digits[11])
+    return False
+
+
+def is_valid_kpp(value):
+    """КПП: 9 знаков формата NNNNPPNNN"""
+    return bool(_KPP_RE.fullmatch(str(value or "")))
+
+
+def clean_document_number(value):
+    """Номер документа без "от ..." и даты"""
+    value = _NUMBER_FROM_RE.sub('', str(value))
+    return _NUMBER_DATE_RE.sub('', value).strip()
+
+
+class TextIndex:
+    """
+    Индекс текста документа, общий для всех проверок:
+    - числа длины реквизитов по длине (в порядке появления, с позицией)
+    - первые позиции ключевых слов типа документа
+    Каждая часть строится одним проходом при первом обращении - если все поля
+    ответа LLM корректны, текст не сканируется вовсе.
+    """
+
+    def __init__(self, text):
+        self.text = text or ""
+        self._numbers_by_length = None
+        self._keywords = None
+        self._inn_candidates = None
+
+    @property
+    def numbers_by_length(self):
+        """Числа длины 9/10/12 с позициями (текст сканируется при первом обращении)"""
+        if self._numbers_by_length is None:
+            self._numbers_by_length = defaultdict(list)
+            text = self.text
+            for match in _DIGIT_RUN_RE.finditer(text):
+                value = match.group()
+                start, end = match.span()
+                if len(value) not in REQUISITE_NUMBER_LENGTHS:
+                    continue
+                if (start and _is_word_char(text[start - 1])) or (end < len(text) and _is_word_char(text[end])):
+                    continue
+                self._numbers_by_length[len(value)].append((value, start))
+        return self._numbers_by_length
+
+    @property
+    def keywords(self):
+        """Первые позиции ключевых слов типа документа (по одному нижнему регистру текста)"""
+        if self._keywords is None:
+            text_lower = self.text.lower()
+            self._keywords = {}
+            for keyword in DOC_TYPE_KEYWORDS:
+                position = text_lower.find(keyword)
+                if position >= 0:
+                    self._keywords[keyword] = position
+        return self._keywords
+
+    def numbers(self, *lengths):
+        """Числовые токены заданных длин в порядке появления в тексте"""
+        tokens = []
+        for length in lengths:
+            tokens.extend(self.numbers_by_length.get(length, ()))
+        tokens.sort(key=lambda token: token[1])
+        return [value for value, position in tokens]
+
+    def inn_candidates(self):
+        """ИНН из текста, прошедшие проверку контрольных разрядов (без повторов)"""
+        if self._inn_candidates is None:
+            self._inn_candidates = list(dict.fromkeys(
+                value for value in self.numbers(10, 12) if is_valid_inn(value)
+            ))
+        return self._inn_candidates
+
+    def kpp_candidates(self):
+        """9-значные числа текста в порядке появления (без повторов)"""
+        return list(dict.fromkeys(self.numbers(9)))
+
+    def has_keyword(self, keyword):
+        return keyword in self.keywords
+
+    def guess_document_type(self):
+        """Тип документа по ключевым словам (порядок приоритета DOC_TYPE_KEYWORDS) или None"""
+        for keyword in DOC_TYPE_KEYWORDS:
+            if keyword in self.keywords:
+                return keyword
+        return None
+
+
+def fix_requisites(result, index, inn_keys, kpp_keys, known=None):
+    """
+    Исправление ИНН/КПП сторон
+    ИНН заменяется, только если не проходит контрольную сумму (и после удаления
+    лишних символов); КПП - если не проходит is_valid_kpp (формат NNNNPPNNN).
+    known - реквизиты, извлеченные по меткам ролей (ключи как в result): берутся в первую
+    очередь и заполняют пустые поля. Иначе замена - первый кандидат из текста, еще не
+    занятый другой стороной (ИНН - только с верной контрольной суммой). Если замены
+    нет, заведомо неверное значение очищается - поле уходит на ручную проверку пустым.
+    """
+    known = known or {}
+    for keys, is_valid, candidates in ((inn_keys, is_valid_inn, index.inn_candidates),
+                                       (kpp_keys, is_valid_kpp, index.kpp_candidates)):
+        for key in keys:
+            value = str(result.get(key) or "").strip()
+            if value and is_valid(value):
+                continue
+            digits = "".join(char for char in value if char.isdigit())
+            if digits and is_valid(digits):
+                result[key] = digits  # "ИНН 7707083893", "7707-01001" - лишние символы вокруг цифр
+                continue
+            if known.get(key):
+                result[key] = known[key]
+            elif value:
+                taken = {str(result.get(other) or "") for other in keys if other != key}
+                free = [candidate for candidate in candidates() if candidate not in taken]
+                result[key] = free[0] if free else ""
+    return result
+
+
+if __name__ == "__main__":
+    import random
+    import time
+
+    print(f"ИНН 7707083893: {is_valid_inn('7707083893')}, 7707083894: {is_valid_inn('7707083894')}, "
+          f"500100732259: {is_valid_inn('500100732259')}")
+
+    # Неверный ИНН без кандидатов в тексте не остается в результате
+    checked = fix_requisites({"ИНН_исполнителя": "ИНН 5001007322", "КПП_исполнителя": "77-01"},
+                             TextIndex("Исполнитель ООО Ромашка"), ["ИНН_исполнителя"], ["КПП_исполнителя"])
+    assert checked == {"ИНН_исполнителя": "", "КПП_исполнителя": ""}, checked
+    # ... а при наличии кандидата заменяется им
+    checked = fix_requisites({"ИНН_исполнителя": "5001007322"}, TextIndex("ИНН 500100732259"),
+                             ["ИНН_исполнителя"], [])
+    assert checked["ИНН_исполнителя"] == "500100732259", checked
+    print("Неверные реквизиты без замены очищаются: OK")
+
+    def legacy_validate(result, original_text):
+        """Прежние проверки: компиляция регулярок и отдельный проход по тексту на каждое поле"""
+        for key in ["ИНН_заказчика", "ИНН_исполнителя"]:
+            inn = result.get(key, "")
+            if inn and not (inn.isdigit() and len(inn) in [10, 12]):
+                inn_matches = re.findall(r'\b\d{10}\b|\b\d{12}\b', original_text)
+                if inn_matches:
+                    result[key] = inn_matches.pop(0)
+        for key in ["КПП_заказчика", "КПП_исполнителя"]:
+            kpp = result.get(key, "")
+            if kpp and not (kpp.isdigit() and len(kpp) == 9):
+                kpp_matches = re.findall(r'\b\d{9}\b', original_text)
+                if kpp_matches:
+                    result[key] = kpp_matches.pop(0)
+        doc_number = result.get("Номер_документа", "")
+        if doc_number:
+            clean = re.sub(r'\s*от\s*\d+.*', '', doc_number)
+            result["Номер_документа"] = re.sub(r'\s*\d{1,2}[./]\d{1,2}[./]\d{2,4}.*', '', clean).strip()
+        text_lower = original_text.lower()
+        for keyword in DOC_TYPE_KEYWORDS:
+            if keyword in text_lower:
+                result["Тип_документа"] = keyword
+                break
+        return result
+
+    def new_validate(result, original_text):
+        index = TextIndex(original_text)
+        fix_requisites(result, index, ["ИНН_заказчика", "ИНН_исполнителя"], ["КПП_заказчика", "КПП_исполнителя"])
+        result["Номер_документа"] = clean_document_number(result.get("Номер_документа", ""))
+        doc_type = index.guess_document_type()
+        if doc_type:
+            result["Тип_документа"] = doc_type
+        return result
+
+    # Синтетический документ на 100 страниц: реквизиты, суммы, счета, даты
+    random.seed(5)
+    words = ["Поставщик", "Покупатель", "ООО", "Ромашка", "р/с", "40702810900000012345", "БИК", "044525225",
+             "Итого", "1 250,00", "НДС", "от", "12.03.2024", "ИНН", "7707083893", "КПП", "770701001", "услуги", "Контрагент"]
+    document_head = "Счет-фактура № 125 от 12.03.2024\n"
+    page_lines = [" ".join(random.choice(words) for _ in range(8)) for _ in range(50)]
+    document = document_head + "\n".join(page_lines * 100)
+    llm_answer = {"ИНН_заказчика": "77070838", "ИНН_исполнителя": "ИНН 5001007322",
+                  "КПП_заказчика": "7707-01001", "КПП_исполнителя": "", "Номер_документа": "125 от 12.03.2024"}
+
+    valid_answer = {"ИНН_заказчика": "7707083893", "ИНН_исполнителя": "500100732259",
+                    "КПП_заказчика": "770701001", "КПП_исполнителя": "", "Номер_документа": "125"}
+
+    print(f"\nБенчмарк на документе 100 страниц ({len(document)} символов):")
+    for answer_name, answer in (("ответ с ошибками", llm_answer), ("корректный ответ", valid_answer)):
+        print(f"  {answer_name}:")
+        for name, validate in (("прежние проверки", legacy_validate), ("индекс текста", new_validate)):
+            start = time.perf_counter()
+            for _ in range(20):
+                checked = validate(dict(answer), document)
+            elapsed = (time.perf_counter() - start) / 20 * 1000
+            print(f"    {name}: {elapsed:.1f} мс, ИНН {checked['ИНН_заказчика']}/{checked['ИНН_исполнителя']}, "
+                  f"КПП {checked['КПП_заказчика']}, тип {checked.get('Тип_документа')}")
@@ -19,727 +19,49 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
 import os
-import json
-import csv
 import time
+import queue
 import threading
 from datetime import datetime
-from pathlib import Path
-import requests
-import multiprocessing  # Для параллельной обработки
-from multiprocessing import Process, Queue
-import queue
-
-# Импорты Surya
-from surya.input.load import load_from_file
-from surya.detection import DetectionPredictor
-from surya.recognition import RecognitionPredictor
-from surya.common.surya.schema import TaskNames
-
-# Импорт для подсчета токенов
-from token_counter import smart_truncate_for_llm, check_context_limit
-
-
-def ocr_worker(pdf_queue, ocr_queue, pdf_folder, date_format):
-    """OCR воркер: непрерывно обрабатывает PDF и подает в OCR очередь"""
-    det_predictor = DetectionPredictor()
-    rec_predictor = RecognitionPredictor()
-    
-    while True:
-        try:
-            pdf_file = pdf_queue.get(timeout=1)
-            if pdf_file is None:  # Сигнал завершения
-                break
-                
-            pdf_path = os.path.join(pdf_folder, pdf_file)
-            
-            # OCR обработка
-            images, names = load_from_file(pdf_path)
-            task_names = [TaskNames.ocr_with_boxes] * len(images)
-            predictions = rec_predictor(images, task_names=task_names, det_predictor=det_predictor, math_mode=False)
-            
-            # Формирование данных
-            pages_data, combined_text = [], ""
-            for page_idx, pred in enumerate(predictions):
-                page_lines = [{"text": line.text, "bbox": line.bbox, "confidence": line.confidence} for line in pred.text_lines]
-                pages_data.append({"page": page_idx + 1, "text_lines": page_lines})
-                combined_text += " ".join(line.text for line in pred.text_lines) + " "
-            
-            ocr_json = {"filename": pdf_file, "pages": len(predictions), "pages_data": pages_data, "full_text": combined_text.strip()}
-            
-            # Сохранение CSV
-            csv_file = os.path.join(os.path.dirname(pdf_folder), "ocr_result.csv")
-            with open(csv_file, 'a', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                if not os.path.exists(csv_file) or os.path.getsize(csv_file) == 0:
-                    writer.writerow(['filename', 'recognition_date', 'ocr_json', 'ocr_text'])
-                date_str = datetime.now().strftime("%Y-%m-%d" if date_format == "ISO" else "%d.%m.%Y")
-                writer.writerow([pdf_file, date_str, json.dumps(ocr_json, ensure_ascii=False), combined_text.strip()])
-            
-            # Подготовка данных для LLM (ПРАВИЛЬНАЯ ЛОГИКА!)
-            if len(pages_data) == 1:
-                # ОДНА СТРАНИЦА - передаем ПОЛНОСТЬЮ
-                truncated_lines = [{"source": "single_page", **line} for line in pages_data[0]["text_lines"]]
-            else:
-                # МНОГОСТРАНИЧНЫЕ - только 10 первых + 30 последних
-                truncated_lines = []
-                first_page_lines = pages_data[0]["text_lines"]
-                truncated_lines.extend([{"source": "first_page", **line} for line in first_page_lines[:10]])
-                last_page_lines = pages_data[-1]["text_lines"]
-                start_idx = max(0, len(last_page_lines) - 30)
-                truncated_lines.extend([{"source": "last_page", **line} for line in last_page_lines[start_idx:]])
-            
-            # Подаем в OCR очередь
-            ocr_queue.put((pdf_file, truncated_lines, combined_text.strip()))
-            
-        except queue.Empty:
-            continue
-        except Exception as e:
-            ocr_queue.put((pdf_file, None, f"OCR ошибка: {e}"))
-
-def llm_worker(ocr_queue, result_queue, json_folder, llm_settings, model_name, worker_name=None, retry_queue=None):
-    """ЛЛМ воркер: непрерывно обрабатывает OCR данные"""
-    display_name = worker_name or model_name
-    result_queue.put(f"Запущен LLM воркер: {display_name}")
-    
-    while True:
-        try:
-            item = ocr_queue.get(timeout=1)
-            if item is None:  # Сигнал завершения
-                result_queue.put(f"Завершаем LLM воркер: {display_name}")
-                break
-                
-            # Парсим данные с учетом счетчика попыток
-            if len(item) == 4:
-                pdf_file, truncated_data, combined_text, retry_count = item
-            else:
-                pdf_file, truncated_data, combined_text = item
-                retry_count = 0
-                
-            result_queue.put(f"Получил задание [{display_name}]: {pdf_file} (попытка {retry_count + 1})")
-            
-            if truncated_data is None:  # Ошибка OCR
-                result_queue.put(f"{pdf_file}: {combined_text}")
-                continue
-            
-            # Анализ с LLM (с замером времени)
-            start_time = time.time()
-            llm_result = analyze_with_llm_worker(pdf_file, truncated_data, llm_settings, model_name)
-            processing_time = time.time() - start_time
-            
-            if "error" not in llm_result:
-                llm_result = validate_llm_result(llm_result, combined_text)
-                
-                # Сохранение JSON
-                json_filename = os.path.splitext(pdf_file)[0] + ".json"
-                json_path = os.path.join(json_folder, json_filename)
-                with open(json_path, 'w', encoding='utf-8') as f:
-                    json.dump(llm_result, f, ensure_ascii=False, indent=2)
-                
-                # Передаем тип документа для статистики
-                doc_type = llm_result.get("Тип_документа", llm_result.get("Тип документа", "не указан"))
-                result_queue.put(f"Завершено [{display_name}]: {pdf_file} (время: {processing_time:.1f}с) - {doc_type}")
-            else:
-                # Ошибка LLM - проверяем возможность повтора
-                max_retries = llm_settings.get('max_retries', 3)
-                auto_retry = llm_settings.get('auto_retry', True)
-                
-                # Правильная проверка: retry_count начинается с 0, максимум max_retries попыток
-                if auto_retry and retry_count < max_retries and retry_queue is not None:
-                    # Добавляем в очередь повтора
-                    retry_queue.put((pdf_file, truncated_data, combined_text, retry_count + 1))
-                    result_queue.put(f"Повтор [{display_name}] для {pdf_file}: {llm_result['error']} (попытка {retry_count + 2}/{max_retries + 1})")
-                else:
-                    # Максимум попыток исчерпан или автоповтор отключен
-                    if "prediction-error" in llm_result.get('error', '').lower():
-                        result_queue.put(f"Ошибка LLM [{display_name}] для {pdf_file}: Превышен контекст модели - документ слишком большой (время: {processing_time:.1f}с, попытка {retry_count + 1}/{max_retries + 1})")
-                    else:
-                        result_queue.put(f"Ошибка LLM [{display_name}] для {pdf_file}: {llm_result['error']} (время: {processing_time:.1f}с, попытка {retry_count + 1}/{max_retries + 1})")
-                
-        except queue.Empty:
-            continue
-        except Exception as e:
-            result_queue.put(f"Ошибка [{display_name}] {pdf_file}: {e}")
-
-def ocr_worker_simple(pdf_queue, result_queue):
-    """Простой OCR воркер для неблокирующей обработки"""
-    det_predictor = DetectionPredictor()
-    rec_predictor = RecognitionPredictor()
-    
-    while True:
-        try:
-            item = pdf_queue.get(timeout=1)
-            if item is None:  # Стоп-сигнал
-                break
-                
-            pdf_file, pdf_folder, date_format = item
-            result = ocr_single_file_worker(pdf_file, pdf_folder, date_format)
-            result_queue.put(result)
-            
-        except queue.Empty:
-            continue
-        except Exception as e:
-            result_queue.put({
-                "success": False,
-                "filename": "unknown",
-                "error": str(e)
-            })
-
-def ocr_single_file_worker(pdf_file, pdf_folder, date_format):
-    """Обработка одного PDF файла через Surya OCR (вне класса)"""
-    start_time = time.time()
-    try:
-        # Инициализация Surya в каждом процессе
-        det_predictor = DetectionPredictor()
-        rec_predictor = RecognitionPredictor()
-        
-        pdf_path = os.path.join(pdf_folder, pdf_file)
-        
-        # OCR обработка
-        images, names = load_from_file(pdf_path)
-        task_names = [TaskNames.ocr_with_boxes] * len(images)
-        predictions = rec_predictor(
-            images,
-            task_names=task_names,
-            det_predictor=det_predictor,
-            math_mode=False
-        )
-        
-        # Формирование данных
-        pages_data = []
-        combined_text = ""
-        
-        for page_idx, pred in enumerate(predictions):
-            page_lines = []
-            page_text = ""
-            for line in pred.text_lines:
-                line_data = {
-                    "text": line.text,
-                    "bbox": line.bbox,
-                    "confidence": line.confidence
-                }
-                page_lines.append(line_data)
-                page_text += line.text + " "
-            pages_data.append({
-                "page": page_idx + 1,
-                "text_lines": page_lines
-            })
-            combined_text += page_text
-        
-        ocr_json = {
-            "filename": os.path.basename(pdf_path),
-            "pages": len(predictions),
-            "pages_data": pages_data,
-            "full_text": combined_text.strip()
-        }
-        
-        # Сохранение в CSV
-        csv_file = os.path.join(os.path.dirname(pdf_folder), "ocr_result.csv")
-        file_exists = os.path.exists(csv_file)
-        
-        with open(csv_file, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            if not file_exists:
-                writer.writerow(['filename', 'recognition_date', 'ocr_json', 'ocr_text'])
-            
-            date_str = datetime.now().strftime("%Y-%m-%d" if date_format == "ISO" else "%d.%m.%Y")
-            writer.writerow([pdf_file, date_str, json.dumps(ocr_json, ensure_ascii=False), combined_text.strip()])
-        
-        # Подготовка данных для LLM с умным усечением
-        all_lines = []
-        for page_data in pages_data:
-            all_lines.extend(page_data["text_lines"])
-        
-        # Применяем умное усечение с точным подсчетом токенов
-        max_tokens = 12000  # Оставляем место для промпта (4000 токенов)
-        truncated_lines, token_count, was_truncated = smart_truncate_for_llm(all_lines, max_tokens)
-        
-        if was_truncated:
-            print(f"✂️ Документ {pdf_file} усечен: {token_count} токенов")
-        else:
-            print(f"✅ Документ {pdf_file} помещается: {token_count} токенов")
-        
-        processing_time = time.time() - start_time
-        return {
-            "success": True,
-            "filename": pdf_file,
-            "truncated_data": truncated_lines,
-            "combined_text": combined_text.strip(),
-            "processing_time": processing_time
-        }
-        
-    except Exception as e:
-        processing_time = time.time() - start_time
-        return {
-            "success": False,
-            "filename": pdf_file,
-            "error": str(e),
-            "processing_time": processing_time
-        }
-
-def process_single_file_worker(args):
-    """Функция-воркер для multiprocessing (вне класса для избежания pickle ошибок)"""
-    pdf_file, pdf_folder, json_folder, date_format, llm_settings = args
-    
-    try:
-        # Инициализация Surya в каждом процессе
-        det_predictor = DetectionPredictor()
-        rec_predictor = RecognitionPredictor()
-        
-        pdf_path = os.path.join(pdf_folder, pdf_file)
-        
-        # OCR обработка
-        images, names = load_from_file(pdf_path)
-        task_names = [TaskNames.ocr_with_boxes] * len(images)
-        predictions = rec_predictor(
-            images,
-            task_names=task_names,
-            det_predictor=det_predictor,
-            math_mode=False
-        )
-        
-        # Формирование данных
-        pages_data = []
-        combined_text = ""
-        
-        for page_idx, pred in enumerate(predictions):
-            page_lines = []
-            page_text = ""
-            for line in pred.text_lines:
-                line_data = {
-                    "text": line.text,
-                    "bbox": line.bbox,
-                    "confidence": line.confidence
-                }
-                page_lines.append(line_data)
-                page_text += line.text + " "
-            pages_data.append({
-                "page": page_idx + 1,
-                "text_lines": page_lines
-            })
-            combined_text += page_text
-        
-        ocr_json = {
-            "filename": os.path.basename(pdf_path),
-            "pages": len(predictions),
-            "pages_data": pages_data,
-            "full_text": combined_text.strip()
-        }
-        
-        # Сохранение в CSV
-        csv_file = os.path.join(os.path.dirname(pdf_folder), "ocr_result.csv")
-        file_exists = os.path.exists(csv_file)
-        
-        with open(csv_file, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            if not file_exists:
-                writer.writerow(['filename', 'recognition_date', 'ocr_json', 'ocr_text'])
-            
-            date_str = datetime.now().strftime("%Y-%m-%d" if date_format == "ISO" else "%d.%m.%Y")
-            writer.writerow([pdf_file, date_str, json.dumps(ocr_json, ensure_ascii=False), combined_text.strip()])
-        
-        # Подготовка данных для LLM с умным усечением
-        all_lines = []
-        for page_data in pages_data:
-            all_lines.extend(page_data["text_lines"])
-        
-        # Проверяем размер и применяем умное усечение
-        max_tokens = 12000  # Оставляем 4000 токенов для промпта
-        truncated_lines, token_count, was_truncated = smart_truncate_for_llm(all_lines, max_tokens)
-        
-        if was_truncated:
-            print(f"✂️ Документ {pdf_file} усечен: {token_count} токенов")
-        else:
-            print(f"✅ Документ {pdf_file} помещается: {token_count} токенов")
-        
-        # Анализ с LLM
-        model_name = llm_settings.get('models', ['local-1'])[0]  # Берем первую модель
-        llm_result = analyze_with_llm_worker(pdf_file, truncated_lines, llm_settings, model_name)
-        
-        if "error" not in llm_result:
-            # Валидация
-            llm_result = validate_llm_result(llm_result, combined_text.strip())
-            
-            # Сохранение JSON
-            json_filename = os.path.splitext(pdf_file)[0] + ".json"
-            json_path = os.path.join(json_folder, json_filename)
-            
-            with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(llm_result, f, ensure_ascii=False, indent=2)
-            
-            return f"Завершено: {pdf_file}"
-        else:
-            return f"Ошибка LLM для {pdf_file}: {llm_result['error']}"
-            
-    except Exception as e:
-        return f"Ошибка обработки {pdf_file}: {str(e)}"
-
-
-def generate_llm_prompt(filename, truncated_data, structured_data):
-    """Генерация улучшенного промпта для LLM с четким определением ролей и предотвращением дублирования типа документа"""
-    prompt = f"""Ты эксперт по извлечению данных из российских деловых документов. Анализируй текст и извлеки структурированную информацию строго по правилам.
-
-ВАЖНО: В JSON ответе должно быть ТОЛЬКО ОДНО поле с типом документа - "Тип_документа" - без вариаций, дублирования или альтернатив!
-
-ОПРЕДЕЛЕНИЕ РОЛЕЙ (САМОЕ ВАЖНОЕ) В каждом документе всегда 2 стороны и в ответе должны быть 2 стороны:
-1. ИСПОЛНИТЕЛЬ (кто оказывает услуги/продает товары):
-   - В договоре: "Исполнитель", "Продавец", "Поставщик", изучай стороны договора чтобы решить.
-   - В акте: "Исполнитель", тот кто выполнил работы/оказал услуги
-   - В счете: "Поставщик", "ИП" или организация в верхней части счета
-
-2. ЗАКАЗЧИК (кто платит/получает услуги/товары):
-   - В договоре: "Заказчик", "Покупатель", "Получатель", сторона документа, изучи чтобы решить кто есть кто.
-   - В акте: "Заказчик", тот кому оказаны услуги
-   - В счете: "Покупатель", "Плательщик", получатель счета
 
-ОПРЕДЕЛЕНИЕ ТИПА ДОКУМЕНТА (ТОЛЬКО ОДИН ТИП - БЕЗ ДУБЛИРОВАНИЯ!):
-- "договор" - если в заголовке есть слова "договор", "соглашение", "купли-продажи"
-- "акт" - если в заголовке есть слова "акт", "выполненных работ", "оказанных услуг"
-- "счет" - если в заголовке есть "счет", "счет на оплату"
-- "счет-фактура" - если в заголовке есть "счет-фактура"
+# Движок обработки (OCR → правила → LLM), общий с запуском без GUI (headless_run.py)
+from pipeline_engine import PipelineEngine, EngineListener, list_pdf_files, get_cache_dir, assign_llm_models
 
-ТИПЫ ОРГАНИЗАЦИЙ (определи точно):
-- "юрлицо" - ООО, АО, ПАО, ГУП, МУП, ФГУП (ИНН 10 цифр, КПП 9 цифр)
-- "ип" - ИП, Индивидуальный предприниматель (ИНН 12 цифр, без КПП)
-- "физлицо" - Ф.И.О. без указания ООО/ИП (возможно ИНН 12 цифр)
+# Хранилище результатов OCR: выгрузка в CSV по запросу
+from results_store import results_db_path, ResultsStore
 
-ПРАВИЛА ИЗВЛЕЧЕНИЯ ДАННЫХ:
-- Название организации: только официальное название (ООО "Название", ИП Иванов А.А., либо физ лицо - Иванов А.А.)
-- ИНН: только числа длиной 10 цифр (юрлица) или 12 цифр (ИП/физлица)
-- КПП: только 9 цифр (только для юрлиц!)
-- Адрес: полный юридический адрес без названия организации
+# Настройки HTTP клиента LLM (пул keep-alive соединений)
+from llm_client import DEFAULT_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_HTTP_RETRIES
 
-ПРИМЕРЫ ОПРЕДЕЛЕНИЯ РОЛЕЙ:
-- В договоре купли-продажи автомобиля: Продавец = ИСПОЛНИТЕЛЬ, Покупатель = ЗАКАЗЧИК
-- В акте выполненных работ: кто выполнил работы = ИСПОЛНИТЕЛЬ, кто принял = ЗАКАЗЧИК
-- В счете: кто выставил счет = ИСПОЛНИТЕЛЬ, кому выставлен счет = ЗАКАЗЧИК
+# Настройки GUI по умолчанию
+from ocr_engine import DEFAULT_PAGE_WINDOW
+from prompt_encoding import PROMPT_ENCODINGS, DEFAULT_PROMPT_ENCODING
+from rule_classifier import RULE_CONFIDENCE_THRESHOLD
 
-ДОКУМЕНТ:
-{structured_data}
+# Обновление окна: события движка копятся в очереди и применяются пачкой раз в кадр
+UI_FRAME_MS = 50  # 20 кадров/с
+UI_MAX_EVENTS_PER_FRAME = 2000  # Остаток очереди - в следующем кадре, окно не замирает
+LOG_MAX_LINES = 5000  # Строк в окне лога (кольцевой буфер: старые строки удаляются)
 
-ВЕРНИ СТРОГО ФОРМАТИРОВАННЫЙ JSON В ТОЧНОМ СООТВЕТСТВИИ С ШАБЛОНОМ НИЖЕ. ТОЧНО СОБЛЮДАЙ ИМЕНА ПОЛЕЙ (с подчеркиванием, не с пробелами):
-{{
-  "Название_файла": "{filename}",
-  "Тип_документа": "договор",  // ТОЛЬКО ОДНО ПОЛЕ С ТИПОМ! Используй "договор", "акт", "счет" или "счет-фактура" в нижнем регистре
-  "Номер_документа": "",
-  "Дата_документа": "",
-  "Наименование_заказчика": "",
-  "Наименование_исполнителя": "",
-  "ИНН_заказчика": "",  // 10 или 12 цифр, не путай с КПП!
-  "КПП_заказчика": "",  // 9 цифр, только для юрлиц
-  "Адрес_заказчика": "",
-  "ИНН_исполнителя": "",  // 10 или 12 цифр, не путай с КПП!
-  "КПП_исполнителя": "",  // 9 цифр, только для юрлиц
-  "Адрес_исполнителя": "",
-  "Тип_заказчика": "юрлицо",  // строго одно из: юрлицо, ип, физлицо
-  "Тип_исполнителя": "юрлицо"  // строго одно из: юрлицо, ип, физлицо
-}}"""
-    return prompt
 
+class SuryaSimpleGUI(EngineListener):
+    """
+    Окно настроек и статистики; обработку выполняет PipelineEngine, GUI - его слушатель
+    Движок работает в фоновом потоке и не трогает виджеты: методы слушателя кладут
+    события в ui_events, главный цикл Tk разбирает очередь по таймеру (drain_ui_events).
+    """
 
-def analyze_document(filename, truncated_data, llm_settings, model_name):
-    """Обработка документа с LLM"""
-    try:
-        # Проверка наличия данных
-        if not truncated_data or len(truncated_data) == 0:
-            return {"error": "Пустые данные OCR"}
-        
-        structured_data = json.dumps(truncated_data, ensure_ascii=False, indent=2)
-        
-        # Логируем размер данных для отладки
-        data_size = len(structured_data)
-        print(f"📊 Отправляем в LLM: {filename}, размер {data_size} байт")
-        
-        # Генерируем промпт
-        prompt = generate_llm_prompt(filename, truncated_data, structured_data)
-        
-        return send_to_llm(prompt, llm_settings, model_name)
-        
-    except Exception as e:
-        return {"error": str(e)}
-
-
-def analyze_with_llm_worker(filename, truncated_data, llm_settings, model_name):
-    """Основная функция анализа документа с LLM"""
-    return analyze_document(filename, truncated_data, llm_settings, model_name)
-
-
-def send_to_llm(prompt, llm_settings, model_name):
-    """Отправка промпта в LLM и надежная обработка JSON-ответов"""
-    try:
-        # Поддержка OpenAI и LM Studio
-        provider = llm_settings.get('provider', 'LM Studio')
-        
-        if provider == 'OpenAI':
-            # Настройки для OpenAI
-            api_key = llm_settings.get('api_key', '')
-            if not api_key:
-                return {"error": "Не указан OpenAI API ключ"}
-                
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
-            endpoint = "https://api.openai.com/v1/chat/completions"
-        else:
-            # Настройки для LM Studio
-            headers = {"Content-Type": "application/json"}
-            endpoint = f"{llm_settings.get('endpoint', 'http://localhost:1234')}/v1/chat/completions"
-        
-        data = {
-            "model": model_name,
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": 0.1,
-            "max_tokens": llm_settings.get('max_tokens', 16000)
-        }
-        
-        try:
-            response = requests.post(
-                endpoint, headers=headers, json=data, 
-                timeout=llm_settings.get('timeout', 180)
-            )
-        except requests.exceptions.Timeout:
-            return {"error": f"Таймаут соединения с {provider} (более 180с)"}
-        except requests.exceptions.ConnectionError:
-            return {"error": f"Не удалось подключиться к {provider} - проверьте LM Studio"}
-        except Exception as e:
-            return {"error": f"Ошибка связи с {provider}: {e}"}
-        
-        if response.status_code == 200:
-            try:
-                result = response.json()
-                content = result.get('choices', [{}])[0].get('message', {}).get('content', '')
-                
-                if not content:
-                    return {"error": "Пустой ответ от модели"}
-                
-                # Поиск и извлечение JSON-блока
-                start = content.find('{')
-                end = content.rfind('}') + 1
-                
-                if start != -1 and end != -1:
-                    json_str = content[start:end]
-                    
-                    # Предварительная обработка для исправления часто встречающихся ошибок JSON
-                    json_str = fix_json_format(json_str)
-                    
-                    try:
-                        return json.loads(json_str)
-                    except json.JSONDecodeError as e:
-                        # Дополнительная попытка восстановления с более агрессивной обработкой
-                        json_str = aggressive_json_repair(json_str)
-                        try:
-                            return json.loads(json_str)
-                        except json.JSONDecodeError:
-                            # Если снова не удалось, возвращаем детали ошибки
-                            return {"error": f"Не удалось распарсить JSON: {e}\nФрагмент ответа: {json_str[:100]}..."}
-                else:
-                    return {"error": f"Не найден JSON в ответе: {content[:200]}..."}
-                
-            except json.JSONDecodeError as e:
-                return {"error": f"Ошибка парсинга JSON: {e}"}
-            except Exception as e:
-                return {"error": f"Неизвестная ошибка при обработке ответа: {e}"}
-                
-        elif response.status_code == 400:
-            # Ошибка превышения контекста (LM Studio)
-            try:
-                error_detail = response.json().get('error', '')
-                if 'context' in error_detail.lower() or 'token' in error_detail.lower():
-                    return {"error": "prediction-error: Превышен контекст модели"}
-                else:
-                    return {"error": f"prediction-error: {error_detail}"}
-            except:
-                return {"error": "prediction-error: Превышен контекст модели"}
-        elif response.status_code == 422:
-            # Ошибка превышения контекста (OpenAI)
-            try:
-                error_detail = response.json().get('detail', '')
-                if 'context' in error_detail.lower() or 'token' in error_detail.lower():
-                    return {"error": "prediction-error: Превышен контекст модели"}
-                else:
-                    return {"error": f"prediction-error: {error_detail}"}
-            except:
-                return {"error": "prediction-error: Превышен контекст модели"}
-        else:
-            try:
-                error_detail = response.json()
-                return {"error": f"HTTP {response.status_code}: {error_detail}"}
-            except:
-                return {"error": f"HTTP {response.status_code}: {response.text[:200]}"}
-        
-    except Exception as e:
-        return {"error": str(e)}
-
-
-def fix_json_format(json_str):
-    """Исправляет наиболее частые ошибки в JSON-строке"""
-    import re
-    
-    # Заменяем одинарные кавычки на двойные вокруг ключей и строковых значений
-    json_str = re.sub(r"([\{\s,]+)'([^']+)'\s*:", r'\1"\2":', json_str)
-    json_str = re.sub(r":\s*'([^']+)'([\s,\}]+)", r':"\1"\2', json_str)
-    
-    # Исправляем ключи без кавычек (наиболее частая ошибка)
-    json_str = re.sub(r"([\{\s,]+)([A-Za-zА-Яа-я0-9_]+)\s*:", r'\1"\2":', json_str)
-    
-    # Убираем комментарии в стиле JavaScript
-    json_str = re.sub(r"//[^\n]*", "", json_str)
-    
-    # Удаляем последние запятые перед закрывающими скобками (trailing commas)
-    json_str = re.sub(r',\s*\}', '}', json_str)
-    
-    # Преобразуем \n в пробелы внутри строковых значений
-    in_string = False
-    result = []
-    for char in json_str:
-        if char == '"' and (not result or result[-1] != '\\'):
-            in_string = not in_string
-        if in_string and char == '\n':
-            result.append(' ')
-        else:
-            result.append(char)
-    
-    return ''.join(result)
-
-
-def aggressive_json_repair(json_str):
-    """Агрессивное восстановление JSON при серьезных ошибках формата"""
-    import re
-    
-    # Основная обработка
-    json_str = fix_json_format(json_str)
-    
-    # Дополнительные агрессивные исправления
-    
-    # Исправляем пропущенные запятые между объектами
-    json_str = re.sub(r'("[^"]*")\s*("[^"]*"\s*:)', r'\1,\2', json_str)
-    
-    # Заменяем неэкранированные кавычки в строковых значениях
-    in_string = False
-    quote_start = -1
-    result = []
-    
-    for i, char in enumerate(json_str):
-        if char == '"' and (i == 0 or json_str[i-1] != '\\'):
-            if not in_string:
-                in_string = True
-                quote_start = i
-            else:
-                in_string = False
-                
-        # Если внутри строки и нашли неэкранированную кавычку - экранируем её
-        if in_string and char == '"' and i != quote_start and json_str[i-1] != '\\':
-            result.append('\\')
-            
-        result.append(char)
-    
-    return ''.join(result)
-
-
-def validate_llm_result(llm_result, original_text):
-    """Валидация результатов LLM и исправление форматирования ключей и значений"""
-    if "error" in llm_result:
-        return llm_result
-        
-    try:
-        import re
-        normalized_result = {}
-        
-        # Нормализация ключей: преобразование всех ключей в формат с подчеркиванием
-        key_mapping = {
-            # Ключи с пробелами -> ключи с подчеркиванием
-            "Тип документа": "Тип_документа",
-            "Номер документа": "Номер_документа",
-            "Дата документа": "Дата_документа",
-            "Название файла": "Название_файла",
-            "Наименование заказчика": "Наименование_заказчика",
-            "Наименование исполнителя": "Наименование_исполнителя",
-            "ИНН заказчика": "ИНН_заказчика",
-            "КПП заказчика": "КПП_заказчика",
-            "Адрес заказчика": "Адрес_заказчика",
-            "ИНН исполнителя": "ИНН_исполнителя",
-            "КПП исполнителя": "КПП_исполнителя",
-            "Адрес исполнителя": "Адрес_исполнителя",
-            "Тип заказчика": "Тип_заказчика",
-            "Тип исполнителя": "Тип_исполнителя"
-        }
-        
-        # Перенос всех значений с нормализацией ключей
-        for key, value in llm_result.items():
-            normalized_key = key_mapping.get(key, key)
-            normalized_result[normalized_key] = value
-        
-        # Если был дублирующий тип документа, исправляем
-        doc_type_keys = ["Тип_документа", "Тип документа"]
-        found_doc_type = None
-        for key in doc_type_keys:
-            if key in normalized_result:
-                found_doc_type = normalized_result[key].lower()
-                # Удаляем ключ с пробелом, оставляем только с подчеркиванием
-                if key == "Тип документа" and "Тип_документа" not in normalized_result:
-                    normalized_result["Тип_документа"] = found_doc_type
-                    del normalized_result[key]
-        
-        # Валидация и нормализация ИНН
-        for key in ["ИНН_заказчика", "ИНН_исполнителя"]:
-            inn = normalized_result.get(key, "")
-            if inn and not (inn.isdigit() and len(inn) in [10, 12]):
-                inn_matches = re.findall(r'\b\d{10}\b|\b\d{12}\b', original_text)
-                if inn_matches:
-                    normalized_result[key] = inn_matches.pop(0) if "заказчика" in key else inn_matches.pop(0) if inn_matches else ""
-        
-        # Валидация и нормализация КПП
-        for key in ["КПП_заказчика", "КПП_исполнителя"]:
-            kpp = normalized_result.get(key, "")
-            if kpp and not (kpp.isdigit() and len(kpp) == 9):
-                kpp_matches = re.findall(r'\b\d{9}\b', original_text)
-                if kpp_matches:
-                    normalized_result[key] = kpp_matches.pop(0) if "заказчика" in key else kpp_matches.pop(0) if kpp_matches else ""
-        
-        # Очистка номера документа
-        doc_number = normalized_result.get("Номер_документа", "")
-        if doc_number:
-            clean_number = re.sub(r'\s*от\s*\d+.*', '', doc_number)
-            clean_number = re.sub(r'\s*\d{1,2}[./]\d{1,2}[./]\d{2,4}.*', '', clean_number)
-            normalized_result["Номер_документа"] = clean_number.strip()
-        
-        # Проверка и нормализация типа документа в нижнем регистре
-        doc_type = normalized_result.get("Тип_документа", "").lower()
-        valid_types = ["договор", "акт", "счет", "счет-фактура"]
-        
-        if doc_type not in valid_types:
-            text_lower = original_text.lower()
-            if "счет-фактура" in text_lower:
-                normalized_result["Тип_документа"] = "счет-фактура"
-            elif "акт" in text_lower:
-                normalized_result["Тип_документа"] = "акт"
-            elif "счет" in text_lower:
-                normalized_result["Тип_документа"] = "счет"
-            elif "договор" in text_lower:
-                normalized_result["Тип_документа"] = "договор"
-            else:
-                normalized_result["Тип_документа"] = "неопределен"
-        else:
-            # Убеждаемся, что тип документа в нижнем регистре
-            normalized_result["Тип_документа"] = doc_type.lower()
-            
-        return normalized_result
-        
-    except Exception as e:
-        print(f"Ошибка валидации: {e}")
-        return llm_result
-
-
-class SuryaSimpleGUI:
     def __init__(self, root):
         self.root = root
         self.root.title("Surya OCR - Массовая обработка документов")
         self.root.geometry("700x600")
         
-        # Флаг остановки обработки
-        self.stop_processing = False
-        self.active_processes = []  # Список активных процессов
+        # Движок текущего запуска (очереди, процессы воркеров, журнал)
+        self.engine = None
+        
+        # События движка для главного потока Tk и число строк в окне лога
+        self.ui_events = queue.Queue()
+        self.log_line_count = 0
         
         # Обработчик закрытия окна
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
@@ -754,38 +76,29 @@ class SuryaSimpleGUI:
         self.processed_files = 0
         
         # Настройки LLM
-        self.llm_max_tokens = 16000  # Для Phi-4, можно увеличить для большего контекста
-        self.llm_timeout = 180
         self.llm_endpoint = "http://localhost:1234"  # Один порт для всех моделей
         # ИСПРАВЛЕНО: ДВЕ МОДЕЛИ local-1 И local-2
         # Используем две разные модели в LM Studio
         self.llm_models = ["local-1", "local-2"]  # Две модели
-        self.llm_model_index = 0  # Для round-robin
-        
-        # Настройки усечения
-        self.first_page_lines = 10   # Первые N строк с первой страницы (заголовки/реквизиты)
-        self.last_page_lines = 30    # Последние N строк с последней страницы (подписи/итоги)
-        
-        # Предикторы Surya (будут инициализированы в процессах)
-        self.det_predictor = None
-        self.rec_predictor = None
         
         # Оптимизация: Число параллельных процессов (будет переопределено из GUI)
         self.ocr_pool_size = 2  # По умолчанию
         self.llm_pool_size = 2  # По умолчанию
         
-        # Статистика OCR
-        self.ocr_start_time = 0
+        # Конвейер OCR → LLM: максимум документов, ожидающих LLM (backpressure для OCR)
+        self.pipeline_queue_size = 16
+        
+        # Межфайловый батчинг и окно потокового рендера OCR (переопределяется из GUI)
+        self.ocr_settings = {'batch_pages': 16, 'max_wait': 0.5, 'page_window': DEFAULT_PAGE_WINDOW}
+        
+        # Статистика OCR (времена документов, страницы и кеш считает движок)
         self.ocr_total_time = 0
         self.ocr_doc_count = 0  # Количество обработанных документов
         self.ocr_completed_count = 0  # Для совместимости
-        self.ocr_doc_times = []  # Времена обработки каждого документа
         
         # Статистика LLM
-        self.llm_start_time = 0
         self.llm_total_time = 0
         self.llm_doc_count = 0
-        self.llm_doc_times = []  # Времена обработки LLM
         
         # Общая статистика (суммарное время OCR + LLM)
         self.total_processing_time = 0
@@ -798,6 +111,7 @@ class SuryaSimpleGUI:
         self.contracts_count = 0
         
         self.setup_ui()
+        self.root.after(UI_FRAME_MS, self.drain_ui_events)
         
     def setup_ui(self):
         """Настройка интерфейса"""
@@ -840,6 +154,58 @@ class SuryaSimpleGUI:
         self.llm_threads_var = tk.StringVar(value="1")
         self.llm_threads_spinbox = ttk.Spinbox(perf_frame, from_=1, to=4, width=5, textvariable=self.llm_threads_var)
         self.llm_threads_spinbox.pack(side=tk.LEFT, padx=5)
+        
+        # Конвейер: OCR и LLM работают одновременно
+        self.pipeline_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(perf_frame, text="Конвейер OCR → LLM", variable=self.pipeline_var).pack(side=tk.LEFT, padx=(20, 0))
+        self.resume_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(perf_frame, text="Продолжить прерванный запуск", variable=self.resume_var).pack(side=tk.LEFT, padx=(20, 0))
+        row += 1
+        
+        # Межфайловый батчинг страниц для Surya
+        ttk.Label(main_frame, text="Батч OCR:").grid(row=row, column=0, sticky=tk.W, pady=5)
+        batch_frame = ttk.Frame(main_frame)
+        batch_frame.grid(row=row, column=1, sticky=(tk.W, tk.E), padx=5)
+        
+        ttk.Label(batch_frame, text="Страниц в батче (1 = выкл.):").pack(side=tk.LEFT)
+        self.ocr_batch_pages_var = tk.StringVar(value="16")
+        ttk.Spinbox(batch_frame, from_=1, to=256, width=5, textvariable=self.ocr_batch_pages_var).pack(side=tk.LEFT, padx=(5, 20))
+        
+        ttk.Label(batch_frame, text="Макс. ожидание (сек):").pack(side=tk.LEFT)
+        self.ocr_batch_wait_var = tk.StringVar(value="0.5")
+        ttk.Entry(batch_frame, width=5, textvariable=self.ocr_batch_wait_var).pack(side=tk.LEFT, padx=(5, 20))
+        
+        ttk.Label(batch_frame, text="Окно рендера (стр.):").pack(side=tk.LEFT)
+        self.ocr_page_window_var = tk.StringVar(value=str(DEFAULT_PAGE_WINDOW))
+        ttk.Spinbox(batch_frame, from_=1, to=64, width=5, textvariable=self.ocr_page_window_var).pack(side=tk.LEFT, padx=5)
+        row += 1
+        
+        # Режим извлечения: OCR только страниц, которые увидит LLM
+        extraction_frame = ttk.Frame(main_frame)
+        extraction_frame.grid(row=row, column=1, sticky=(tk.W, tk.E), padx=5)
+        
+        self.extraction_only_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(extraction_frame, text="OCR только для LLM: первых", variable=self.extraction_only_var).pack(side=tk.LEFT)
+        self.head_pages_var = tk.StringVar(value="2")
+        ttk.Spinbox(extraction_frame, from_=1, to=20, width=3, textvariable=self.head_pages_var).pack(side=tk.LEFT, padx=5)
+        ttk.Label(extraction_frame, text="и последних").pack(side=tk.LEFT)
+        self.tail_pages_var = tk.StringVar(value="2")
+        ttk.Spinbox(extraction_frame, from_=1, to=20, width=3, textvariable=self.tail_pages_var).pack(side=tk.LEFT, padx=5)
+        ttk.Label(extraction_frame, text="стр.").pack(side=tk.LEFT)
+        
+        self.backfill_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(extraction_frame, text="Полный OCR в фоне для CSV", variable=self.backfill_var).pack(side=tk.LEFT, padx=(20, 0))
+        row += 1
+        
+        # Кеш OCR по содержимому PDF
+        cache_frame = ttk.Frame(main_frame)
+        cache_frame.grid(row=row, column=1, sticky=(tk.W, tk.E), padx=5)
+        
+        self.ocr_cache_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(cache_frame, text="Кеш OCR (повторно не распознавать неизмененные PDF)", variable=self.ocr_cache_var).pack(side=tk.LEFT)
+        ttk.Label(cache_frame, text="Макс. МБ:").pack(side=tk.LEFT, padx=(20, 5))
+        self.ocr_cache_size_var = tk.StringVar(value="2048")
+        ttk.Entry(cache_frame, width=7, textvariable=self.ocr_cache_size_var).pack(side=tk.LEFT)
         row += 1
         
         # Настройки автоповтора
@@ -896,6 +262,90 @@ class SuryaSimpleGUI:
         self.llm_timeout_entry.insert(0, "180")
         self.llm_timeout_entry.grid(row=4, column=1, sticky="ew")
         
+        # Пул HTTP соединений
+        ttk.Label(llm_frame, text="Соединения:").grid(row=6, column=0, sticky="w", padx=(0, 10))
+        conn_frame = ttk.Frame(llm_frame)
+        conn_frame.grid(row=6, column=1, sticky="w")
+        ttk.Label(conn_frame, text="Пул на воркер:").pack(side=tk.LEFT)
+        self.llm_pool_conn_var = tk.StringVar(value=str(DEFAULT_POOL_SIZE))
+        ttk.Spinbox(conn_frame, from_=1, to=64, width=4, textvariable=self.llm_pool_conn_var).pack(side=tk.LEFT, padx=(5, 20))
+        ttk.Label(conn_frame, text="Таймаут подключения (сек):").pack(side=tk.LEFT)
+        self.llm_connect_timeout_var = tk.StringVar(value=str(DEFAULT_CONNECT_TIMEOUT))
+        ttk.Entry(conn_frame, width=5, textvariable=self.llm_connect_timeout_var).pack(side=tk.LEFT, padx=5)
+        
+        # Асинхронный диспетчер: много запросов в работе из одного процесса
+        ttk.Label(llm_frame, text="Асинхронно:").grid(row=7, column=0, sticky="w", padx=(0, 10))
+        async_frame = ttk.Frame(llm_frame)
+        async_frame.grid(row=7, column=1, sticky="w")
+        self.llm_async_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(async_frame, text="Один процесс, запросов одновременно:", variable=self.llm_async_var).pack(side=tk.LEFT)
+        self.llm_concurrency_var = tk.StringVar(value="32")
+        ttk.Spinbox(async_frame, from_=1, to=128, width=4, textvariable=self.llm_concurrency_var).pack(side=tk.LEFT, padx=5)
+        
+        # Лимиты частоты OpenAI (0 - без ограничения); скорость подстраивается по ответам 429
+        ttk.Label(llm_frame, text="Лимиты OpenAI:").grid(row=8, column=0, sticky="w", padx=(0, 10))
+        rate_frame = ttk.Frame(llm_frame)
+        rate_frame.grid(row=8, column=1, sticky="w")
+        ttk.Label(rate_frame, text="Запросов/мин:").pack(side=tk.LEFT)
+        self.llm_rpm_var = tk.StringVar(value="500")
+        ttk.Entry(rate_frame, width=7, textvariable=self.llm_rpm_var).pack(side=tk.LEFT, padx=(5, 20))
+        ttk.Label(rate_frame, text="Токенов/мин:").pack(side=tk.LEFT)
+        self.llm_tpm_var = tk.StringVar(value="200000")
+        ttk.Entry(rate_frame, width=9, textvariable=self.llm_tpm_var).pack(side=tk.LEFT, padx=5)
+        
+        # Формат данных OCR в промпте (компактные форматы экономят токены)
+        ttk.Label(llm_frame, text="Формат данных:").grid(row=9, column=0, sticky="w", padx=(0, 10))
+        encoding_frame = ttk.Frame(llm_frame)
+        encoding_frame.grid(row=9, column=1, sticky="w")
+        self.prompt_encoding_var = tk.StringVar(value=DEFAULT_PROMPT_ENCODING)
+        encoding_combobox = ttk.Combobox(encoding_frame, textvariable=self.prompt_encoding_var, width=10, state="readonly")
+        encoding_combobox['values'] = tuple(PROMPT_ENCODINGS)
+        encoding_combobox.pack(side=tk.LEFT)
+        ttk.Label(encoding_frame, text=", ".join(f"{name} - {title}" for name, title in PROMPT_ENCODINGS.items()),
+                  foreground="gray").pack(side=tk.LEFT, padx=(10, 0))
+        
+        # Строгий JSON ответ по схеме (response_format)
+        ttk.Label(llm_frame, text="Формат ответа:").grid(row=11, column=0, sticky="w", padx=(0, 10))
+        self.structured_output_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(llm_frame, text="Строгий JSON по схеме (response_format, короткий max_tokens)",
+                        variable=self.structured_output_var).grid(row=11, column=1, sticky="w")
+        self.llm_stream_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(llm_frame, text="Потоковый ответ (stream): остановка сразу после закрытия JSON",
+                        variable=self.llm_stream_var).grid(row=12, column=1, sticky="w")
+        
+        # Быстрый путь: уверенно распознанные правилами документы не идут в LLM
+        ttk.Label(llm_frame, text="Без LLM:").grid(row=13, column=0, sticky="w", padx=(0, 10))
+        rule_frame = ttk.Frame(llm_frame)
+        rule_frame.grid(row=13, column=1, sticky="w")
+        self.rule_fast_path_var = tk.BooleanVar(value=False)  # Включается пользователем
+        ttk.Checkbutton(rule_frame, text="Правила для уверенно распознанных документов, порог:",
+                        variable=self.rule_fast_path_var).pack(side=tk.LEFT)
+        self.rule_threshold_var = tk.StringVar(value=str(RULE_CONFIDENCE_THRESHOLD))
+        ttk.Entry(rule_frame, width=5, textvariable=self.rule_threshold_var).pack(side=tk.LEFT, padx=5)
+        
+        # Пакетный режим: несколько мелких документов в одном запросе
+        ttk.Label(llm_frame, text="Пакеты документов:").grid(row=10, column=0, sticky="w", padx=(0, 10))
+        llm_batch_frame = ttk.Frame(llm_frame)
+        llm_batch_frame.grid(row=10, column=1, sticky="w")
+        self.llm_batch_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(llm_batch_frame, text="Включены, документов до:", variable=self.llm_batch_var).pack(side=tk.LEFT)
+        self.llm_batch_docs_var = tk.StringVar(value="4")
+        ttk.Spinbox(llm_batch_frame, from_=2, to=16, width=3, textvariable=self.llm_batch_docs_var).pack(side=tk.LEFT, padx=(5, 20))
+        ttk.Label(llm_batch_frame, text="Токенов данных на пакет:").pack(side=tk.LEFT)
+        self.llm_batch_budget_var = tk.StringVar(value="6000")
+        ttk.Entry(llm_batch_frame, width=7, textvariable=self.llm_batch_budget_var).pack(side=tk.LEFT, padx=5)
+        
+        # Кеш ответов LLM
+        ttk.Label(llm_frame, text="Кеш ответов:").grid(row=5, column=0, sticky="w", padx=(0, 10))
+        llm_cache_frame = ttk.Frame(llm_frame)
+        llm_cache_frame.grid(row=5, column=1, sticky="w")
+        self.llm_cache_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(llm_cache_frame, text="Включен, срок (ч):", variable=self.llm_cache_var).pack(side=tk.LEFT)
+        self.llm_cache_ttl_var = tk.StringVar(value="720")
+        ttk.Entry(llm_cache_frame, width=6, textvariable=self.llm_cache_ttl_var).pack(side=tk.LEFT, padx=5)
+        self.llm_cache_bypass_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(llm_cache_frame, text="Принудительный повторный анализ", variable=self.llm_cache_bypass_var).pack(side=tk.LEFT, padx=(20, 0))
+        
         llm_frame.columnconfigure(1, weight=1)
         row += 1
         
@@ -930,6 +380,10 @@ class SuryaSimpleGUI:
         self.ocr_avg_time_label.pack(anchor=tk.W)
         self.ocr_completed_label = ttk.Label(ocr_stats_frame, text="Завершено: 0/0")
         self.ocr_completed_label.pack(anchor=tk.W)
+        self.ocr_pages_speed_label = ttk.Label(ocr_stats_frame, text="Скорость: 0 стр/сек")
+        self.ocr_pages_speed_label.pack(anchor=tk.W)
+        self.ocr_cache_label = ttk.Label(ocr_stats_frame, text="Кеш: 0 попаданий / 0 промахов")
+        self.ocr_cache_label.pack(anchor=tk.W)
         
         # Правая колонка - LLM статистика
         llm_stats_frame = ttk.Frame(stats_frame)
@@ -976,8 +430,11 @@ class SuryaSimpleGUI:
         self.log_text.grid(row=row, column=0, columnspan=3, sticky=(tk.W, tk.E, tk.N, tk.S), pady=5)
         row += 1
         
-        # Кнопка сохранения лога
-        ttk.Button(main_frame, text="Сохранить лог как txt файл", command=self.save_log).grid(row=row, column=0, columnspan=3, pady=10)
+        # Кнопки сохранения лога и выгрузки результатов OCR
+        buttons_frame = ttk.Frame(main_frame)
+        buttons_frame.grid(row=row, column=0, columnspan=3, pady=10)
+        ttk.Button(buttons_frame, text="Сохранить лог как txt файл", command=self.save_log).pack(side=tk.LEFT, padx=5)
+        ttk.Button(buttons_frame, text="Выгрузить OCR в CSV", command=self.export_ocr_csv).pack(side=tk.LEFT, padx=5)
         
         # Настройка сетки
         main_frame.columnconfigure(1, weight=1)
@@ -1021,114 +478,159 @@ class SuryaSimpleGUI:
     def on_closing(self):
         """Обработчик закрытия окна - останавливает все процессы"""
         self.log("Получен сигнал закрытия - останавливаем все процессы...")
-        self.stop_processing = True
-        
-        # Завершаем все активные процессы
-        for process in self.active_processes:
-            if process.is_alive():
-                self.log(f"Завершаем процесс PID: {process.pid}")
-                process.terminate()
-                process.join(timeout=2)
-                if process.is_alive():
-                    process.kill()  # Принудительное завершение
-        
-        self.active_processes.clear()
+        if self.engine is not None:
+            self.engine.stop(wait=True)
         self.root.destroy()
     
     def stop_processing_manually(self):
         """Ручная остановка обработки"""
         self.log("Пользователь остановил обработку")
-        self.stop_processing = True
-        
-        # Завершаем все активные процессы
-        for process in self.active_processes:
-            if process.is_alive():
-                self.log(f"Останавливаем процесс PID: {process.pid}")
-                process.terminate()
+        if self.engine is not None:
+            self.engine.stop()
         
         # Возвращаем кнопки в нормальное состояние
         self.start_button.config(state="normal")
         self.stop_button.config(state="disabled")
             
     def log(self, message):
-        """Добавляет сообщение в лог"""
+        """Добавляет сообщение в лог (из любого потока; выводится в ближайшем кадре)"""
         timestamp = datetime.now().strftime("%H:%M:%S")
-        log_message = f"[{timestamp}] {message}"
-        self.log_text.insert(tk.END, log_message + "\n")
-        self.log_text.see(tk.END)
-        self.root.update_idletasks()
+        self.ui_events.put(("log", f"[{timestamp}] {message}"))
         
     def update_progress(self, current, total):
+        self.ui_events.put(("progress", current, total))
+            
+    def update_ocr_stats(self, completed_count, total_count):
+        self.ui_events.put(("ocr_stats", completed_count, total_count))
+        
+    def update_llm_stats(self, completed_count, total_count):
+        self.ui_events.put(("llm_stats", completed_count, total_count))
+    
+    def update_document_type_count(self, doc_type):
+        """Обновление счетчиков типов документов"""
+        # Увеличиваем счетчик только если тип не пустой
+        if doc_type:
+            # Приводим к нижнему регистру для сравнения
+            doc_type_lower = doc_type.lower()
+            
+            if doc_type_lower == "акт":
+                self.acts_count += 1
+            elif doc_type_lower in ["счёт", "счет"]:
+                self.invoices_count += 1
+            elif doc_type_lower == "счет-фактура":
+                self.bills_count += 1
+            elif doc_type_lower == "договор":
+                self.contracts_count += 1
+        self.ui_events.put(("doc_types",))
+    
+    def call_in_ui(self, func, *args):
+        """Вызов в главном потоке Tk (диалоги, кнопки) после уже накопленных событий"""
+        self.ui_events.put(("call", func, args))
+    
+    def drain_ui_events(self):
+        """
+        Кадр окна: до UI_MAX_EVENTS_PER_FRAME событий движка за раз
+        Строки лога вставляются одной операцией, от прогресса и статистики
+        берется только последнее значение за кадр.
+        """
+        lines = []
+        latest = {}
+        call = None
+        for _ in range(UI_MAX_EVENTS_PER_FRAME):
+            try:
+                event = self.ui_events.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == "log":
+                lines.append(event[1])
+            elif event[0] == "call":
+                call = event[1:]
+                break  # Остальное - в следующем кадре, после вызова
+            else:
+                latest[event[0]] = event[1:]
+        
+        self.append_log_lines(lines)
+        if "progress" in latest:
+            self.render_progress(*latest["progress"])
+        if "ocr_stats" in latest:
+            self.render_ocr_stats(*latest["ocr_stats"])
+        if "llm_stats" in latest:
+            self.render_llm_stats(*latest["llm_stats"])
+        if "doc_types" in latest:
+            self.render_document_types()
+        
+        self.root.after(UI_FRAME_MS, self.drain_ui_events)
+        if call is not None:
+            func, args = call
+            func(*args)
+    
+    def append_log_lines(self, lines):
+        """Строки лога одной вставкой; в окне остаются последние LOG_MAX_LINES строк"""
+        if not lines:
+            return
+        text = "\n".join(lines[-LOG_MAX_LINES:]) + "\n"
+        self.log_text.insert(tk.END, text)
+        self.log_line_count += text.count("\n")
+        excess = self.log_line_count - LOG_MAX_LINES
+        if excess > 0:
+            self.log_text.delete("1.0", f"{excess + 1}.0")
+            self.log_line_count -= excess
+        self.log_text.see(tk.END)
+    
+    def render_progress(self, current, total):
         """Обновление прогресс-бара"""
         if total > 0:
             progress_value = (current / total) * 100
             self.progress['value'] = progress_value
-        self.root.update_idletasks()
             
-    def update_ocr_stats(self, completed_count, total_count, doc_time=None):
-        """Обновление статистики OCR"""
+    def render_ocr_stats(self, completed_count, total_count):
+        """Обновление статистики OCR (по счетчикам движка)"""
+        engine = self.engine
         self.ocr_completed_count = completed_count
         self.ocr_doc_count = completed_count  # Обновляем счетчик документов
-        if doc_time:
-            self.ocr_doc_times.append(doc_time)
             
         # Обновляем общее время
-        if self.ocr_start_time > 0:
-            self.ocr_total_time = time.time() - self.ocr_start_time
+        if engine.ocr_start_time > 0:
+            self.ocr_total_time = time.time() - engine.ocr_start_time
             
         # Среднее время на документ
-        avg_time = sum(self.ocr_doc_times) / len(self.ocr_doc_times) if self.ocr_doc_times else 0
+        avg_time = sum(engine.ocr_doc_times) / len(engine.ocr_doc_times) if engine.ocr_doc_times else 0
+        
+        # Пропускная способность в страницах
+        pages_per_sec = engine.ocr_pages_count / self.ocr_total_time if self.ocr_total_time > 0 else 0
         
         # Обновляем GUI
         self.ocr_total_time_label.config(text=f"Общее время: {self.ocr_total_time:.1f} сек")
         self.ocr_avg_time_label.config(text=f"Среднее на док.: {avg_time:.1f} сек")
         self.ocr_completed_label.config(text=f"Завершено: {completed_count}/{total_count}")
-        self.root.update_idletasks()
+        self.ocr_pages_speed_label.config(text=f"Скорость: {pages_per_sec:.2f} стр/сек")
+        self.ocr_cache_label.config(text=f"Кеш: {engine.ocr_cache_hits} попаданий / {engine.ocr_cache_misses} промахов")
         
-    def update_llm_stats(self, completed_count, total_count, doc_time=None):
-        """Обновление статистики LLM"""
+    def render_llm_stats(self, completed_count, total_count):
+        """Обновление статистики LLM (по счетчикам движка)"""
+        engine = self.engine
         self.llm_doc_count = completed_count  # Обновляем счетчик документов
-        if doc_time:
-            self.llm_doc_times.append(doc_time)
             
         # Обновляем общее время
-        if self.llm_start_time > 0:
-            self.llm_total_time = time.time() - self.llm_start_time
+        if engine.llm_start_time > 0:
+            self.llm_total_time = time.time() - engine.llm_start_time
             
         # Среднее время на документ
-        avg_time = sum(self.llm_doc_times) / len(self.llm_doc_times) if self.llm_doc_times else 0
+        avg_time = sum(engine.llm_doc_times) / len(engine.llm_doc_times) if engine.llm_doc_times else 0
         
         # Обновляем GUI
         self.llm_total_time_label.config(text=f"Общее время: {self.llm_total_time:.1f} сек")
         self.llm_avg_time_label.config(text=f"Среднее на док.: {avg_time:.1f} сек")
         self.llm_completed_label.config(text=f"Завершено: {completed_count}/{total_count}")
-        self.root.update_idletasks()
         
         # Обновляем общую статистику
         self.update_total_stats()
     
-    def update_document_type_count(self, doc_type):
-        """Обновление счетчиков типов документов"""
-        # Увеличиваем счетчик только если тип не пустой
-        if doc_type:
-            # Приводим к нижнему регистру для сравнения
-            doc_type_lower = doc_type.lower()
-            
-            if doc_type_lower == "акт":
-                self.acts_count += 1
-            elif doc_type_lower in ["счёт", "счет"]:
-                self.invoices_count += 1
-            elif doc_type_lower == "счет-фактура":
-                self.bills_count += 1
-            elif doc_type_lower == "договор":
-                self.contracts_count += 1
-        
-        # Обновляем GUI
+    def render_document_types(self):
         self.acts_count_label.config(text=f"Акты: {self.acts_count}")
         self.invoices_count_label.config(text=f"Счета: {self.invoices_count}")
         self.bills_count_label.config(text=f"Счет-фактуры: {self.bills_count}")
         self.contracts_count_label.config(text=f"Договоры: {self.contracts_count}")
-        self.root.update_idletasks()
     
     def update_total_stats(self):
         """Обновление общей статистики (OCR + LLM)"""
@@ -1147,277 +649,49 @@ class SuryaSimpleGUI:
             self.total_time_breakdown_label.config(text=f"OCR + LLM: {avg_ocr_time:.1f} + {avg_llm_time:.1f} с")
             self.processing_speed_label.config(text=f"Скорость: {docs_per_minute:.1f} док/мин")
         
-        self.root.update_idletasks()
-        
-    def initialize_surya(self):
-        """Инициализация предикторов Surya (в каждом процессе)"""
-        self.det_predictor = DetectionPredictor()
-        self.rec_predictor = RecognitionPredictor()
-        
-    def process_pdf_with_surya(self, pdf_path):
-        """Обработка PDF с Surya OCR, возвращает данные по страницам"""
-        try:
-            images, names = load_from_file(pdf_path)
-            task_names = [TaskNames.ocr_with_boxes] * len(images)
-            predictions = self.rec_predictor(
-                images,
-                task_names=task_names,
-                det_predictor=self.det_predictor,
-                math_mode=False
-            )
-            
-            pages_data = []
-            combined_text = ""
-            
-            for page_idx, pred in enumerate(predictions):
-                page_lines = []
-                page_text = ""
-                for line in pred.text_lines:
-                    line_data = {
-                        "text": line.text,
-                        "bbox": line.bbox,
-                        "confidence": line.confidence
-                    }
-                    page_lines.append(line_data)
-                    page_text += line.text + " "
-                pages_data.append({
-                    "page": page_idx + 1,
-                    "text_lines": page_lines
-                })
-                combined_text += page_text
-            
-            combined_json = {
-                "filename": os.path.basename(pdf_path),
-                "pages": len(predictions),
-                "pages_data": pages_data,
-                "full_text": combined_text.strip()
-            }
-            
-            return combined_json, combined_text.strip()
-            
-        except Exception as e:
-            return None, None
-            
-    def prepare_truncated_ocr_for_llm(self, ocr_json_data):
-        """Умное усечение OCR данных для LLM с точным подсчетом токенов"""
-        pages_data = ocr_json_data.get("pages_data", [])
-        total_pages = len(pages_data)
-        
-        if total_pages == 0:
-            return []
-        
-        # Собираем все строки со всех страниц
-        all_lines = []
-        for page_idx, page in enumerate(pages_data):
-            for line in page["text_lines"]:
-                all_lines.append({
-                    "page": page_idx + 1,
-                    "text": line["text"],
-                    "bbox": line["bbox"],
-                    "confidence": line["confidence"]
-                })
-        
-        # Используем новую логику усечения с точным подсчетом токенов
-        max_tokens = 12000  # Оставляем место для промпта (4000 токенов)
-        truncated_lines, token_count, was_truncated = smart_truncate_for_llm(all_lines, max_tokens)
-        
-        if was_truncated:
-            self.log(f"✂️ Документ усечен: {token_count} токенов")
-        else:
-            self.log(f"✅ Документ помещается: {token_count} токенов")
-        
-        return truncated_lines
-        
-    def save_to_csv(self, filename, ocr_json, ocr_text, pdf_folder):
-        csv_file = os.path.join(os.path.dirname(pdf_folder), "ocr_result.csv")
+    def build_llm_settings(self):
+        """Сбор настроек LLM из GUI и распределение моделей по воркерам (None - ошибка настроек)"""
+        provider = self.llm_provider_var.get()
+        auto_retry = self.auto_retry_var.get()
+        max_retries = int(self.max_retries_var.get())
+        
+        llm_settings = {
+            'provider': provider,
+            'max_tokens': int(self.llm_max_tokens_entry.get()),
+            'timeout': int(self.llm_timeout_entry.get()),
+            'endpoint': self.llm_endpoint,
+            'auto_retry': auto_retry,
+            'max_retries': max_retries,
+            'cache_dir': get_cache_dir(self.pdf_folder.get()) if self.llm_cache_var.get() else None,
+            'cache_ttl_hours': int(self.llm_cache_ttl_var.get()),
+            'cache_bypass': self.llm_cache_bypass_var.get(),
+            'pool_size': int(self.llm_pool_conn_var.get()),
+            'connect_timeout': int(self.llm_connect_timeout_var.get()),
+            'http_retries': DEFAULT_HTTP_RETRIES,
+            'async': self.llm_async_var.get(),
+            'concurrency': int(self.llm_concurrency_var.get()),
+            'prompt_encoding': self.prompt_encoding_var.get(),
+            'batch_docs': int(self.llm_batch_docs_var.get()) if self.llm_batch_var.get() else 0,
+            'batch_token_budget': int(self.llm_batch_budget_var.get()),
+            'structured_output': self.structured_output_var.get(),
+            'stream': self.llm_stream_var.get(),
+            'rpm_limit': int(self.llm_rpm_var.get()),
+            'tpm_limit': int(self.llm_tpm_var.get())
+        }
         
-        file_exists = os.path.exists(csv_file)
+        # Настраиваем модели с учетом количества потоков
+        if provider == 'OpenAI':
+            api_key = self.openai_api_key_entry.get().strip()
+            if not api_key:
+                self.call_in_ui(messagebox.showerror, "Ошибка", "Введите OpenAI API ключ!")
+                return None
+            llm_settings['api_key'] = api_key
+        self.llm_models = assign_llm_models(provider, self.llm_pool_size, self.llm_model_var.get())
         
-        try:
-            with open(csv_file, 'a', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                
-                if not file_exists:
-                    writer.writerow(['filename', 'recognition_date', 'ocr_json', 'ocr_text'])
-                
-                date_str = datetime.now().strftime("%Y-%m-%d" if self.date_format.get() == "ISO" else "%d.%m.%Y")
-                
-                writer.writerow([
-                    filename,
-                    date_str,
-                    json.dumps(ocr_json, ensure_ascii=False),
-                    ocr_text
-                ])
-        except Exception as e:
-            pass  # Лог в другом месте
-            
-    def analyze_with_llm(self, filename, truncated_data):
-        """Анализ усеченных данных с LLM (балансировка по именам моделей на одном порту)"""
-        try:
-            structured_data = json.dumps(truncated_data, ensure_ascii=False, indent=2)
-            
-            prompt = f"""Ты эксперт по анализу российских деловых документов.
-
-К тебе приходят УСЕЧЕННЫЕ СТРУКТУРИРОВАННЫЕ данные от Surya OCR с координатами (bbox) каждой строки. Фокус на ключевых частях: первые строки (заголовки, реквизиты, тип, номер, дата, стороны) и последние (адреса, подписи, ИНН, КПП, итоги).
-
-КООРДИНАТЫ помогают понять РАСПОЛОЖЕНИЕ:
-- Малые X = левая часть, большие X = правая часть
-- Малые Y = верх страницы, большие Y = низ страницы
-
-КРИТИЧЕСКИ ВАЖНО! ЛОГИКА ОПРЕДЕЛЕНИЯ РОЛЕЙ:
-1. АКТ выполненных работ/услуг:
-   - ИСПОЛНИТЕЛЬ = тот, кто ВЫПОЛНИЛ работы (обычно слева или подписывает акт)
-   - ЗАКАЗЧИК = тот, кто ПРИНИМАЕТ работы (обычно справа)
-   - Пример: "Автоассистанс" выполнил услуги для "Деалон"
-
-2. СЧЕТ на оплату:
-   - ИСПОЛНИТЕЛЬ = поставщик, кто ВЫСТАВЛЯЕТ счет (получатель денег)
-   - ЗАКАЗЧИК = плательщик, кому выставлен счет (платит деньги)
-
-3. СЧЕТ-ФАКТУРА:
-   - ИСПОЛНИТЕЛЬ = продавец, кто ПОСТАВЛЯЕТ товары/услуги
-   - ЗАКАЗЧИК = покупатель, кто ПОЛУЧАЕТ товары/услуги
-
-4. ДОГОВОР:
-   - Смотри на контекст: кто поставщик, кто заказчик
-
-ОПРЕДЕЛЕНИЕ ТИПА ДОКУМЕНТА:
-- Если видишь "АКТ" - это Акт
-- Если видишь "СЧЕТ" (но не "счет-фактура") - это Счёт
-- Если видишь "СЧЕТ-ФАКТУРА" - это Счет-фактура
-- Если видишь "ДОГОВОР" - это Договор
-
-ПРАВИЛА ИЗВЛЕЧЕНИЯ:
-1. ИНН: ТОЛЬКО 10 или 12 цифр (не путай с номерами счетов!)
-2. КПП: ТОЛЬКО 9 цифр
-3. Номер документа: без "от", "№", дат - только цифры/буквы
-4. Используй координаты для группировки связанных данных
-
-СТРУКТУРИРОВАННЫЕ ДАННЫЕ SURYA OCR (усеченные):
-{structured_data}
-
-АНАЛИЗИРУЙ ПОШАГОВО:
-1. Определи тип документа (фокус на первых строках)
-2. Найди номер и дату документа (обычно в первых)
-3. Определи, кто ЗАКАЗЧИК (получает услуги), кто ИСПОЛНИТЕЛЬ (оказывает услуги)
-4. Извлеки ИНН, КПП, адреса каждой стороны (часто в последних для подписей)
-5. Проверь правильность ИНН (10-12 цифр) и КПП (9 цифр)
-
-Верни результат ТОЛЬКО в JSON формате:
-{{
-  "Название файла": "{filename}",
-  "Тип документа": "Акт|Счёт|Счет-фактура|Договор" (выбрать только одно!),
-  "Номер документа": "",
-  "Дата документа": "",
-  "Наименование заказчика": "",
-  "Наименование исполнителя": "",
-  "ИНН заказчика": "",
-  "ИНН исполнителя": "",
-  "КПП заказчика": "",
-  "КПП исполнителя": "",
-  "Адрес заказчика": "",
-  "Адрес исполнителя": ""
-}}"""
-
-            # Балансировка имени модели
-            model = self.llm_models[self.llm_model_index % len(self.llm_models)]
-            self.llm_model_index += 1
-            
-            headers = {"Content-Type": "application/json"}
-            
-            data = {
-                "model": model,
-                "messages": [{"role": "user", "content": prompt}],
-                "temperature": 0.1,
-                "max_tokens": self.llm_max_tokens
-            }
-            
-            response = requests.post(f"{self.llm_endpoint}/v1/chat/completions", 
-                                     headers=headers, json=data, timeout=self.llm_timeout)
-            
-            if response.status_code == 200:
-                result = response.json()
-                content = result.get('choices', [{}])[0].get('message', {}).get('content', '')
-                
-                # Извлечение JSON
-                start = content.find('{')
-                end = content.rfind('}') + 1
-                if start != -1 and end != -1:
-                    json_str = content[start:end]
-                    return json.loads(json_str)
-                
-            return {"error": "Не удалось извлечь JSON"}
-            
-        except Exception as e:
-            return {"error": str(e)}
-            
-    def validate_and_fix_llm_result(self, llm_result, original_text):
-        """Валидация и исправление результатов LLM (как в оригинале)"""
-        if "error" in llm_result:
-            return llm_result
-            
-        try:
-            import re
-            
-            # Валидация ИНН
-            for key in ["ИНН заказчика", "ИНН исполнителя"]:
-                inn = llm_result.get(key, "")
-                if inn and not (inn.isdigit() and len(inn) in [10, 12]):
-                    inn_matches = re.findall(r'\b\d{10}\b|\b\d{12}\b', original_text)
-                    if inn_matches:
-                        llm_result[key] = inn_matches.pop(0) if "заказчика" in key else inn_matches.pop(0) if inn_matches else ""
-            
-            # Валидация КПП
-            for key in ["КПП заказчика", "КПП исполнителя"]:
-                kpp = llm_result.get(key, "")
-                if kpp and not (kpp.isdigit() and len(kpp) == 9):
-                    kpp_matches = re.findall(r'\b\d{9}\b', original_text)
-                    if kpp_matches:
-                        llm_result[key] = kpp_matches.pop(0) if "заказчика" in key else kpp_matches.pop(0) if kpp_matches else ""
-            
-            # Очистка номера документа
-            doc_number = llm_result.get("Номер документа", "")
-            if doc_number:
-                clean_number = re.sub(r'\s*от\s*\d+.*', '', doc_number)
-                clean_number = re.sub(r'\s*\d{1,2}[./]\d{1,2}[./]\d{2,4}.*', '', clean_number)
-                llm_result["Номер документа"] = clean_number.strip()
-            
-            # Проверка типа документа
-            doc_type = llm_result.get("Тип документа", "")
-            valid_types = ["Акт", "Счёт", "Счет-фактура", "Договор"]
-            if doc_type not in valid_types:
-                text_lower = original_text.lower()
-                if "счет-фактура" in text_lower:
-                    llm_result["Тип документа"] = "Счет-фактура"
-                elif "акт" in text_lower:
-                    llm_result["Тип документа"] = "Акт"
-                elif "счет" in text_lower:
-                    llm_result["Тип документа"] = "Счёт"
-                elif "договор" in text_lower:
-                    llm_result["Тип документа"] = "Договор"
-                else:
-                    llm_result["Тип документа"] = "Неопределен"
-            
-            return llm_result
-            
-        except Exception as e:
-            return llm_result
-            
-
+        return llm_settings
     
-    def save_llm_result(self, filename, llm_result, json_folder):
-        try:
-            json_filename = os.path.splitext(filename)[0] + ".json"
-            json_path = os.path.join(json_folder, json_filename)
-            
-            with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(llm_result, f, ensure_ascii=False, indent=2)
-                
-        except Exception as e:
-            pass  # Лог в другом месте
-            
     def process_files(self):
-        """Основная функция: параллельная обработка с multiprocessing"""
+        """Основная функция: настройки из GUI и запуск движка (GUI - слушатель его событий)"""
         try:
             pdf_folder = self.pdf_folder.get()
             json_folder = self.json_folder.get()
@@ -1429,16 +703,28 @@ class SuryaSimpleGUI:
             # Получаем настройки потоков из GUI
             self.ocr_pool_size = int(self.ocr_threads_var.get())
             self.llm_pool_size = int(self.llm_threads_var.get())
+            self.ocr_settings = {
+                'batch_pages': int(self.ocr_batch_pages_var.get()),
+                'max_wait': float(self.ocr_batch_wait_var.get()),
+                'page_window': int(self.ocr_page_window_var.get()),
+                'extraction_only': self.extraction_only_var.get(),
+                'head_pages': int(self.head_pages_var.get()),
+                'tail_pages': int(self.tail_pages_var.get()),
+                'backfill': self.backfill_var.get(),
+                'cache_dir': get_cache_dir(pdf_folder) if self.ocr_cache_var.get() else None,
+                'cache_max_mb': int(self.ocr_cache_size_var.get()),
+                'prompt_encoding': self.prompt_encoding_var.get(),
+                'rule_threshold': float(self.rule_threshold_var.get()) if self.rule_fast_path_var.get() else 0
+            }
+            llm_settings = self.build_llm_settings()
+            if llm_settings is None:
+                return
             
             # Сбрасываем статистику
-            self.ocr_start_time = 0
             self.ocr_total_time = 0
             self.ocr_completed_count = 0
-            self.ocr_doc_times = []
-            self.llm_start_time = 0
             self.llm_total_time = 0
             self.llm_completed_count = 0
-            self.llm_doc_times = []
             
             # Сбрасываем счетчики типов документов
             self.acts_count = 0
@@ -1447,279 +733,42 @@ class SuryaSimpleGUI:
             self.contracts_count = 0
             self.update_document_type_count("")  # Обновляем GUI
             
-            os.makedirs(json_folder, exist_ok=True)
-            
-            pdf_files = [f for f in os.listdir(pdf_folder) if f.lower().endswith('.pdf')]
+            pdf_files = list_pdf_files(pdf_folder)
             
             if not pdf_files:
-                messagebox.showwarning("Предупреждение", "Нет PDF файлов")
+                self.call_in_ui(messagebox.showwarning, "Предупреждение", "Нет PDF файлов")
                 return
                 
             self.total_files = len(pdf_files)
             self.processed_files = 0
             
-            start_time = datetime.now()
-            self.log(f"=== НАЧАЛО ОБРАБОТКИ ===")
-            self.log(f"Время начала: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
-            self.log(f"Найдено {self.total_files} PDF файлов")
-            self.log(f"OCR потоков: {self.ocr_pool_size}, LLM моделей: {self.llm_pool_size}")
-            
-            # ЭТАП 1: OCR ОБРАБОТКА с очередями (НЕБЛОКИРУЮЩАЯ!)
-            self.log(f"ЭТАП 1: Начинаем OCR обработку в {self.ocr_pool_size} потока...")
-            
-            # Запускаем таймер OCR
-            self.ocr_start_time = time.time()
-            self.update_ocr_stats(0, len(pdf_files))
-            
-            # Очереди для OCR
-            pdf_queue = Queue()
-            ocr_result_queue = Queue()
-            
-            # Заполняем очередь PDF
-            for pdf_file in pdf_files:
-                pdf_queue.put((pdf_file, pdf_folder, self.date_format.get()))
-            
-            # Проверяем флаг остановки
-            if self.stop_processing:
-                self.log("Обработка остановлена пользователем")
-                return
-            
-            # Запуск OCR процессов
-            ocr_processes = []
-            for i in range(self.ocr_pool_size):
-                p = Process(target=ocr_worker_simple, args=(pdf_queue, ocr_result_queue))
-                p.start()
-                ocr_processes.append(p)
-                self.active_processes.append(p)  # Добавляем в список активных
-            
-            # Мониторинг OCR результатов
-            ocr_completed = 0
-            ocr_data_list = []
-            
-            while ocr_completed < len(pdf_files) and not self.stop_processing:
-                try:
-                    result = ocr_result_queue.get(timeout=1)
-                    
-                    # Проверяем флаг остановки
-                    if self.stop_processing:
-                        self.log("Остановка OCR обработки...")
-                        break
-                    
-                    doc_time = result.get('processing_time', 0)
-                    
-                    if result["success"]:
-                        ocr_data_list.append(result)
-                        ocr_completed += 1
-                        self.log(f"OCR завершен: {result['filename']} ({doc_time:.1f}с)")
-                        self.update_progress(ocr_completed, len(pdf_files))
-                        self.update_ocr_stats(ocr_completed, len(pdf_files), doc_time)
-                    else:
-                        ocr_completed += 1
-                        self.log(f"OCR ошибка: {result['filename']} - {result['error']}")
-                        self.update_progress(ocr_completed, len(pdf_files))
-                        self.update_ocr_stats(ocr_completed, len(pdf_files))
-                except queue.Empty:
-                    self.root.update()  # Обновляем GUI
-                    continue
-            
-            # Завершаем OCR процессы
-            for _ in range(self.ocr_pool_size):
-                pdf_queue.put(None)
-            for p in ocr_processes:
-                p.join()
-            
-            self.log(f"ЭТАП 1 ЗАВЕРШЕН: OCR обработано {ocr_completed}/{len(pdf_files)} файлов")
-            
-            if not ocr_data_list:
-                messagebox.showerror("Ошибка", "OCR не обработал ни одного файла")
+            self.engine = PipelineEngine(self.ocr_settings, llm_settings, self.llm_models,
+                                         ocr_workers=self.ocr_pool_size,
+                                         pipeline=self.pipeline_var.get(),
+                                         pipeline_queue_size=self.pipeline_queue_size,
+                                         date_format=self.date_format.get(),
+                                         listener=self)
+            processed = self.engine.run(pdf_files, pdf_folder, json_folder, resume=self.resume_var.get())
+            if processed is None:
                 return
+            self.processed_files = processed
             
-            # ЭТАП 2: LLM ОБРАБОТКА (параллельно local-1 и local-2)
-            self.log(f"ЭТАП 2: Начинаем LLM анализ с {self.llm_pool_size} воркерами...")
-            
-            # Запускаем таймер LLM
-            self.llm_start_time = time.time()
-            self.update_llm_stats(0, len(ocr_data_list))
-            
-            # Получаем настройки LLM и автоповтора из GUI
-            provider = self.llm_provider_var.get()
-            auto_retry = self.auto_retry_var.get()
-            max_retries = int(self.max_retries_var.get())
-            
-            llm_settings = {
-                'provider': provider,
-                'max_tokens': int(self.llm_max_tokens_entry.get()),
-                'timeout': int(self.llm_timeout_entry.get()),
-                'endpoint': self.llm_endpoint,
-                'auto_retry': auto_retry,
-                'max_retries': max_retries
-            }
-            
-            # Настраиваем модели с учетом количества потоков
-            if provider == 'OpenAI':
-                api_key = self.openai_api_key_entry.get().strip()
-                if not api_key:
-                    messagebox.showerror("Ошибка", "Введите OpenAI API ключ!")
-                    return
-                llm_settings['api_key'] = api_key
-                # Для OpenAI используем одну модель с несколькими воркерами
-                model_name = self.llm_model_var.get()
-                self.llm_models = [model_name] * self.llm_pool_size  # Дублируем по количеству потоков
+            if not self.engine.stop_processing:
+                self.call_in_ui(messagebox.showinfo, "Готово", f"Обработано: {self.processed_files}/{self.total_files}")
             else:
-                # Для LM Studio создаем модели по количеству потоков
-                if self.llm_pool_size == 1:
-                    self.llm_models = ["local-model"]  # Один воркер
-                elif self.llm_pool_size == 2:
-                    self.llm_models = ["local-1", "local-2"]  # Два воркера
-                else:
-                    # Больше 2 потоков - используем одну модель
-                    self.llm_models = ["local-model"] * self.llm_pool_size
-            
-            # Очереди для LLM и повторов
-            llm_queue = Queue()
-            retry_queue = Queue() if auto_retry else None
-            result_queue = Queue()
-            
-            # Заполняем очередь OCR данными
-            for ocr_data in ocr_data_list:
-                llm_queue.put((ocr_data['filename'], ocr_data['truncated_data'], ocr_data['combined_text']))
-            
-            # Запуск LLM процессов
-            self.log(f"Создаем {len(self.llm_models)} LLM воркеров: {self.llm_models}")
-            llm_processes = []
-            for i, model in enumerate(self.llm_models):
-                worker_name = f"LLM-{i+1}" if len(self.llm_models) > 1 else "LLM"
-                # Проверяем флаг остановки
-                if self.stop_processing:
-                    self.log("Остановка перед запуском LLM")
-                    return
-                    
-                self.log(f"Запускаем воркер: {worker_name} (модель: {model})")
-                p = Process(target=llm_worker, args=(llm_queue, result_queue, json_folder, llm_settings, model, worker_name, retry_queue))
-                p.start()
-                llm_processes.append(p)
-                self.active_processes.append(p)  # Добавляем в список активных
-            
-            # Мониторинг LLM результатов с поддержкой повторов
-            llm_completed = 0
-            retry_added = 0  # Счетчик добавленных повторов
-            
-            while llm_completed < len(ocr_data_list) and not self.stop_processing:
-                try:
-                    result = result_queue.get(timeout=1)
-                    
-                    # Проверяем флаг остановки
-                    if self.stop_processing:
-                        self.log("Остановка LLM обработки...")
-                        break
-                    
-                    self.log(result)
-                    
-                    # Проверяем повторы в очереди и добавляем их в основную очередь
-                    if auto_retry and retry_queue:
-                        while not retry_queue.empty():
-                            try:
-                                retry_item = retry_queue.get_nowait()
-                                llm_queue.put(retry_item)
-                                retry_added += 1
-                                self.log(f"Добавлен повтор в очередь: {retry_item[0]}")
-                            except queue.Empty:
-                                break
-                    
-                    # Увеличиваем счетчик ТОЛЬКО для завершенных документов (не повторов)
-                    if "Завершено" in result or ("Ошибка LLM" in result and "попытка" in result):
-                        # Парсим время обработки
-                        doc_time = 0
-                        if "(время:" in result:
-                            try:
-                                time_part = result.split("(время: ")[1].split("с)")[0]
-                                doc_time = float(time_part)
-                            except:
-                                pass
-                        
-                        # Парсим тип документа для статистики
-                        if "Завершено" in result and " - " in result:
-                            try:
-                                doc_type = result.split(" - ")[-1].strip()
-                                if doc_type and doc_type != "Неопределен":
-                                    self.update_document_type_count(doc_type)
-                            except:
-                                pass
-                        
-                        llm_completed += 1
-                        self.update_progress(llm_completed, len(ocr_data_list))
-                        self.update_llm_stats(llm_completed, len(ocr_data_list), doc_time if doc_time > 0 else None)
-                        
-                except queue.Empty:
-                    self.root.update()  # Обновляем GUI
-                    continue
-            
-            # Обработка оставшихся повторов перед завершением
-            if auto_retry and retry_queue:
-                # Проверяем оставшиеся повторы
-                final_retries = 0
-                while not retry_queue.empty():
-                    try:
-                        retry_item = retry_queue.get_nowait()
-                        llm_queue.put(retry_item)
-                        final_retries += 1
-                        self.log(f"Обработка оставшегося повтора: {retry_item[0]}")
-                    except queue.Empty:
-                        break
-                        
-                if final_retries > 0:
-                    self.log(f"Обрабатываем {final_retries} оставшихся повторов...")
-                    
-                    # Ожидаем завершения повторов
-                    final_completed = 0
-                    while final_completed < final_retries:
-                        try:
-                            result = result_queue.get(timeout=5)
-                            self.log(result)
-                            if "Завершено" in result or "Ошибка LLM" in result:
-                                final_completed += 1
-                        except queue.Empty:
-                            self.log("Таймаут ожидания повторов")
-                            break
-            
-            # Завершение LLM воркеров
-            for _ in range(len(self.llm_models)):
-                llm_queue.put(None)
-            
-            for p in llm_processes:
-                p.join()
-            
-            self.processed_files = llm_completed
-            
-            end_time = datetime.now()
-            duration = end_time - start_time
-            
-            self.log(f"\n=== ОБРАБОТКА ЗАВЕРШЕНА ===")
-            self.log(f"Время окончания: {end_time.strftime('%Y-%m-%d %H:%M:%S')}")
-            self.log(f"Длительность: {duration}")
-            self.log(f"Обработано: {self.processed_files}/{self.total_files}")
-            if auto_retry and retry_added > 0:
-                self.log(f"Повторов выполнено: {retry_added}")
-            
-            # Восстанавливаем состояние кнопок
-            self.start_button.config(state="normal")
-            self.stop_button.config(state="disabled")
-            
-            # Очищаем список активных процессов
-            self.active_processes.clear()
-            
-            if not self.stop_processing:
-                messagebox.showinfo("Готово", f"Обработано: {self.processed_files}/{self.total_files}")
-            else:
-                messagebox.showwarning("Остановлено", "Обработка остановлена пользователем")
+                self.call_in_ui(messagebox.showwarning, "Остановлено", "Обработка остановлена пользователем")
             
         except Exception as e:
             self.log(f"Критическая ошибка: {e}")
-            messagebox.showerror("Ошибка", str(e))
+            self.call_in_ui(messagebox.showerror, "Ошибка", str(e))
         finally:
             self.processing = False
-            self.start_button.config(text="Запустить обработку", state="normal")
-            
+            self.call_in_ui(self.reset_buttons)
+    
+    def reset_buttons(self):
+        self.start_button.config(text="Запустить обработку", state="normal")
+        self.stop_button.config(state="disabled")
+    
     def start_processing(self):
         if self.processing:
             self.processing = False
@@ -1732,7 +781,26 @@ class SuryaSimpleGUI:
         processing_thread = threading.Thread(target=self.process_files, daemon=True)
         processing_thread.start()
 
+    def export_ocr_csv(self):
+        """Выгрузка базы результатов OCR в ocr_result.csv (прежний формат) по запросу"""
+        pdf_folder = self.pdf_folder.get()
+        db_path = results_db_path(pdf_folder) if pdf_folder else None
+        if not db_path or not os.path.exists(db_path):
+            messagebox.showwarning("Предупреждение", "Нет базы результатов OCR для выбранной папки PDF")
+            return
+        try:
+            csv_path = os.path.join(os.path.dirname(pdf_folder), "ocr_result.csv")
+            store = ResultsStore(db_path)
+            try:
+                exported = store.export_csv(csv_path)
+            finally:
+                store.close()
+            messagebox.showinfo("Выгружено", f"{exported} строк в: {csv_path}")
+        except Exception as e:
+            messagebox.showerror("Ошибка", str(e))
+    
     def save_log(self):
+        """Сохраняет строки из окна лога (последние LOG_MAX_LINES)"""
         try:
             log_content = self.log_text.get(1.0, tk.END)
             filename = f"surya_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Запуск обработки без GUI (серверы без дисплея, Docker без VNC)
+
+Разовая обработка папки:
+    python headless_run.py <папка PDF> <папка JSON> [--ocr-workers 2 --llm-workers 2 --resume]
+Демон слежения за папкой (модели Surya загружены между пакетами):
+    python headless_run.py <папка PDF> <папка JSON> --watch [--poll 5]
+
+Настройки по умолчанию совпадают с настройками GUI; ключ OpenAI берется из
+--api-key или переменной окружения OPENAI_API_KEY.
+"""
+import argparse
+import os
+import signal
+import sys
+
+from pipeline_engine import (PipelineEngine, list_pdf_files, get_cache_dir, assign_llm_models,
+                             WATCH_POLL_INTERVAL)
+from llm_client import DEFAULT_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_HTTP_RETRIES
+from ocr_engine import DEFAULT_PAGE_WINDOW
+from prompt_encoding import PROMPT_ENCODINGS, DEFAULT_PROMPT_ENCODING
+from rule_classifier import RULE_CONFIDENCE_THRESHOLD
+
+PROVIDERS = {"lmstudio": "LM Studio", "openai": "OpenAI"}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Массовая обработка PDF: Surya OCR → правила → LLM, без GUI")
+    parser.add_argument("pdf_folder", help="папка с PDF файлами")
+    parser.add_argument("json_folder", help="папка для JSON результатов")
+    parser.add_argument("--ocr-workers", type=int, default=1, help="OCR процессов (по умолчанию 1)")
+    parser.add_argument("--llm-workers", type=int, default=1, help="LLM воркеров (по умолчанию 1)")
+    parser.add_argument("--provider", choices=sorted(PROVIDERS), default="lmstudio", help="провайдер LLM")
+    parser.add_argument("--model", default="gpt-4o-mini", help="модель OpenAI (для LM Studio модели назначаются по числу воркеров)")
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY", ""), help="ключ OpenAI (или OPENAI_API_KEY)")
+    parser.add_argument("--endpoint", default="http://localhost:1234", help="адрес LM Studio")
+    parser.add_argument("--resume", action="store_true", help="продолжить прерванный запуск по журналу")
+    parser.add_argument("--watch", action="store_true", help="демон: следить за папкой PDF и обрабатывать новые файлы")
+    parser.add_argument("--poll", type=float, default=WATCH_POLL_INTERVAL, help="пауза между опросами папки, с")
+    parser.add_argument("--two-phase", action="store_true", help="сначала OCR всех файлов, затем LLM (без конвейера)")
+    parser.add_argument("--date-format", choices=("ISO", "CLASSIC"), default="ISO", help="формат даты распознавания")
+
+    ocr = parser.add_argument_group("OCR")
+    ocr.add_argument("--batch-pages", type=int, default=16, help="страниц в батче Surya (межфайловый батчинг)")
+    ocr.add_argument("--batch-wait", type=float, default=0.5, help="ожидание добора батча, с")
+    ocr.add_argument("--page-window", type=int, default=DEFAULT_PAGE_WINDOW, help="окно рендера длинных PDF, страниц")
+    ocr.add_argument("--extraction-only", action="store_true", help="OCR только первых/последних страниц для LLM")
+    ocr.add_argument("--head-pages", type=int, default=2)
+    ocr.add_argument("--tail-pages", type=int, default=2)
+    ocr.add_argument("--no-backfill", action="store_true", help="без фонового полного OCR в режиме извлечения")
+    ocr.add_argument("--no-ocr-cache", action="store_true", help="не использовать кеш OCR")
+    ocr.add_argument("--ocr-cache-mb", type=int, default=2048)
+
+    llm = parser.add_argument_group("LLM")
+    llm.add_argument("--max-tokens", type=int, default=16000)
+    llm.add_argument("--timeout", type=int, default=180)
+    llm.add_argument("--max-retries", type=int, default=3, help="повторов при ошибке (0 - без автоповтора)")
+    llm.add_argument("--async-llm", action="store_true", help="один асинхронный процесс вместо воркеров")
+    llm.add_argument("--concurrency", type=int, default=32, help="запросов одновременно в асинхронном режиме")
+    llm.add_argument("--pool-size", type=int, default=DEFAULT_POOL_SIZE, help="keep-alive соединений на процесс")
+    llm.add_argument("--connect-timeout", type=int, default=DEFAULT_CONNECT_TIMEOUT)
+    llm.add_argument("--rpm", type=int, default=500, help="лимит запросов в минуту (OpenAI)")
+    llm.add_argument("--tpm", type=int, default=200000, help="лимит токенов в минуту (OpenAI)")
+    llm.add_argument("--prompt-encoding", choices=sorted(PROMPT_ENCODINGS), default=DEFAULT_PROMPT_ENCODING)
+    llm.add_argument("--batch-docs", type=int, default=0, help="документов в одном запросе (0 - по одному)")
+    llm.add_argument("--batch-budget", type=int, default=6000, help="бюджет токенов пакетного запроса")
+    llm.add_argument("--structured-output", action="store_true", help="строгий JSON по схеме (response_format)")
+    llm.add_argument("--stream", action="store_true", help="потоковый ответ")
+    llm.add_argument("--no-llm-cache", action="store_true", help="не использовать кеш ответов LLM")
+    llm.add_argument("--llm-cache-ttl", type=int, default=720, help="срок кеша ответов, ч")
+    llm.add_argument("--force-llm", action="store_true", help="повторный анализ в обход кеша ответов")
+    llm.add_argument("--rule-threshold", type=float, default=0,
+                     help="порог уверенности правил для записи без LLM "
+                          f"(по умолчанию 0 - выключено, рекомендуется {RULE_CONFIDENCE_THRESHOLD})")
+    return parser.parse_args(argv)
+
+
+def build_settings(args):
+    """(ocr_settings, llm_settings, модели LLM) из аргументов - те же ключи, что собирает GUI"""
+    pdf_folder = os.path.abspath(args.pdf_folder)
+    ocr_settings = {
+        'batch_pages': args.batch_pages,
+        'max_wait': args.batch_wait,
+        'page_window': args.page_window,
+        'extraction_only': args.extraction_only,
+        'head_pages': args.head_pages,
+        'tail_pages': args.tail_pages,
+        'backfill': not args.no_backfill,
+        'cache_dir': None if args.no_ocr_cache else get_cache_dir(pdf_folder),
+        'cache_max_mb': args.ocr_cache_mb,
+        'prompt_encoding': args.prompt_encoding,
+        'rule_threshold': args.rule_threshold
+    }
+    provider = PROVIDERS[args.provider]
+    llm_settings = {
+        'provider': provider,
+        'max_tokens': args.max_tokens,
+        'timeout': args.timeout,
+        'endpoint': args.endpoint,
+        'auto_retry': args.max_retries > 0,
+        'max_retries': args.max_retries,
+        'cache_dir': None if args.no_llm_cache else get_cache_dir(pdf_folder),
+        'cache_ttl_hours': args.llm_cache_ttl,
+        'cache_bypass': args.force_llm,
+        'pool_size': args.pool_size,
+        'connect_timeout': args.connect_timeout,
+        'http_retries': DEFAULT_HTTP_RETRIES,
+        'async': args.async_llm,
+        'concurrency': args.concurrency,
+        'prompt_encoding': args.prompt_encoding,
+        'batch_docs': args.batch_docs,
+        'batch_token_budget': args.batch_budget,
+        'structured_output': args.structured_output,
+        'stream': args.stream,
+        'rpm_limit': args.rpm,
+        'tpm_limit': args.tpm
+    }
+    if provider == 'OpenAI':
+        llm_settings['api_key'] = args.api_key
+    return ocr_settings, llm_settings, assign_llm_models(provider, args.llm_workers, args.model)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    pdf_folder = os.path.abspath(args.pdf_folder)
+    json_folder = os.path.abspath(args.json_folder)
+    if not os.path.isdir(pdf_folder):
+        print(f"Ошибка: нет папки {pdf_folder}")
+        return 2
+    if args.provider == "openai" and not args.api_key:
+        print("Ошибка: нужен ключ OpenAI (--api-key или OPENAI_API_KEY)")
+        return 2
+
+    ocr_settings, llm_settings, llm_models = build_settings(args)
+    engine = PipelineEngine(ocr_settings, llm_settings, llm_models,
+                            ocr_workers=args.ocr_workers,
+                            pipeline=not args.two_phase,
+                            date_format=args.date_format,
+                            keep_loaded=args.watch)
+
+    # SIGTERM (docker stop) и Ctrl+C: цикл завершает текущую итерацию, писатель дописывает результаты
+    main_pid = os.getpid()
+
+    def request_stop(signum, frame):
+        if os.getpid() != main_pid:
+            # Обработчик унаследован воркером (fork): Ctrl+C воркеры игнорируют - их
+            # останавливает оркестратор, SIGTERM (terminate) завершает процесс как обычно
+            if signum == signal.SIGTERM:
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+            return
+        engine.log("Получен сигнал остановки")
+        engine.stop_processing = True
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    if args.watch:
+        engine.watch(pdf_folder, json_folder, poll_interval=args.poll)
+        return 0
+
+    pdf_files = list_pdf_files(pdf_folder)
+    if not pdf_files:
+        print(f"Нет PDF файлов в {pdf_folder}")
+        return 1
+    processed = engine.run(pdf_files, pdf_folder, json_folder, resume=args.resume)
+    if engine.stop_processing:
+        return 130
+    return 0 if processed is None or processed == len(pdf_files) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
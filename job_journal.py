@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Журнал заданий запуска: состояние каждого файла (в очереди, OCR готов, LLM готов,
+ошибка) и число попыток. Хранится в SQLite в папке JSON результатов, поэтому
+прерванный запуск (сбой, кнопка "Остановить") можно продолжить с места остановки.
+Изменения копятся в памяти и записываются пакетом в одной транзакции.
+Отдельный флаг archive_pending - полный OCR файла (режим извлечения) еще не записан
+фоновым проходом в архив; продолжение запуска дописывает такие файлы.
+"""
+import os
+import sqlite3
+import time
+from collections import Counter
+
+JOURNAL_DB_NAME = "job_journal.sqlite"
+
+# Состояния файла
+QUEUED = "queued"
+OCR_DONE = "ocr_done"
+LLM_DONE = "llm_done"
+FAILED = "failed"
+
+# Пакетная запись: по числу измененных файлов или по времени с прошлой записи
+JOURNAL_BATCH_SIZE = 200
+JOURNAL_FLUSH_INTERVAL = 2.0
+
+
+def journal_path(json_folder):
+    return os.path.join(json_folder, JOURNAL_DB_NAME)
+
+
+class JobJournal:
+    """
+    Журнал одного запуска (одной папки результатов)
+    Пишет только оркестратор GUI - один писатель, блокировки между процессами не нужны.
+    """
+
+    def __init__(self, db_path, batch_size=JOURNAL_BATCH_SIZE, flush_interval=JOURNAL_FLUSH_INTERVAL):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " filename TEXT PRIMARY KEY,"
+            " state TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL,"
+            " error TEXT,"
+            " ocr_done_at REAL,"
+            " updated REAL NOT NULL,"
+            " archive_pending INTEGER NOT NULL DEFAULT 0,"
+            " llm_retries INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        for column in ("archive_pending", "llm_retries"):
+            if column not in columns:  # Журнал прежней версии
+                self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+        self.conn.commit()
+        # Состояние в памяти: filename -> [state, attempts, error, ocr_done_at, updated, archive_pending, llm_retries]
+        # attempts - попытки обработки файла (постановки в очередь запуска), llm_retries - повторы
+        # запроса LLM внутри попытки; предел попыток демона считается только по attempts
+        self.entries = {
+            row[0]: list(row[1:])
+            for row in self.conn.execute(
+                "SELECT filename, state, attempts, error, ocr_done_at, updated, archive_pending, llm_retries FROM jobs")
+        }
+        self.dirty = set()
+        self.last_flush = time.monotonic()
+
+    def reset(self):
+        """Новый запуск: прежний журнал очищается"""
+        self.entries.clear()
+        self.dirty.clear()
+        with self.conn:
+            self.conn.execute("DELETE FROM jobs")
+
+    def get(self, filename):
+        """(состояние, попыток, время готовности OCR, ждет полного OCR для архива) или None"""
+        entry = self.entries.get(filename)
+        return (entry[0], entry[1], entry[3], bool(entry[5])) if entry else None
+
+    def queue(self, filenames):
+        """Файлы, поставленные в очередь OCR: новая попытка для каждого"""
+        now = time.time()
+        for filename in filenames:
+            entry = self.entries.setdefault(filename, [QUEUED, 0, None, None, now, 0, 0])
+            entry[0] = QUEUED
+            entry[1] += 1
+            entry[4] = now
+            self.dirty.add(filename)
+        self.maybe_flush()
+
+    def mark(self, filename, state=None, error=None, new_attempt=False, llm_retry=False):
+        """Смена состояния файла (state=None - только счетчик: новая попытка или повтор LLM)"""
+        now = time.time()
+        entry = self.entries.setdefault(filename, [QUEUED, 0, None, None, now, 0, 0])
+        if state is not None:
+            entry[0] = state
+            entry[2] = error
+            if state == OCR_DONE:
+                entry[3] = now
+        if new_attempt:
+            entry[1] += 1
+        if llm_retry:
+            entry[6] += 1
+        entry[4] = now
+        self.dirty.add(filename)
+        self.maybe_flush()
+
+    def mark_archive(self, filename, pending):
+        """Полный OCR файла ждет фонового прохода (True) или записан в архив (False)"""
+        entry = self.entries.setdefault(filename, [QUEUED, 0, None, None, time.time(), 0, 0])
+        entry[5] = int(pending)
+        self.dirty.add(filename)
+        self.maybe_flush()
+    
+    def archive_pending(self):
+        """Файлы, полный OCR которых еще не записан в архив"""
+        return sorted(filename for filename, entry in self.entries.items() if entry[5])
+    
+    def maybe_flush(self):
+        if len(self.dirty) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Все накопленные изменения - одной транзакцией"""
+        if self.dirty:
+            rows = [(filename, *self.entries[filename]) for filename in self.dirty]
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO jobs"
+                    " (filename, state, attempts, error, ocr_done_at, updated, archive_pending, llm_retries)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+            self.dirty.clear()
+        self.last_flush = time.monotonic()
+
+    def summary(self):
+        return Counter(entry[0] for entry in self.entries.values())
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    # Оценка: 20 000 файлов, по 3 смены состояния на файл
+    path = os.path.join(tempfile.mkdtemp(), JOURNAL_DB_NAME)
+    journal = JobJournal(path)
+    files = [f"doc_{i:05d}.pdf" for i in range(20000)]
+    start = time.perf_counter()
+    journal.queue(files)
+    for filename in files:
+        journal.mark(filename, OCR_DONE)
+        journal.mark(filename, LLM_DONE if hash(filename) % 10 else FAILED, error=None)
+    journal.close()
+    elapsed = time.perf_counter() - start
+    print(f"60 000 изменений: {elapsed:.2f}с ({elapsed / 60000 * 1e6:.1f} мкс на изменение)")
+    print(f"После перезапуска: {dict(JobJournal(path).summary())}")
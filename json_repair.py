@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+"""
+Терпимый разбор JSON из ответов LLM за один проход
+Заменяет цепочку fix_json_format + aggressive_json_repair (регулярки и повторные
+проходы по строке). Разбирает за O(n):
+- текст до и после JSON (пояснения, ```json ограждения)
+- одинарные кавычки, ключи без кавычек (в т.ч. кириллица и с пробелами)
+- комментарии // и /* */, висячие запятые, пропущенные запятые
+- переводы строк внутри строк, неэкранированные кавычки внутри значений
+  (ООО "Ромашка"), оборванный по max_tokens конец ответа
+"""
+import json
+
+_WHITESPACE = " \t\r\n﻿ "
+_VALUE_END = ",}]"
+_CONSTANTS = {"true": True, "false": False, "null": None, "True": True, "False": False, "None": None}
+_ESCAPES = {'"': '"', "'": "'", "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+MAX_DEPTH = 100  # Вложенность объектов/массивов: в ответах по схеме 2-3 уровня, глубже - мусор
+
+
+class _LenientParser:
+    """Рекурсивный спуск с одним указателем по тексту - каждый символ читается один раз"""
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+        self.length = len(text)
+        self.depth = 0
+
+    def skip(self):
+        """Пропуск пробелов и комментариев"""
+        text = self.text
+        while self.pos < self.length:
+            char = text[self.pos]
+            if char in _WHITESPACE:
+                self.pos += 1
+            elif text.startswith("//", self.pos):
+                newline = text.find("\n", self.pos)
+                self.pos = self.length if newline == -1 else newline + 1
+            elif text.startswith("/*", self.pos):
+                end = text.find("*/", self.pos + 2)
+                self.pos = self.length if end == -1 else end + 2
+            else:
+                break
+
+    def peek(self):
+        self.skip()
+        return self.text[self.pos] if self.pos < self.length else ""
+
+    def value(self):
+        char = self.peek()
+        if char in "{[":
+            # Рекурсия на каждый уровень - ограничиваем, иначе '[[[[...' дает RecursionError
+            if self.depth >= MAX_DEPTH:
+                raise ValueError(f"Вложенность JSON больше {MAX_DEPTH} уровней")
+            self.depth += 1
+            try:
+                return self.obj() if char == "{" else self.array()
+            finally:
+                self.depth -= 1
+        if char in "\"'":
+            return self.string(char, key=False)
+        return self.bare(key=False)
+
+    def obj(self):
+        self.pos += 1  # {
+        result = {}
+        while True:
+            char = self.peek()
+            if char == "":
+                return result  # Ответ оборван - закрываем
+            if char == "}":
+                self.pos += 1
+                return result
+            if char == ",":
+                self.pos += 1  # Лишние / висячие запятые
+                continue
+            if char == "]":
+                self.pos += 1  # Перепутанная скобка
+                return result
+            key = self.string(char, key=True) if char in "\"'" else self.bare(key=True)
+            if self.peek() == ":":
+                self.pos += 1
+            elif self.peek() in "}," or self.peek() == "":
+                result[str(key)] = ""  # Ключ без значения
+                continue
+            result[str(key)] = self.value()
+
+    def array(self):
+        self.pos += 1  # [
+        result = []
+        while True:
+            char = self.peek()
+            if char == "":
+                return result
+            if char == "]":
+                self.pos += 1
+                return result
+            if char == ",":
+                self.pos += 1
+                continue
+            if char == "}":
+                self.pos += 1
+                return result
+            result.append(self.value())
+
+    def closes_string(self, index, key):
+        """
+        Кавычка закрывает строку, только если за ней (через пробелы) идет
+        разделитель, конец текста или перевод строки; иначе это кавычка внутри
+        значения: "ООО "Ромашка""
+        """
+        text = self.text
+        index += 1
+        newline = False
+        while index < self.length and text[index] in _WHITESPACE:
+            newline = newline or text[index] == "\n"
+            index += 1
+        if index >= self.length or newline:
+            return True
+        next_char = text[index]
+        if key:
+            return next_char in ":,}"  # "," / "}" - ключ без значения
+        return next_char in _VALUE_END or text.startswith("//", index)
+
+    def string(self, quote, key):
+        self.pos += 1  # открывающая кавычка
+        text = self.text
+        parts = []
+        start = self.pos
+        while self.pos < self.length:
+            char = text[self.pos]
+            if char == "\\":
+                parts.append(text[start:self.pos])
+                escape = text[self.pos + 1:self.pos + 2]
+                if escape == "u" and self.pos + 6 > self.length:
+                    self.pos = self.length  # Ответ оборван посреди \uXXXX - хвост отбрасываем
+                    return "".join(parts)
+                if escape == "u":
+                    try:
+                        parts.append(chr(int(text[self.pos + 2:self.pos + 6], 16)))
+                        self.pos += 6
+                        start = self.pos
+                        continue
+                    except ValueError:
+                        pass
+                parts.append(_ESCAPES.get(escape, escape))
+                self.pos += 2
+                start = self.pos
+            elif char == quote and self.closes_string(self.pos, key):
+                parts.append(text[start:self.pos])
+                self.pos += 1
+                return "".join(parts)
+            elif char in "\r\n\t":
+                # Сырые переводы строк внутри значения - пробелом (как делал fix_json_format)
+                parts.append(text[start:self.pos])
+                parts.append(" ")
+                self.pos += 1
+                start = self.pos
+            else:
+                self.pos += 1
+        parts.append(text[start:self.pos])  # Строка оборвана концом ответа
+        return "".join(parts)
+
+    def bare(self, key):
+        """Значение или ключ без кавычек: до разделителя (и до ':' для ключа)"""
+        text = self.text
+        start = self.pos
+        stops = ":{}[],\n" if key else "{}[],\n"
+        while self.pos < self.length and text[self.pos] not in stops:
+            if text.startswith("//", self.pos) and not text.startswith("://", self.pos - 1):
+                break
+            self.pos += 1
+        token = text[start:self.pos].strip()
+        if key:
+            return token
+        if self.pos == start and self.pos < self.length and text[self.pos] in "}]":
+            return None  # Пустое значение перед закрывающей скобкой
+        if self.pos == start:
+            self.pos += 1  # Неожиданный символ - пропускаем, чтобы не зациклиться
+            return None
+        return _bare_value(token)
+
+
+def _bare_value(token):
+    """Константы и числа без кавычек; реквизиты с ведущими нулями и длинные номера - строкой"""
+    if token in _CONSTANTS:
+        return _CONSTANTS[token]
+    digits = token.lstrip("-")
+    if digits.isdigit():
+        if (len(digits) > 1 and digits[0] == "0") or len(digits) >= 9:
+            return token  # ИНН / КПП / номера счетов остаются строками
+        return int(token)
+    try:
+        return float(token)
+    except ValueError:
+        return token
+
+
+def parse_json_lenient(text, open_char="{"):
+    """
+    Разбор JSON объекта (или массива при open_char='[') из ответа модели
+    Текст до первой скобки и после закрытия верхнеуровневого значения игнорируется.
+    Возвращает dict/list; ValueError - если в тексте нет JSON значения
+    или вложенность больше MAX_DEPTH
+    """
+    start = text.find(open_char)
+    if start == -1:
+        raise ValueError(f"Не найден JSON ('{open_char}') в ответе")
+    # Быстрый путь - корректный JSON (с возможным текстом после него)
+    try:
+        value, _ = json.JSONDecoder().raw_decode(text, start)
+        return value
+    except (ValueError, RecursionError):
+        pass  # RecursionError - глубокая вложенность, терпимый разбор ответит ValueError
+    parser = _LenientParser(text)
+    parser.pos = start
+    return parser.value()
+
+
+def repair_json(text, open_char="{"):
+    """Исправленная JSON строка (для мест, где нужен текст, а не объект)"""
+    return json.dumps(parse_json_lenient(text, open_char), ensure_ascii=False)
+
+
+# Синтетический корпус: строки написаны вручную по типам поломок ответов LLM,
+# это не захваченные ответы моделей. Доля разбора на нем - проверка типов ошибок,
+# а не оценка на реальных данных: для нее запускайте модуль с файлом ответов (см. ниже)
+BAD_LLM_OUTPUTS = [
+    # Комментарии из шаблона промпта и висячая запятая
+    '{\n  "Название_файла": "scan_001.pdf",\n  "Тип_документа": "счет",  // ТОЛЬКО ОДНО ПОЛЕ С ТИПОМ!\n'
+    '  "Номер_документа": "125",\n  "ИНН_заказчика": "7707083893",  // 10 или 12 цифр\n}',
+    # Пояснения вокруг, markdown ограждение
+    'Вот извлеченные данные:\n```json\n{"Тип_документа": "акт", "Номер_документа": "17"}\n```\nНадеюсь, это поможет!',
+    # Неэкранированные кавычки в наименованиях
+    '{"Наименование_заказчика": "ООО "Ромашка"", "Наименование_исполнителя": "АО "Лес" и партнеры", '
+    '"Тип_заказчика": "юрлицо"}',
+    # Одинарные кавычки (python dict)
+    "{'Тип_документа': 'договор', 'Номер_документа': 'Д-12/2024', 'КПП_заказчика': '770701001'}",
+    # Ключи без кавычек, кириллица и пробелы
+    '{Тип_документа: "счет-фактура", Номер документа: "45", ИНН_исполнителя: 500100732259}',
+    # Перевод строки внутри значения адреса
+    '{"Адрес_заказчика": "г. Москва,\nул. Ленина, д. 1", "Адрес_исполнителя": "г. Тверь"}',
+    # Пропущенные запятые между полями
+    '{\n "Тип_документа": "акт"\n "Номер_документа": "3"\n "Дата_документа": "01.02.2024"\n}',
+    # Ответ оборван по max_tokens
+    '{"Тип_документа": "договор", "Наименование_заказчика": "ИП Иванов И.И.", "Адрес_заказчика": "г. Казань, ул. Баум',
+    # Реквизиты числами, с ведущим нулем
+    '{"ИНН_заказчика": 0278012345, "КПП_заказчика": 027801001, "Номер_документа": 12}',
+    # Пакет документов - массив
+    '[{"Название_файла": "a.pdf", "Тип_документа": "счет",}, {"Название_файла": "b.pdf", "Тип_документа": "акт"},]',
+    # Python-константы и \\u-экранирование кириллицы
+    '{"Тип_документа": "\\u0430\\u043a\\u0442", "Подписан": True, "КПП_исполнителя": None}',
+    # Оборван посреди экранирования
+    '{"Тип_документа": "счет", "Наименование_исполнителя": "ООО \\"Вектор\\u04',
+    # После JSON модель "исправляет" себя вторым объектом - берется первый
+    '{"Тип_документа": "акт", "Номер_документа": "7"}\nИсправленный вариант: {"Тип_документа": "акт"}',
+    # Ключ без значения и пустое значение перед скобкой
+    '{"Тип_документа": "счет", "Дата_документа", "Номер_документа": }',
+]
+
+
+if __name__ == "__main__":
+    import random
+    import re
+    import sys
+    import time
+
+    # python json_repair.py [ответы.jsonl] - захваченные ответы модели, по строке JSON на ответ
+    # (сырой content как JSON строка); без файла - синтетический корпус BAD_LLM_OUTPUTS
+    corpus, corpus_name = BAD_LLM_OUTPUTS, "синтетический корпус"
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], encoding="utf-8") as f:
+            corpus = [json.loads(line) for line in f if line.strip()]
+        corpus_name = f"захваченные ответы {sys.argv[1]}"
+
+    # Прежняя цепочка ремонта регулярками - только для сравнения
+    def fix_json_format(json_str):
+        """Прежний ремонт JSON регулярками"""
+        # Заменяем одинарные кавычки на двойные вокруг ключей и строковых значений
+        json_str = re.sub(r"([\{\s,]+)'([^']+)'\s*:", r'\1"\2":', json_str)
+        json_str = re.sub(r":\s*'([^']+)'([\s,\}]+)", r':"\1"\2', json_str)
+
+        # Исправляем ключи без кавычек (наиболее частая ошибка)
+        json_str = re.sub(r"([\{\s,]+)([A-Za-zА-Яа-я0-9_]+)\s*:", r'\1"\2":', json_str)
+
+        # Убираем комментарии в стиле JavaScript
+        json_str = re.sub(r"//[^\n]*", "", json_str)
+
+        # Удаляем последние запятые перед закрывающими скобками (trailing commas)
+        json_str = re.sub(r',\s*\}', '}', json_str)
+
+        # Преобразуем \n в пробелы внутри строковых значений
+        in_string = False
+        result = []
+        for char in json_str:
+            if char == '"' and (not result or result[-1] != '\\'):
+                in_string = not in_string
+            if in_string and char == '\n':
+                result.append(' ')
+            else:
+                result.append(char)
+
+        return ''.join(result)
+
+
+    def aggressive_json_repair(json_str):
+        """Прежнее агрессивное восстановление JSON"""
+        # Основная обработка
+        json_str = fix_json_format(json_str)
+
+        # Дополнительные агрессивные исправления
+
+        # Исправляем пропущенные запятые между объектами
+        json_str = re.sub(r'("[^"]*")\s*("[^"]*"\s*:)', r'\1,\2', json_str)
+
+        # Заменяем неэкранированные кавычки в строковых значениях
+        in_string = False
+        quote_start = -1
+        result = []
+
+        for i, char in enumerate(json_str):
+            if char == '"' and (i == 0 or json_str[i-1] != '\\'):
+                if not in_string:
+                    in_string = True
+                    quote_start = i
+                else:
+                    in_string = False
+
+            # Если внутри строки и нашли неэкранированную кавычку - экранируем её
+            if in_string and char == '"' and i != quote_start and json_str[i-1] != '\\':
+                result.append('\\')
+
+            result.append(char)
+
+        return ''.join(result)
+
+
+    print(f"Плохие ответы LLM ({corpus_name}, {len(corpus)}):")
+    new_parsed = 0
+    for sample in corpus:
+        open_char = "[" if sample.lstrip().startswith("[") else "{"
+        try:
+            parsed = parse_json_lenient(sample, open_char)
+            new_parsed += 1
+            print(f"  {parsed}")
+        except ValueError as e:
+            print(f"  ⚠️ {e}")
+
+    old_parsed = 0
+    for sample in corpus:
+        open_char, close_char = ("[", "]") if sample.lstrip().startswith("[") else ("{", "}")
+        fragment = sample[sample.find(open_char):sample.rfind(close_char) + 1]
+        try:
+            json.loads(aggressive_json_repair(fix_json_format(fragment)))
+            old_parsed += 1
+        except json.JSONDecodeError:
+            pass
+    print(f"Разобрано: однопроходный {new_parsed}, прежняя цепочка регулярок {old_parsed} из {len(corpus)}")
+
+    # Фазз: случайные обрезки и вставки мусора не должны приводить к исключениям/зависаниям
+    random.seed(7)
+    junk = ['"', "'", "{", "}", "[", "]", ",", ":", "\n", "//", "/*", "\\", "ООО", " "]
+    failures = 0
+    for _ in range(20000):
+        sample = random.choice(corpus)
+        chars = list(sample[:random.randint(1, len(sample))])
+        for _ in range(random.randint(0, 5)):
+            chars.insert(random.randint(0, len(chars)), random.choice(junk))
+        try:
+            parse_json_lenient("".join(chars))
+        except ValueError:
+            pass  # Нет JSON вовсе - допустимый результат
+        except Exception as e:
+            failures += 1
+            print(f"⚠️ Фазз: {type(e).__name__}: {e!r} на {''.join(chars)!r}")
+    print(f"Фазз: 20000 случаев, непредвиденных ошибок: {failures}")
+    try:
+        parse_json_lenient('{"a":' + "[" * 3000)
+    except ValueError as e:
+        print(f"Глубокая вложенность: ValueError ({e})")
+
+    # Бенчмарк на многокилобайтных сломанных ответах: прежняя цепочка регулярок против однопроходного разбора
+    big = "{" + ",\n".join(
+        f'  Поле_{i}: "ООО "Компания {i}" г. Москва,\nул. Ленина, д. {i}"  // комментарий {i}' for i in range(400)
+    ) + ",\n}"
+    print(f"\nБенчмарк: ответ {len(big)} символов")
+    start = time.perf_counter()
+    for _ in range(20):
+        parsed = parse_json_lenient(big)
+    print(f"  однопроходный: {(time.perf_counter() - start) / 20 * 1000:.1f} мс, полей {len(parsed)}")
+    start = time.perf_counter()
+    for _ in range(20):
+        try:
+            json.loads(aggressive_json_repair(fix_json_format(big)))
+            old_ok = True
+        except json.JSONDecodeError:
+            old_ok = False
+    print(f"  fix_json_format + aggressive_json_repair: {(time.perf_counter() - start) / 20 * 1000:.1f} мс, "
+          f"{'разобран' if old_ok else 'не разобран'}")
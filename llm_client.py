@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+HTTP клиент для LLM (LM Studio / OpenAI)
+Каждый процесс воркера держит пул keep-alive соединений: TCP и TLS рукопожатия
+не повторяются на каждый документ. Неудачные подключения повторяются на транспортном
+уровне (отправленный запрос - нет), время подключения и ожидания ответа замеряется для статистики.
+"""
+import json
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+# Значения по умолчанию (переопределяются через llm_settings)
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 180
+DEFAULT_HTTP_RETRIES = 2
+
+# Замеры подключений текущего потока (заполняются из urllib3 при connect)
+_CONNECT_STATS = threading.local()
+
+
+class _TimedConnectionMixin:
+    """Замер времени установки соединения (для HTTPS - вместе с TLS рукопожатием)"""
+
+    def connect(self):
+        start_time = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            _CONNECT_STATS.connect_time = getattr(_CONNECT_STATS, 'connect_time', 0.0) + time.perf_counter() - start_time
+            _CONNECT_STATS.new_connections = getattr(_CONNECT_STATS, 'new_connections', 0) + 1
+
+
+class TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter, чьи соединения сообщают время подключения"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, http_retries=DEFAULT_HTTP_RETRIES):
+    """
+    Сессия с пулом keep-alive соединений
+    Повторяются только ошибки подключения (запрос еще не отправлен). Таймаут/обрыв
+    чтения и HTTP статусы не повторяются: POST мог уже выполниться (и тарифицироваться),
+    ими управляет автоповтор воркера с паузами и лимитером
+    """
+    retry = Retry(
+        total=http_retries,
+        connect=http_retries,
+        read=0,
+        status=0,
+        backoff_factor=0.5,
+        raise_on_status=False,
+    )
+    adapter = TimedHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+
+# Сессии текущего процесса по параметрам пула
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def get_llm_session(llm_settings):
+    """Пул соединений текущего процесса (создается при первом запросе)"""
+    key = (
+        llm_settings.get('pool_size', DEFAULT_POOL_SIZE),
+        llm_settings.get('http_retries', DEFAULT_HTTP_RETRIES),
+    )
+    with _SESSIONS_LOCK:
+        if key not in _SESSIONS:
+            _SESSIONS[key] = create_session(*key)
+        return _SESSIONS[key]
+
+
+def post_json(url, payload, headers, llm_settings, timings=None, stream=False):
+    """
+    POST запрос через пул соединений процесса
+    timings (dict) дополняется: connect_time, wait_time, read_time, total_time,
+    connection_reused, new_connections, sent_at (perf_counter отправки)
+    stream=True - тело не читается (см. read_stream_content)
+    """
+    session = get_llm_session(llm_settings)
+    timeout = (
+        llm_settings.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT),
+        llm_settings.get('timeout', DEFAULT_READ_TIMEOUT),
+    )
+
+    _CONNECT_STATS.connect_time = 0.0
+    _CONNECT_STATS.new_connections = 0
+    start_time = time.perf_counter()
+    try:
+        response = session.post(url, json=payload, headers=headers, timeout=timeout, stream=stream)
+    finally:
+        if timings is not None:
+            timings["sent_at"] = start_time
+            timings["connect_time"] = _CONNECT_STATS.connect_time
+            timings["new_connections"] = _CONNECT_STATS.new_connections
+            timings["connection_reused"] = _CONNECT_STATS.new_connections == 0
+            timings["total_time"] = time.perf_counter() - start_time
+
+    if timings is not None:
+        # elapsed - от отправки до заголовков ответа (включает подключение)
+        elapsed = response.elapsed.total_seconds()
+        timings["wait_time"] = max(0.0, elapsed - timings["connect_time"])
+        timings["read_time"] = max(0.0, timings["total_time"] - elapsed)
+    return response
+
+
+class JsonCompletionTracker:
+    """
+    Инкрементальный трекер скобок: по кускам текста определяет момент, когда
+    закрылся верхнеуровневый JSON объект (или массив), начатый с open_char.
+    Скобки внутри строк и экранированные кавычки не учитываются.
+    """
+
+    def __init__(self, open_char='{'):
+        self.open_char = open_char
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escape = False
+        self.complete = False
+
+    def feed(self, text):
+        """Возвращает длину префикса text до конца JSON включительно или None, если JSON еще не закрыт"""
+        for index, char in enumerate(text):
+            if not self.started:
+                if char == self.open_char:
+                    self.started = True
+                    self.depth = 1
+                continue
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in '{[':
+                self.depth += 1
+            elif char in '}]':
+                self.depth -= 1
+                if self.depth == 0:
+                    self.complete = True
+                    return index + 1
+        return None
+
+
+def read_stream_content(response, timings=None, open_char='{', drain_usage=False):
+    """
+    Чтение потокового ответа chat/completions (SSE, stream: true)
+    Чтение прекращается, а соединение закрывается, как только закрыт верхнеуровневый
+    JSON - модель не дописывает текст после него. Возвращает (content, последний_чанк);
+    timings дополняется first_token_time, json_complete_time (от отправки запроса), stopped_early.
+    drain_usage - после JSON дочитать поток до чанка с usage (OpenAI присылает его
+    последним при stream_options.include_usage): текст после JSON отбрасывается,
+    но токены промпта/кеша и поправка лимита TPM не теряются.
+    """
+    tracker = JsonCompletionTracker(open_char)
+    read_started = time.perf_counter()
+    started_at = (timings or {}).get("sent_at", read_started)
+    parts = []
+    last_chunk = {}
+    stopped_early = False
+    json_complete_time = None
+    try:
+        for raw_line in response.iter_lines():
+            if not raw_line:
+                continue
+            line = raw_line.decode('utf-8') if isinstance(raw_line, bytes) else raw_line
+            if not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == "[DONE]":
+                break
+            try:
+                chunk = json.loads(payload)
+            except ValueError:
+                continue
+            last_chunk = chunk
+            if tracker.complete:
+                if chunk.get('usage'):
+                    break  # Дочитали до usage
+                continue
+            choices = chunk.get('choices') or [{}]
+            delta = (choices[0].get('delta') or {}).get('content') or ''
+            if not delta:
+                continue
+            if timings is not None and "first_token_time" not in timings:
+                timings["first_token_time"] = time.perf_counter() - started_at
+            end = tracker.feed(delta)
+            if end is not None:
+                parts.append(delta[:end])
+                json_complete_time = time.perf_counter() - started_at
+                if drain_usage:
+                    continue
+                stopped_early = True
+                break
+            parts.append(delta)
+    finally:
+        # Закрытие без дочитывания: сервер прекращает генерацию, соединение не вернется в пул
+        response.close()
+    if timings is not None:
+        timings["read_time"] = timings.get("read_time", 0.0) + time.perf_counter() - read_started
+        if json_complete_time is not None:
+            timings["json_complete_time"] = json_complete_time
+        timings["stopped_early"] = stopped_early
+    return "".join(parts), last_chunk
+
+
+def format_http_timings(timings):
+    """Краткая строка о сетевой части запроса для лога"""
+    if not timings or "total_time" not in timings:
+        return "нет данных"
+    reuse = "повторное" if timings.get("connection_reused") else f"новое ({timings.get('new_connections', 0)})"
+    line = (f"соединение {reuse}, подключение {timings.get('connect_time', 0):.2f}с, "
+            f"ожидание {timings.get('wait_time', 0):.1f}с, чтение {timings.get('read_time', 0):.2f}с")
+    if timings.get("rate_wait") or timings.get("rate_retries"):
+        line += f", лимит частоты: пауза {timings.get('rate_wait', 0):.1f}с, повторов {timings.get('rate_retries', 0)}"
+    return line
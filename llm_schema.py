@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+JSON схема ответа LLM для строгого (constrained) вывода
+Передается в response_format: OpenAI structured outputs, в LM Studio / llama.cpp
+та же схема превращается в грамматику - ответ всегда разбирается как JSON.
+"""
+
+# Поля результата в порядке шаблона промпта
+LLM_RESULT_FIELDS = [
+    "Название_файла",
+    "Тип_документа",
+    "Номер_документа",
+    "Дата_документа",
+    "Наименование_заказчика",
+    "Наименование_исполнителя",
+    "ИНН_заказчика",
+    "КПП_заказчика",
+    "Адрес_заказчика",
+    "ИНН_исполнителя",
+    "КПП_исполнителя",
+    "Адрес_исполнителя",
+    "Тип_заказчика",
+    "Тип_исполнителя",
+]
+
+DOCUMENT_TYPES = ["договор", "акт", "счет", "счет-фактура"]
+PARTY_TYPES = ["юрлицо", "ип", "физлицо"]
+
+# Ответ по схеме - 14 коротких полей; с запасом на длинные наименования и адреса
+STRUCTURED_MAX_TOKENS_PER_DOC = 768
+
+
+def result_schema():
+    """Схема одного документа: все поля обязательны, лишние запрещены"""
+    properties = {field: {"type": "string"} for field in LLM_RESULT_FIELDS}
+    properties["Тип_документа"] = {"type": "string", "enum": DOCUMENT_TYPES}
+    properties["Тип_заказчика"] = {"type": "string", "enum": PARTY_TYPES}
+    properties["Тип_исполнителя"] = {"type": "string", "enum": PARTY_TYPES}
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(LLM_RESULT_FIELDS),
+        "additionalProperties": False,
+    }
+
+
+def build_response_format(batch=False):
+    """
+    response_format для запроса chat/completions
+    Пакет документов - объект {"documents": [...]} (корень схемы должен быть объектом)
+    """
+    if batch:
+        schema = {
+            "type": "object",
+            "properties": {"documents": {"type": "array", "items": result_schema()}},
+            "required": ["documents"],
+            "additionalProperties": False,
+        }
+        name = "document_batch"
+    else:
+        schema = result_schema()
+        name = "document_fields"
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": name, "strict": True, "schema": schema},
+    }
+
+
+def structured_max_tokens(configured, documents=1):
+    """max_tokens для ответа по схеме: размер схемы, но не больше заданного в настройках"""
+    return min(configured, STRUCTURED_MAX_TOKENS_PER_DOC * max(1, documents))
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+OCR ядро SuperOCR на базе Surya
+Держит предикторы Surya загруженными на весь срок жизни процесса воркера
+и формирует единую структуру pages_data для всех путей обработки
+"""
+import os
+import time
+
+import pypdfium2 as pdfium
+from surya.input.load import load_from_file
+from surya.detection import DetectionPredictor
+from surya.recognition import RecognitionPredictor
+from surya.common.surya.schema import TaskNames
+
+
+# Окно потокового рендера: сколько страниц PDF держим в памяти одновременно
+DEFAULT_PAGE_WINDOW = 8
+
+
+class SuryaModels:
+    """Держатель предикторов Surya: модели грузятся один раз на процесс"""
+
+    def __init__(self):
+        self.det_predictor = None
+        self.rec_predictor = None
+        self.load_time = 0.0       # Время загрузки моделей (сек)
+        self.warmup_time = 0.0     # Время прогрева (сек)
+        self._load_reported = False
+
+    @property
+    def loaded(self):
+        return self.rec_predictor is not None
+
+    def load(self, warmup=True):
+        """Загрузка предикторов (повторный вызов ничего не делает)"""
+        if self.loaded:
+            return self
+        start_time = time.time()
+        self.det_predictor = DetectionPredictor()
+        self.rec_predictor = RecognitionPredictor()
+        self.load_time = time.time() - start_time
+        print(f"🧠 Модели Surya загружены за {self.load_time:.1f}с (PID {os.getpid()})")
+        if warmup:
+            self.warmup()
+        return self
+
+    def warmup(self):
+        """Прогрев: первый прогон на пустой странице, чтобы не платить за него на реальном файле"""
+        try:
+            from PIL import Image
+            start_time = time.time()
+            blank = Image.new("RGB", (256, 64), "white")
+            self.rec_predictor(
+                [blank],
+                task_names=[TaskNames.ocr_with_boxes],
+                det_predictor=self.det_predictor,
+                math_mode=False
+            )
+            self.warmup_time = time.time() - start_time
+            print(f"🔥 Прогрев Surya: {self.warmup_time:.1f}с")
+        except Exception as e:
+            print(f"⚠️ Ошибка прогрева Surya: {e}")
+
+    def take_load_time(self):
+        """
+        Возвращает время загрузки+прогрева один раз за жизнь процесса,
+        далее 0 - чтобы в статистике по файлам загрузка учитывалась однократно
+        """
+        if self._load_reported or not self.loaded:
+            return 0.0
+        self._load_reported = True
+        return self.load_time + self.warmup_time
+
+
+# Единственный экземпляр на процесс
+_SURYA_MODELS = None
+
+
+def get_surya_models(warmup=True):
+    """Возвращает загруженные модели текущего процесса (загружает при первом вызове)"""
+    global _SURYA_MODELS
+    if _SURYA_MODELS is None:
+        _SURYA_MODELS = SuryaModels()
+    return _SURYA_MODELS.load(warmup=warmup)
+
+
+def predictions_to_pages(predictions, first_page=1, page_numbers=None):
+    """
+    Преобразует предсказания Surya в pages_data и сплошной текст
+    page_numbers - реальные номера страниц (если распознаны не подряд)
+    """
+    pages_data = []
+    combined_text = ""
+
+    for page_idx, pred in enumerate(predictions):
+        page_lines = []
+        page_text = ""
+        for line in pred.text_lines:
+            line_data = {
+                "text": line.text,
+                "bbox": line.bbox,
+                "confidence": line.confidence
+            }
+            page_lines.append(line_data)
+            page_text += line.text + " "
+        pages_data.append({
+            "page": page_numbers[page_idx] if page_numbers else first_page + page_idx,
+            "text_lines": page_lines
+        })
+        combined_text += page_text
+
+    return pages_data, combined_text
+
+
+def load_pdf_images(pdf_path, page_indices=None):
+    """Рендер страниц PDF в изображения (всех или только page_indices, с 0)"""
+    if page_indices is None:
+        images, names = load_from_file(pdf_path)
+    else:
+        images, names = load_from_file(pdf_path, page_range=list(page_indices))
+    return images
+
+
+def get_pdf_page_count(pdf_path):
+    """Количество страниц PDF без рендера"""
+    doc = pdfium.PdfDocument(pdf_path)
+    try:
+        return len(doc)
+    finally:
+        doc.close()
+
+
+def select_extraction_pages(page_count, head_pages, tail_pages):
+    """
+    Страницы, которые увидит LLM: первые head_pages и последние tail_pages
+    (заголовок/реквизиты и итоги/подписи). Возвращает индексы с 0 по возрастанию.
+    """
+    head = range(0, min(head_pages, page_count))
+    tail = range(max(0, page_count - tail_pages), page_count)
+    return sorted(set(head) | set(tail))
+
+
+def iter_page_windows(pdf_path, page_window=DEFAULT_PAGE_WINDOW, page_indices=None):
+    """
+    Потоковый рендер PDF окнами по page_window страниц
+    Выдает (номера_страниц, images); рендер тот же, что у load_from_file
+    Генератор не держит ссылку на окно после yield: если вызывающий освободил
+    images, при рендере следующего окна в памяти только оно
+    """
+    if page_indices is None:
+        page_indices = list(range(get_pdf_page_count(pdf_path)))
+    for start in range(0, len(page_indices), page_window):
+        window = page_indices[start:start + page_window]
+        images = load_pdf_images(pdf_path, window)
+        yield [idx + 1 for idx in window], images
+        images = None  # Иначе кадр генератора держит прошлое окно во время рендера следующего
+
+
+def run_recognition(images, models):
+    """Детекция + распознавание списка страниц одним вызовом Surya"""
+    task_names = [TaskNames.ocr_with_boxes] * len(images)
+    return models.rec_predictor(
+        images,
+        task_names=task_names,
+        det_predictor=models.det_predictor,
+        math_mode=False
+    )
+
+
+def make_ocr_json(pdf_path, pages_data, combined_text, page_count=None):
+    """
+    Итоговая OCR структура файла
+    Если распознана только часть страниц (режим извлечения) - помечаем это
+    """
+    combined_text = combined_text.strip()
+    ocr_json = {
+        "filename": os.path.basename(pdf_path),
+        "pages": page_count if page_count is not None else len(pages_data),
+        "pages_data": pages_data,
+        "full_text": combined_text
+    }
+    if page_count is not None and len(pages_data) < page_count:
+        ocr_json["extraction_only"] = True
+        ocr_json["ocr_pages"] = [page["page"] for page in pages_data]
+    return ocr_json, combined_text
+
+
+def build_ocr_json(pdf_path, predictions, page_indices=None, page_count=None):
+    """Итоговая OCR структура файла из предсказаний: (ocr_json, combined_text)"""
+    page_numbers = [idx + 1 for idx in page_indices] if page_indices is not None else None
+    pages_data, combined_text = predictions_to_pages(predictions, page_numbers=page_numbers)
+    return make_ocr_json(pdf_path, pages_data, combined_text, page_count)
+
+
+def ocr_pdf(pdf_path, models=None, page_window=DEFAULT_PAGE_WINDOW, extraction_pages=None):
+    """
+    OCR одного PDF на уже загруженных моделях
+    
+    При page_window > 0 страницы рендерятся и распознаются окнами, а изображения
+    окна освобождаются до рендера следующего: пиковая память зависит от размера
+    окна, а не от длины документа. Результат совпадает с полной загрузкой.
+    
+    extraction_pages = (первых, последних) - режим извлечения: распознаются
+    только страницы, которые попадут в LLM.
+    Возвращает (ocr_json, combined_text, timings)
+    """
+    timings = {"model_load_time": 0.0, "inference_time": 0.0}
+
+    if models is None:
+        models = get_surya_models()
+    timings["model_load_time"] = models.take_load_time()
+
+    start_time = time.time()
+    is_pdf = pdf_path.lower().endswith('.pdf')
+    page_count = None
+    page_indices = None
+    if extraction_pages and is_pdf:
+        page_count = get_pdf_page_count(pdf_path)
+        page_indices = select_extraction_pages(page_count, *extraction_pages)
+
+    if not page_window or not is_pdf:
+        predictions = run_recognition(load_pdf_images(pdf_path, page_indices), models)
+        ocr_json, combined_text = build_ocr_json(pdf_path, predictions, page_indices, page_count)
+    else:
+        pages_data = []
+        combined_text = ""
+        for page_numbers, images in iter_page_windows(pdf_path, page_window, page_indices):
+            predictions = run_recognition(images, models)
+            del images  # Освобождаем окно до рендера следующего
+            window_pages, window_text = predictions_to_pages(predictions, page_numbers=page_numbers)
+            pages_data.extend(window_pages)
+            combined_text += window_text
+        ocr_json, combined_text = make_ocr_json(pdf_path, pages_data, combined_text, page_count)
+    timings["inference_time"] = time.time() - start_time
+
+    return ocr_json, combined_text, timings
+
+
+def ocr_documents_batch(documents, models=None):
+    """
+    Межфайловый батч: страницы нескольких PDF распознаются одним вызовом Surya,
+    затем предсказания раскладываются обратно по файлам
+
+    documents - список (pdf_path, images, page_indices, page_count);
+    page_indices=None - в images все страницы документа
+    Возвращает (список (ocr_json, combined_text) в порядке documents, время распознавания)
+    """
+    if models is None:
+        models = get_surya_models()
+
+    all_images = []
+    for pdf_path, images, page_indices, page_count in documents:
+        all_images.extend(images)
+
+    start_time = time.time()
+    predictions = run_recognition(all_images, models) if all_images else []
+    inference_time = time.time() - start_time
+
+    results = []
+    offset = 0
+    for pdf_path, images, page_indices, page_count in documents:
+        doc_predictions = predictions[offset:offset + len(images)]
+        offset += len(images)
+        results.append(build_ocr_json(pdf_path, doc_predictions, page_indices, page_count))
+
+    return results, inference_time
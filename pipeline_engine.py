@@ -0,0 +1,2138 @@
+#!/usr/bin/env python3
+"""
+Движок массовой обработки документов без GUI: OCR (Surya) → правила → LLM
+Воркеры OCR/LLM, журнал запуска, писатель результатов и оркестратор PipelineEngine.
+Используется GUI (gui_run.py), разовым запуском из командной строки и демоном
+слежения за папкой (headless_run.py). О ходе работы движок сообщает слушателю
+(EngineListener): по умолчанию - печать в консоль, GUI обновляет виджеты.
+"""
+import os
+import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import requests
+from multiprocessing import Process, Queue
+import queue
+
+# OCR ядро Surya (модели загружаются один раз на процесс)
+from ocr_engine import (get_surya_models, ocr_pdf, load_pdf_images, get_pdf_page_count,
+                        select_extraction_pages, ocr_documents_batch, DEFAULT_PAGE_WINDOW)
+
+# Персистентные кеши OCR и ответов LLM
+from result_cache import get_ocr_cache, get_llm_cache, file_sha256
+
+# Хранилище результатов OCR (SQLite, один процесс-писатель) с выгрузкой в CSV
+from results_store import make_row, write_ocr_result, results_writer, results_db_path, ResultsStore
+
+# Журнал запуска для продолжения прерванной обработки
+from job_journal import JobJournal, journal_path, OCR_DONE, LLM_DONE, FAILED
+
+# HTTP клиент LLM с пулом keep-alive соединений
+from llm_client import post_json, read_stream_content, DEFAULT_POOL_SIZE
+
+# Ограничение частоты запросов к OpenAI (RPM/TPM, 429/Retry-After)
+from rate_limiter import get_rate_limiter, get_retry_after, backoff_delay, RETRY_STATUS_CODES
+
+# Форматы данных OCR в промпте
+from prompt_encoding import encode_lines
+
+# JSON схема ответа для строгого вывода (response_format)
+from llm_schema import build_response_format, structured_max_tokens
+
+# Терпимый однопроходный разбор JSON ответов LLM
+from json_repair import parse_json_lenient
+
+# Проверка реквизитов по индексу текста документа
+from field_validation import TextIndex, fix_requisites, clean_document_number
+
+# Быстрый путь без LLM: классификация и поля по правилам (ИНН по контрольной сумме и меткам ролей)
+from rule_classifier import rule_based_result, rule_result_json
+
+# События воркеров для оркестратора (вместо строк лога)
+from pipeline_events import (PipelineEvent, render_event, STAGE_OCR, STAGE_LLM, STAGE_RULES,
+                             STATUS_STARTED, STATUS_STOPPED, STATUS_INFO, STATUS_RETRY, STATUS_DONE, STATUS_FAILED)
+
+# Импорт для подсчета токенов
+from token_counter import smart_truncate_for_llm, estimate_tokens
+
+# Демон: пауза между опросами папки и предел попыток для файла с ошибкой
+WATCH_POLL_INTERVAL = 5.0
+WATCH_MAX_ATTEMPTS = 3
+
+
+def ocr_worker(pdf_queue, ocr_queue, pdf_folder, date_format):
+    """OCR воркер: непрерывно обрабатывает PDF и подает в OCR очередь"""
+    models = get_surya_models()  # Загрузка и прогрев один раз на процесс
+    
+    while True:
+        try:
+            pdf_file = pdf_queue.get(timeout=1)
+            if pdf_file is None:  # Сигнал завершения
+                break
+                
+            pdf_path = os.path.join(pdf_folder, pdf_file)
+            
+            # OCR обработка на загруженных моделях
+            ocr_json, combined_text, timings = ocr_pdf(pdf_path, models)
+            pages_data = ocr_json["pages_data"]
+            
+            # Сохранение результата OCR
+            store_ocr_result(pdf_file, pdf_folder, date_format, ocr_json, combined_text)
+            
+            # Подготовка данных для LLM (ПРАВИЛЬНАЯ ЛОГИКА!)
+            if len(pages_data) == 1:
+                # ОДНА СТРАНИЦА - передаем ПОЛНОСТЬЮ
+                truncated_lines = [{"source": "single_page", **line} for line in pages_data[0]["text_lines"]]
+            else:
+                # МНОГОСТРАНИЧНЫЕ - только 10 первых + 30 последних
+                truncated_lines = []
+                first_page_lines = pages_data[0]["text_lines"]
+                truncated_lines.extend([{"source": "first_page", **line} for line in first_page_lines[:10]])
+                last_page_lines = pages_data[-1]["text_lines"]
+                start_idx = max(0, len(last_page_lines) - 30)
+                truncated_lines.extend([{"source": "last_page", **line} for line in last_page_lines[start_idx:]])
+            
+            # Подаем в OCR очередь
+            ocr_queue.put((pdf_file, truncated_lines, combined_text.strip()))
+            
+        except queue.Empty:
+            continue
+        except Exception as e:
+            ocr_queue.put((pdf_file, None, f"OCR ошибка: {e}"))
+
+def llm_worker(ocr_queue, result_queue, json_folder, llm_settings, model_name, worker_name=None, retry_queue=None):
+    """ЛЛМ воркер: непрерывно обрабатывает OCR данные"""
+    display_name = worker_name or model_name
+    result_queue.put(PipelineEvent(STAGE_LLM, STATUS_STARTED, worker=display_name))
+    
+    while True:
+        try:
+            item = ocr_queue.get(timeout=1)
+            if item is None:  # Сигнал завершения
+                result_queue.put(PipelineEvent(STAGE_LLM, STATUS_STOPPED, worker=display_name))
+                break
+            if llm_settings.get('batch_docs', 0) > 1:
+                # Пакетный режим: несколько мелких документов одним запросом
+                batch, singles, stop = collect_llm_batch(item, ocr_queue, llm_settings)
+                process_llm_group(batch, singles, result_queue, json_folder, llm_settings, model_name, display_name, retry_queue)
+                if stop:
+                    result_queue.put(PipelineEvent(STAGE_LLM, STATUS_STOPPED, worker=display_name))
+                    break
+                continue
+            process_llm_item(item, result_queue, json_folder, llm_settings, model_name, display_name, retry_queue)
+        except queue.Empty:
+            continue
+
+def process_llm_item(item, result_queue, json_folder, llm_settings, model_name, display_name, retry_queue=None):
+    """
+    Обработка одного документа LLM: запрос, проверка результата, сохранение JSON
+    и постановка в очередь повтора при ошибке (общая для llm_worker и llm_async_worker)
+    На каждый документ в result_queue уходит ровно одно итоговое событие (DONE/FAILED)
+    либо RETRY, если документ поставлен в очередь повтора.
+    """
+    pdf_file = item[0]
+    max_attempts = llm_settings.get('max_retries', 3) + 1
+    event = PipelineEvent(STAGE_LLM, STATUS_FAILED, filename=pdf_file, worker=display_name,
+                          max_attempts=max_attempts)
+    try:
+        # Парсим данные с учетом счетчика попыток и полей, извлеченных без LLM
+        pdf_file, truncated_data, combined_text = item[:3]
+        retry_count = item[3] if len(item) > 3 else 0
+        known_fields = item[4] if len(item) > 4 else None
+        event.attempt = retry_count + 1
+            
+        result_queue.put(PipelineEvent(STAGE_LLM, STATUS_INFO, filename=pdf_file, worker=display_name,
+                                       kind="assigned", attempt=event.attempt, max_attempts=max_attempts))
+        
+        if truncated_data is None:  # Ошибка OCR
+            event.stage, event.error = STAGE_OCR, combined_text
+            result_queue.put(event)
+            return
+        
+        # Повтор после ошибки - не сразу, а с нарастающей паузой (без шторма повторов)
+        if retry_count > 0:
+            time.sleep(backoff_delay(retry_count - 1, base=2.0))
+        
+        # Анализ с LLM (с замером времени и сетевой части запроса)
+        start_time = time.time()
+        http_timings = {}
+        llm_result = analyze_with_llm_worker(pdf_file, truncated_data, llm_settings, model_name, http_timings)
+        event.processing_time = time.time() - start_time
+        event.timings = http_timings
+        event.prompt_tokens = http_timings.get("prompt_tokens") or 0
+        event.cached_tokens = http_timings.get("cached_tokens") or 0
+        
+        if "error" not in llm_result:
+            event.doc_type = save_llm_item(pdf_file, llm_result, combined_text, json_folder, known_fields)
+            event.status = STATUS_DONE
+        else:
+            # Ошибка LLM - проверяем возможность повтора
+            max_retries = max_attempts - 1
+            auto_retry = llm_settings.get('auto_retry', True)
+            event.error = llm_result['error']
+            
+            # Правильная проверка: retry_count начинается с 0, максимум max_retries попыток
+            if auto_retry and retry_count < max_retries and retry_queue is not None:
+                # Добавляем в очередь повтора
+                retry_queue.put((pdf_file, truncated_data, combined_text, retry_count + 1, known_fields))
+                event.status = STATUS_RETRY
+            elif "prediction-error" in llm_result.get('error', '').lower():
+                # Максимум попыток исчерпан или автоповтор отключен
+                event.error = "Превышен контекст модели - документ слишком большой"
+        result_queue.put(event)
+                
+    except Exception as e:
+        # Итоговая ошибка документа: оркестратор не ждет его бесконечно
+        event.status, event.kind, event.error = STATUS_FAILED, "exception", str(e)
+        result_queue.put(event)
+
+def save_llm_item(pdf_file, llm_result, combined_text, json_folder, known_fields=None):
+    """Проверка результата LLM и сохранение JSON документа. Возвращает тип документа"""
+    llm_result = validate_llm_result(llm_result, combined_text, known_fields=known_fields)
+    
+    # Сохранение JSON
+    json_filename = os.path.splitext(pdf_file)[0] + ".json"
+    json_path = os.path.join(json_folder, json_filename)
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(llm_result, f, ensure_ascii=False, indent=2)
+    
+    # Тип документа для статистики
+    return llm_result.get("Тип_документа", llm_result.get("Тип документа", "не указан"))
+
+def llm_item_tokens(item, llm_settings):
+    """Токены данных документа в формате промпта (None - документ не для пакета)"""
+    if len(item) > 3 and item[3] > 0:
+        return None  # Повторы идут поодиночке
+    if item[1] is None:
+        return None  # Ошибка OCR
+    return estimate_tokens(encode_lines(item[1], llm_settings.get('prompt_encoding', 'json')))
+
+def collect_llm_batch(first_item, ocr_queue, llm_settings):
+    """
+    Пакет мелких документов для одного запроса LLM
+    Берет из очереди документы, пока их не batch_docs и сумма токенов в пределах
+    batch_token_budget. Возвращает (пакет, документы_поодиночке, получен_стоп_сигнал).
+    """
+    max_docs = llm_settings.get('batch_docs', 0)
+    budget = llm_settings.get('batch_token_budget', 6000)
+    max_wait = llm_settings.get('batch_wait', 0.2)
+    
+    tokens = llm_item_tokens(first_item, llm_settings)
+    if tokens is None or tokens > budget:
+        return [], [first_item], False
+    
+    batch = [first_item]
+    singles = []
+    total_tokens = tokens
+    stop = False
+    while len(batch) < max_docs:
+        try:
+            item = ocr_queue.get(timeout=max_wait)
+        except queue.Empty:
+            break
+        if item is None:  # Стоп-сигнал: допроцессим собранное и выходим
+            stop = True
+            break
+        tokens = llm_item_tokens(item, llm_settings)
+        if tokens is None or total_tokens + tokens > budget:
+            singles.append(item)
+            break
+        batch.append(item)
+        total_tokens += tokens
+    return batch, singles, stop
+
+def generate_llm_batch_prompt(items, llm_settings):
+    """Сообщение пользователя для пакета: несколько документов, ответ - JSON массив"""
+    encoding = llm_settings.get('prompt_encoding', 'json')
+    parts = [f"ПАКЕТ ИЗ {len(items)} ДОКУМЕНТОВ. Обработай каждый документ отдельно по правилам и шаблону. "
+             f"Верни JSON массив из {len(items)} объектов по шаблону, по одному на документ, "
+             f"в поле \"Название_файла\" укажи имя файла документа."]
+    for item in items:
+        parts.append(generate_llm_prompt(item[0], item[1], encode_lines(item[1], encoding)))
+    return "\n\n".join(parts)
+
+def process_llm_batch(items, result_queue, json_folder, llm_settings, model_name, display_name, retry_queue=None):
+    """
+    Один запрос LLM на пакет документов; ответ раскладывается по файлам по "Название_файла".
+    Документы, для которых ответ не получен или не разобран, обрабатываются поодиночке.
+    """
+    if len(items) == 1:
+        process_llm_item(items[0], result_queue, json_folder, llm_settings, model_name, display_name, retry_queue)
+        return
+    
+    names = [item[0] for item in items]
+    result_queue.put(PipelineEvent(STAGE_LLM, STATUS_INFO, worker=display_name, kind="batch", files=names))
+    start_time = time.time()
+    http_timings = {}
+    try:
+        llm_result = send_to_llm(generate_llm_batch_prompt(items, llm_settings), llm_settings,
+                                 model_name, http_timings, expect_array=True)
+    except Exception as e:
+        llm_result = {"error": str(e)}
+    per_doc_time = (time.time() - start_time) / len(items)
+    if "total_time" in http_timings:
+        result_queue.put(PipelineEvent(STAGE_LLM, STATUS_INFO, worker=display_name, kind="batch_http",
+                                       files=names, timings=http_timings))
+    
+    answers = {}
+    if "error" not in llm_result:
+        for answer in llm_result["batch"]:
+            if isinstance(answer, dict) and answer.get("Название_файла"):
+                answers[str(answer["Название_файла"]).strip()] = answer
+    else:
+        result_queue.put(PipelineEvent(STAGE_LLM, STATUS_INFO, worker=display_name, kind="batch_unparsed",
+                                       files=names, error=llm_result['error']))
+    
+    fallback = []
+    for item in items:
+        pdf_file, truncated_data, combined_text = item[:3]
+        answer = answers.get(pdf_file)
+        if answer is None:
+            fallback.append(item)
+            continue
+        try:
+            doc_type = save_llm_item(pdf_file, answer, combined_text, json_folder, item[4] if len(item) > 4 else None)
+        except Exception as e:
+            result_queue.put(PipelineEvent(STAGE_LLM, STATUS_INFO, filename=pdf_file, worker=display_name,
+                                           kind="batch_save_error", error=str(e)))
+            fallback.append(item)
+            continue
+        result_queue.put(PipelineEvent(STAGE_LLM, STATUS_DONE, filename=pdf_file, worker=display_name,
+                                       doc_type=doc_type, processing_time=per_doc_time))
+    
+    if fallback and "error" not in llm_result:
+        result_queue.put(PipelineEvent(STAGE_LLM, STATUS_INFO, worker=display_name, kind="batch_fallback",
+                                       files=[item[0] for item in fallback]))
+    for item in fallback:
+        process_llm_item(item, result_queue, json_folder, llm_settings, model_name, display_name, retry_queue)
+
+def process_llm_group(batch, singles, result_queue, json_folder, llm_settings, model_name, display_name, retry_queue=None):
+    """Пакет (если собран) и документы, не попавшие в пакет"""
+    if batch:
+        process_llm_batch(batch, result_queue, json_folder, llm_settings, model_name, display_name, retry_queue)
+    for item in singles:
+        process_llm_item(item, result_queue, json_folder, llm_settings, model_name, display_name, retry_queue)
+
+def llm_async_worker(ocr_queue, result_queue, json_folder, llm_settings, model_names, retry_queue=None, concurrency=32):
+    """
+    Асинхронный LLM воркер: один процесс держит до concurrency запросов в работе
+    
+    Вместо процесса на каждый запрос документы раздаются задачам asyncio,
+    число одновременных запросов к одному эндпоинту ограничено семафором.
+    Сам HTTP запрос синхронный (пул соединений llm_client) и выполняется
+    в пуле потоков; повторы, проверка результата и сохранение JSON - как у llm_worker.
+    Модели model_names назначаются документам по кругу (round-robin).
+    """
+    asyncio.run(dispatch_llm_async(ocr_queue, result_queue, json_folder, llm_settings,
+                                   model_names, retry_queue, concurrency))
+
+def get_llm_endpoint(llm_settings):
+    """Базовый адрес API, к которому идут запросы (ключ лимита параллельности)"""
+    if llm_settings.get('provider', 'LM Studio') == 'OpenAI':
+        return "https://api.openai.com"
+    return llm_settings.get('endpoint', 'http://localhost:1234')
+
+async def dispatch_llm_async(ocr_queue, result_queue, json_folder, llm_settings, model_names, retry_queue, concurrency):
+    """Цикл диспетчера: берет документы из очереди, пока есть свободные слоты эндпоинта"""
+    concurrency = max(1, concurrency)
+    # Пул соединений не меньше числа запросов в работе
+    llm_settings = dict(llm_settings, pool_size=max(llm_settings.get('pool_size', DEFAULT_POOL_SIZE), concurrency))
+    endpoint = get_llm_endpoint(llm_settings)
+    endpoint_limits = {endpoint: asyncio.Semaphore(concurrency)}
+    
+    loop = asyncio.get_running_loop()
+    # +1 поток на чтение очереди документов
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency + 1))
+    result_queue.put(PipelineEvent(STAGE_LLM, STATUS_STARTED, worker=endpoint, kind="dispatcher", count=concurrency))
+    
+    async def run_group(batch, singles, model_name, display_name, limit):
+        try:
+            await loop.run_in_executor(None, process_llm_group, batch, singles, result_queue, json_folder,
+                                       llm_settings, model_name, display_name, retry_queue)
+        finally:
+            limit.release()
+    
+    tasks = set()
+    dispatched = 0
+    stop = False
+    while not stop:
+        limit = endpoint_limits[endpoint]
+        await limit.acquire()  # Новый документ берем только при свободном слоте
+        item = await loop.run_in_executor(None, ocr_queue.get)
+        if item is None:  # Сигнал завершения
+            limit.release()
+            break
+        if llm_settings.get('batch_docs', 0) > 1:
+            batch, singles, stop = await loop.run_in_executor(None, collect_llm_batch, item, ocr_queue, llm_settings)
+        else:
+            batch, singles = [], [item]
+        model_name = model_names[dispatched % len(model_names)]
+        display_name = f"LLM-async {model_name}"
+        dispatched += len(batch) + len(singles)
+        task = asyncio.create_task(run_group(batch, singles, model_name, display_name, limit))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    
+    # Дожидаемся запросов в работе
+    if tasks:
+        await asyncio.gather(*tasks)
+    result_queue.put(PipelineEvent(STAGE_LLM, STATUS_STOPPED, worker=endpoint, kind="dispatcher", count=dispatched))
+
+def ocr_worker_simple(pdf_queue, result_queue, llm_queue=None, ocr_settings=None):
+    """
+    Простой OCR воркер для неблокирующей обработки
+    
+    Если передана llm_queue (конвейерный режим) - успешный результат сразу
+    отправляется в очередь LLM, а в result_queue уходит только сводка для статистики.
+    llm_queue ограничена по размеру: когда LLM не успевает, OCR ждет (backpressure).
+    
+    ocr_settings:
+    - 'batch_pages', 'max_wait' - межфайловый батчинг: страницы нескольких PDF
+      из очереди распознаются одним вызовом Surya
+    - 'page_window' - окно потокового рендера длинных PDF (страниц)
+    - 'extraction_only', 'head_pages', 'tail_pages', 'backfill' - режим извлечения:
+      распознаются только первые/последние страницы, которые увидит LLM
+    """
+    models = get_surya_models()  # Загрузка и прогрев при старте воркера
+    ocr_settings = ocr_settings or {}
+    batch_pages = ocr_settings.get('batch_pages', 0)
+    
+    while True:
+        try:
+            if batch_pages > 1:
+                batch, stop = collect_page_batch(pdf_queue, ocr_settings)
+                for result in ocr_batch_worker(batch, models, ocr_settings):
+                    emit_ocr_result(result, result_queue, llm_queue)
+                if stop:
+                    break
+                continue
+            
+            item = pdf_queue.get(timeout=1)
+            if item is None:  # Стоп-сигнал
+                break
+                
+            pdf_file, pdf_folder, date_format = item
+            result = ocr_single_file_worker(pdf_file, pdf_folder, date_format, models, ocr_settings)
+            emit_ocr_result(result, result_queue, llm_queue)
+            
+        except queue.Empty:
+            continue
+        except Exception as e:
+            result_queue.put({
+                "success": False,
+                "filename": "unknown",
+                "error": str(e)
+            })
+
+def emit_ocr_result(result, result_queue, llm_queue=None):
+    """
+    Отправка результата OCR: в конвейере данные сразу идут в очередь LLM
+    (кроме документов быстрого пути - их JSON пишет GUI по полям правил)
+    """
+    if llm_queue is not None and result["success"] and not result.get("rule_bypass"):
+        # Блокируется, пока в очереди LLM нет места
+        llm_queue.put((result["filename"], result.pop("truncated_data"), result.pop("combined_text"), 0,
+                       result.pop("known_fields", None)))
+    result_queue.put(result)
+
+def get_extraction_pages(ocr_settings):
+    """(первых, последних) страниц для режима извлечения или None - полный OCR"""
+    if not ocr_settings or not ocr_settings.get('extraction_only'):
+        return None
+    return ocr_settings.get('head_pages', 1), ocr_settings.get('tail_pages', 1)
+
+def open_ocr_cache(ocr_settings):
+    """OCR кеш из настроек (None - кеш выключен или недоступен)"""
+    if not ocr_settings or not ocr_settings.get('cache_dir'):
+        return None
+    try:
+        return get_ocr_cache(ocr_settings['cache_dir'], ocr_settings.get('cache_max_mb', 2048))
+    except Exception as e:
+        print(f"⚠️ OCR кеш недоступен: {e}")
+        return None
+
+def lookup_ocr_cache(ocr_cache, pdf_path, extraction_pages):
+    """Поиск OCR в кеше до рендера PDF: (cache_key, ocr_json или None)"""
+    if ocr_cache is None:
+        return None, None
+    cache_key = ocr_cache.make_key(pdf_path, extraction_pages)
+    return cache_key, ocr_cache.get(cache_key)
+
+def collect_page_batch(pdf_queue, ocr_settings):
+    """
+    Планировщик батча: набирает PDF из очереди, пока суммарно не наберется
+    batch_pages страниц или не истечет max_wait секунд с первого файла.
+    Перед рендером проверяется OCR кеш - найденные файлы в батч не рендерятся.
+    Страницы рендерятся сразу при наборе (в режиме извлечения - только нужные).
+    Длинные PDF (больше окна page_window) в батч не рендерятся: images=None,
+    их обработает потоковый путь.
+    Возвращает (список записей батча, получен_стоп_сигнал)
+    """
+    batch_pages = ocr_settings.get('batch_pages', 0)
+    max_wait = ocr_settings.get('max_wait', 0.5)
+    page_window = ocr_settings.get('page_window', DEFAULT_PAGE_WINDOW)
+    extraction_pages = get_extraction_pages(ocr_settings)
+    ocr_cache = open_ocr_cache(ocr_settings)
+    
+    batch = []
+    total_pages = 0
+    deadline = None
+    
+    while total_pages < batch_pages:
+        if deadline is None:
+            timeout = 1
+        else:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+        try:
+            item = pdf_queue.get(timeout=timeout)
+        except queue.Empty:
+            if deadline is None:
+                continue  # Ждем первый файл батча
+            break
+        
+        if item is None:  # Стоп-сигнал: дообрабатываем набранное
+            return batch, True
+        
+        if deadline is None:
+            deadline = time.time() + max_wait
+        
+        pdf_file, pdf_folder, date_format = item
+        pdf_path = os.path.join(pdf_folder, pdf_file)
+        entry = {"item": item, "images": None, "page_indices": None, "page_count": None,
+                 "load_time": 0.0, "error": None, "cached": None, "cache_key": None}
+        load_start = time.time()
+        try:
+            entry["cache_key"], entry["cached"] = lookup_ocr_cache(ocr_cache, pdf_path, extraction_pages)
+            if entry["cached"] is not None:
+                batch.append(entry)
+                continue
+            
+            page_count = get_pdf_page_count(pdf_path)
+            if extraction_pages:
+                entry["page_indices"] = select_extraction_pages(page_count, *extraction_pages)
+                entry["page_count"] = page_count
+            render_count = len(entry["page_indices"]) if entry["page_indices"] is not None else page_count
+            if page_window and render_count > page_window:
+                batch.append(entry)  # Длинный документ - потоковый OCR
+                continue
+            entry["images"] = load_pdf_images(pdf_path, entry["page_indices"])
+            total_pages += len(entry["images"])
+        except Exception as e:
+            entry["error"] = str(e)
+        entry["load_time"] = time.time() - load_start
+        batch.append(entry)
+    
+    return batch, False
+
+def ocr_batch_worker(batch, models, ocr_settings):
+    """OCR батча из collect_page_batch: один вызов Surya на страницы всех файлов"""
+    results = []
+    documents = []
+    loaded = []
+    ocr_cache = open_ocr_cache(ocr_settings)
+    
+    for entry in batch:
+        pdf_file, pdf_folder, date_format = entry["item"]
+        if entry["error"] is not None:
+            results.append({
+                "success": False,
+                "filename": pdf_file,
+                "error": entry["error"],
+                "processing_time": entry["load_time"]
+            })
+        elif entry["cached"] is not None:
+            timings = {"model_load_time": 0.0, "inference_time": 0.0}
+            ocr_json = entry["cached"]
+            result = build_ocr_result(pdf_file, pdf_folder, date_format, ocr_json, ocr_json["full_text"], timings, ocr_settings)
+            result["processing_time"] = entry["load_time"]
+            result["cache_hit"] = True
+            results.append(result)
+        elif entry["images"] is None:
+            results.append(ocr_single_file_worker(pdf_file, pdf_folder, date_format, models, ocr_settings))
+        else:
+            documents.append((os.path.join(pdf_folder, pdf_file), entry["images"],
+                              entry["page_indices"], entry["page_count"]))
+            loaded.append(entry)
+    
+    if not documents:
+        return results
+    
+    model_load_time = models.take_load_time()
+    total_pages = sum(len(entry["images"]) for entry in loaded)
+    try:
+        ocr_results, inference_time = ocr_documents_batch(documents, models)
+    except Exception as e:
+        # Батч не прошел - распознаем файлы по одному, чтобы ошибка одного не валила остальные
+        print(f"⚠️ Ошибка батча OCR ({len(documents)} файлов): {e}, обрабатываем по одному")
+        for entry in loaded:
+            pdf_file, pdf_folder, date_format = entry["item"]
+            results.append(ocr_single_file_worker(pdf_file, pdf_folder, date_format, models, ocr_settings))
+        return results
+    
+    pages_per_sec = total_pages / inference_time if inference_time > 0 else 0
+    print(f"📦 Батч OCR: {len(documents)} файлов, {total_pages} страниц за {inference_time:.1f}с ({pages_per_sec:.1f} стр/с)")
+    
+    for entry, (ocr_json, combined_text) in zip(loaded, ocr_results):
+        pdf_file, pdf_folder, date_format = entry["item"]
+        if ocr_cache is not None:
+            ocr_cache.put(entry["cache_key"], ocr_json)
+        # Время распознавания батча делим между файлами пропорционально страницам
+        share = inference_time * len(entry["images"]) / total_pages if total_pages else 0
+        timings = {"model_load_time": model_load_time, "inference_time": entry["load_time"] + share}
+        model_load_time = 0.0  # Загрузка моделей учитывается только один раз
+        try:
+            result = build_ocr_result(pdf_file, pdf_folder, date_format, ocr_json, combined_text, timings, ocr_settings)
+        except Exception as e:
+            result = {"success": False, "filename": pdf_file, "error": str(e)}
+        result["processing_time"] = timings["model_load_time"] + timings["inference_time"]
+        result["cache_hit"] = False
+        result["batch_files"] = len(documents)
+        result["batch_pages"] = total_pages
+        result["pages_per_sec"] = pages_per_sec
+        results.append(result)
+    
+    return results
+
+def store_ocr_result(pdf_file, pdf_folder, date_format, ocr_json, combined_text, ocr_settings=None):
+    """Результат OCR в базу результатов (через процесс-писатель, если он запущен)"""
+    write_ocr_result(make_row(pdf_file, pdf_folder, date_format, ocr_json, combined_text), ocr_settings)
+
+def build_ocr_result(pdf_file, pdf_folder, date_format, ocr_json, combined_text, timings, ocr_settings=None):
+    """Сохранение результата OCR и подготовка усеченных данных для LLM"""
+    pages_data = ocr_json["pages_data"]
+    extraction_only = ocr_json.get("extraction_only", False)
+    
+    # Частичный OCR в архив не пишем, если полный OCR будет дозаписан фоновым проходом
+    if not (extraction_only and (ocr_settings or {}).get('backfill')):
+        store_ocr_result(pdf_file, pdf_folder, date_format, ocr_json, combined_text, ocr_settings)
+    
+    return prepare_llm_input(pdf_file, ocr_json, combined_text, timings, ocr_settings)
+
+def prepare_llm_input(pdf_file, ocr_json, combined_text, timings, ocr_settings=None):
+    """
+    Данные OCR для LLM: усеченные строки и поля по правилам
+    (и для свежего OCR, и для OCR из базы результатов при продолжении запуска)
+    """
+    pages_data = ocr_json["pages_data"]
+    extraction_only = ocr_json.get("extraction_only", False)
+    
+    # Подготовка данных для LLM с умным усечением
+    all_lines = []
+    prev_page = 0
+    for page_data in pages_data:
+        skipped = page_data["page"] - prev_page - 1
+        if all_lines and skipped > 0:
+            # Страницы не распознавались (режим извлечения) - помечаем разрыв
+            all_lines.append({'text': f'[... ПРОПУЩЕНО {skipped} СТРАНИЦ ...]', 'chunk_type': 'separator'})
+        # Номер страницы нужен компактным форматам промпта (в JSON формат не выводится)
+        all_lines.extend(dict(line, page=page_data["page"]) for line in page_data["text_lines"])
+        prev_page = page_data["page"]
+    
+    # Применяем умное усечение с точным подсчетом токенов в формате промпта
+    max_tokens = 12000  # Оставляем место для промпта (4000 токенов)
+    encoding = (ocr_settings or {}).get('prompt_encoding', 'json')
+    truncated_lines, token_count, was_truncated = smart_truncate_for_llm(all_lines, max_tokens, encoding)
+    
+    if was_truncated:
+        print(f"✂️ Документ {pdf_file} усечен: {token_count} токенов")
+    else:
+        print(f"✅ Документ {pdf_file} помещается: {token_count} токенов")
+    
+    # Классификация и поля по правилам: при уверенности не ниже порога LLM не нужен
+    rule_start = time.time()
+    known_fields, rule_confidence = rule_based_result(pages_data, pdf_file)
+    rule_threshold = (ocr_settings or {}).get('rule_threshold', 0)
+    
+    return {
+        "success": True,
+        "filename": pdf_file,
+        "truncated_data": truncated_lines,
+        "combined_text": combined_text.strip(),
+        "known_fields": known_fields,
+        "rule_confidence": rule_confidence,
+        "rule_bypass": bool(rule_threshold) and rule_confidence >= rule_threshold,
+        "rule_time": time.time() - rule_start,
+        "pages": len(pages_data),
+        "extraction_only": extraction_only,
+        "model_load_time": timings["model_load_time"],
+        "inference_time": timings["inference_time"]
+    }
+
+def ocr_single_file_worker(pdf_file, pdf_folder, date_format, models=None, ocr_settings=None):
+    """Обработка одного PDF файла через Surya OCR (вне класса), страницы рендерятся окнами"""
+    start_time = time.time()
+    timings = {"model_load_time": 0.0, "inference_time": 0.0}
+    ocr_settings = ocr_settings or {}
+    try:
+        # Модели процесса: загружаются только при первом вызове
+        if models is None:
+            models = get_surya_models()
+        
+        pdf_path = os.path.join(pdf_folder, pdf_file)
+        extraction_pages = get_extraction_pages(ocr_settings)
+        
+        # Сначала кеш: неизмененный PDF повторно не распознаем
+        ocr_cache = open_ocr_cache(ocr_settings)
+        cache_key, ocr_json = lookup_ocr_cache(ocr_cache, pdf_path, extraction_pages)
+        cache_hit = ocr_json is not None
+        
+        if cache_hit:
+            combined_text = ocr_json["full_text"]
+        else:
+            # OCR обработка (потоковый рендер окнами по page_window страниц)
+            ocr_json, combined_text, timings = ocr_pdf(
+                pdf_path, models,
+                page_window=ocr_settings.get('page_window', DEFAULT_PAGE_WINDOW),
+                extraction_pages=extraction_pages
+            )
+            if ocr_cache is not None:
+                ocr_cache.put(cache_key, ocr_json)
+        
+        result = build_ocr_result(pdf_file, pdf_folder, date_format, ocr_json, combined_text, timings, ocr_settings)
+        result["processing_time"] = time.time() - start_time
+        result["cache_hit"] = cache_hit
+        return result
+        
+    except Exception as e:
+        processing_time = time.time() - start_time
+        return {
+            "success": False,
+            "filename": pdf_file,
+            "error": str(e),
+            "processing_time": processing_time,
+            "model_load_time": timings["model_load_time"],
+            "inference_time": timings["inference_time"]
+        }
+
+def lower_process_priority():
+    """Понижает приоритет текущего процесса (фоновые задачи не мешают основной обработке)"""
+    try:
+        if os.name == 'nt':
+            import ctypes
+            BELOW_NORMAL_PRIORITY_CLASS = 0x00004000
+            kernel32 = ctypes.windll.kernel32
+            kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), BELOW_NORMAL_PRIORITY_CLASS)
+        else:
+            os.nice(10)
+    except Exception as e:
+        print(f"⚠️ Не удалось понизить приоритет процесса: {e}")
+
+def ocr_backfill_worker(backfill_queue, ocr_settings=None, done_queue=None):
+    """
+    Фоновый полный OCR для архива после режима извлечения
+    Работает с пониженным приоритетом и заменяет частичные результаты в базе полными;
+    в done_queue - (файл, ошибка или None) для журнала запуска
+    """
+    lower_process_priority()
+    ocr_settings = ocr_settings or {}
+    page_window = ocr_settings.get('page_window', DEFAULT_PAGE_WINDOW)
+    ocr_cache = open_ocr_cache(ocr_settings)
+    models = None
+    
+    while True:
+        try:
+            item = backfill_queue.get(timeout=1)
+        except queue.Empty:
+            continue
+        if item is None:  # Стоп-сигнал
+            break
+        
+        pdf_file, pdf_folder, date_format = item
+        pdf_path = os.path.join(pdf_folder, pdf_file)
+        try:
+            cache_key, ocr_json = lookup_ocr_cache(ocr_cache, pdf_path, None)
+            if ocr_json is not None:
+                store_ocr_result(pdf_file, pdf_folder, date_format, ocr_json, ocr_json["full_text"], ocr_settings)
+            else:
+                if models is None:
+                    models = get_surya_models()  # Модели грузим только когда есть работа
+                ocr_json, combined_text, timings = ocr_pdf(pdf_path, models, page_window)
+                if ocr_cache is not None:
+                    ocr_cache.put(cache_key, ocr_json)
+                store_ocr_result(pdf_file, pdf_folder, date_format, ocr_json, combined_text, ocr_settings)
+                print(f"🗄️ Полный OCR для архива: {pdf_file} ({ocr_json['pages']} стр., {timings['inference_time']:.1f}с)")
+            if done_queue is not None:
+                done_queue.put((pdf_file, None))
+        except Exception as e:
+            print(f"⚠️ Ошибка фонового OCR {pdf_file}: {e}")
+            if done_queue is not None:
+                done_queue.put((pdf_file, str(e)))
+
+def process_single_file_worker(args):
+    """
+    Функция-воркер для multiprocessing (вне класса для избежания pickle ошибок)
+    args = (pdf_file, pdf_folder, json_folder, date_format, llm_settings[, ocr_settings])
+    """
+    pdf_file, pdf_folder, json_folder, date_format, llm_settings = args[:5]
+    ocr_settings = args[5] if len(args) > 5 else None
+    
+    try:
+        # Модели Surya переиспользуются между вызовами в одном процессе пула
+        models = get_surya_models()
+        
+        pdf_path = os.path.join(pdf_folder, pdf_file)
+        
+        # OCR обработка
+        ocr_json, combined_text, timings = ocr_pdf(pdf_path, models)
+        pages_data = ocr_json["pages_data"]
+        
+        # Сохранение результата OCR
+        store_ocr_result(pdf_file, pdf_folder, date_format, ocr_json, combined_text)
+        
+        # Подготовка данных для LLM с умным усечением
+        all_lines = []
+        for page_data in pages_data:
+            all_lines.extend(page_data["text_lines"])
+        
+        # Проверяем размер и применяем умное усечение
+        max_tokens = 12000  # Оставляем 4000 токенов для промпта
+        truncated_lines, token_count, was_truncated = smart_truncate_for_llm(all_lines, max_tokens)
+        
+        if was_truncated:
+            print(f"✂️ Документ {pdf_file} усечен: {token_count} токенов")
+        else:
+            print(f"✅ Документ {pdf_file} помещается: {token_count} токенов")
+        
+        # Анализ с LLM (не нужен, если правила уверенно заполнили все поля)
+        known_fields, rule_confidence = rule_based_result(pages_data, pdf_file)
+        rule_threshold = (ocr_settings or {}).get('rule_threshold', 0)
+        if rule_threshold and rule_confidence >= rule_threshold:
+            llm_result = rule_result_json(known_fields)
+        else:
+            model_name = llm_settings.get('models', ['local-1'])[0]  # Берем первую модель
+            llm_result = analyze_with_llm_worker(pdf_file, truncated_lines, llm_settings, model_name)
+        
+        if "error" not in llm_result:
+            # Валидация
+            llm_result = validate_llm_result(llm_result, combined_text.strip(), known_fields=known_fields)
+            
+            # Сохранение JSON
+            json_filename = os.path.splitext(pdf_file)[0] + ".json"
+            json_path = os.path.join(json_folder, json_filename)
+            
+            with open(json_path, 'w', encoding='utf-8') as f:
+                json.dump(llm_result, f, ensure_ascii=False, indent=2)
+            
+            return f"Завершено: {pdf_file}"
+        else:
+            return f"Ошибка LLM для {pdf_file}: {llm_result['error']}"
+            
+    except Exception as e:
+        return f"Ошибка обработки {pdf_file}: {str(e)}"
+
+
+# Системное сообщение: все инструкции и схема ответа. Одинаково байт в байт для всех
+# документов, поэтому сервер LLM может переиспользовать его префикс (prompt caching
+# в LM Studio/llama.cpp, автоматическое кеширование префикса OpenAI)
+LLM_SYSTEM_PROMPT = """Ты эксперт по извлечению данных из российских деловых документов. Анализируй текст и извлеки структурированную информацию строго по правилам.
+
+ВАЖНО: В JSON ответе должно быть ТОЛЬКО ОДНО поле с типом документа - "Тип_документа" - без вариаций, дублирования или альтернатив!
+
+ОПРЕДЕЛЕНИЕ РОЛЕЙ (САМОЕ ВАЖНОЕ) В каждом документе всегда 2 стороны и в ответе должны быть 2 стороны:
+1. ИСПОЛНИТЕЛЬ (кто оказывает услуги/продает товары):
+   - В договоре: "Исполнитель", "Продавец", "Поставщик", изучай стороны договора чтобы решить.
+   - В акте: "Исполнитель", тот кто выполнил работы/оказал услуги
+   - В счете: "Поставщик", "ИП" или организация в верхней части счета
+
+2. ЗАКАЗЧИК (кто платит/получает услуги/товары):
+   - В договоре: "Заказчик", "Покупатель", "Получатель", сторона документа, изучи чтобы решить кто есть кто.
+   - В акте: "Заказчик", тот кому оказаны услуги
+   - В счете: "Покупатель", "Плательщик", получатель счета
+
+ОПРЕДЕЛЕНИЕ ТИПА ДОКУМЕНТА (ТОЛЬКО ОДИН ТИП - БЕЗ ДУБЛИРОВАНИЯ!):
+- "договор" - если в заголовке есть слова "договор", "соглашение", "купли-продажи"
+- "акт" - если в заголовке есть слова "акт", "выполненных работ", "оказанных услуг"
+- "счет" - если в заголовке есть "счет", "счет на оплату"
+- "счет-фактура" - если в заголовке есть "счет-фактура"
+
+ТИПЫ ОРГАНИЗАЦИЙ (определи точно):
+- "юрлицо" - ООО, АО, ПАО, ГУП, МУП, ФГУП (ИНН 10 цифр, КПП 9 цифр)
+- "ип" - ИП, Индивидуальный предприниматель (ИНН 12 цифр, без КПП)
+- "физлицо" - Ф.И.О. без указания ООО/ИП (возможно ИНН 12 цифр)
+
+ПРАВИЛА ИЗВЛЕЧЕНИЯ ДАННЫХ:
+- Название организации: только официальное название (ООО "Название", ИП Иванов А.А., либо физ лицо - Иванов А.А.)
+- ИНН: только числа длиной 10 цифр (юрлица) или 12 цифр (ИП/физлица)
+- КПП: только 9 цифр (только для юрлиц!)
+- Адрес: полный юридический адрес без названия организации
+
+ПРИМЕРЫ ОПРЕДЕЛЕНИЯ РОЛЕЙ:
+- В договоре купли-продажи автомобиля: Продавец = ИСПОЛНИТЕЛЬ, Покупатель = ЗАКАЗЧИК
+- В акте выполненных работ: кто выполнил работы = ИСПОЛНИТЕЛЬ, кто принял = ЗАКАЗЧИК
+- В счете: кто выставил счет = ИСПОЛНИТЕЛЬ, кому выставлен счет = ЗАКАЗЧИК
+
+ФОРМАТ ДАННЫХ: строки документа приходят в одном из видов - JSON список строк (text, bbox = [x1, y1, x2, y2], confidence), таблица "стр|x|y|текст" или текст с маркерами страниц. Малые x - левая часть страницы, малые y - верх. Строка "[... ПРОПУЩЕНО ...]" означает пропущенную середину документа.
+
+ВЕРНИ СТРОГО ФОРМАТИРОВАННЫЙ JSON В ТОЧНОМ СООТВЕТСТВИИ С ШАБЛОНОМ НИЖЕ. ТОЧНО СОБЛЮДАЙ ИМЕНА ПОЛЕЙ (с подчеркиванием, не с пробелами):
+{
+  "Название_файла": "<имя файла из сообщения>",
+  "Тип_документа": "договор",  // ТОЛЬКО ОДНО ПОЛЕ С ТИПОМ! Используй "договор", "акт", "счет" или "счет-фактура" в нижнем регистре
+  "Номер_документа": "",
+  "Дата_документа": "",
+  "Наименование_заказчика": "",
+  "Наименование_исполнителя": "",
+  "ИНН_заказчика": "",  // 10 или 12 цифр, не путай с КПП!
+  "КПП_заказчика": "",  // 9 цифр, только для юрлиц
+  "Адрес_заказчика": "",
+  "ИНН_исполнителя": "",  // 10 или 12 цифр, не путай с КПП!
+  "КПП_исполнителя": "",  // 9 цифр, только для юрлиц
+  "Адрес_исполнителя": "",
+  "Тип_заказчика": "юрлицо",  // строго одно из: юрлицо, ип, физлицо
+  "Тип_исполнителя": "юрлицо"  // строго одно из: юрлицо, ип, физлицо
+}"""
+
+
+def generate_llm_prompt(filename, truncated_data, structured_data):
+    """
+    Сообщение пользователя для документа: только имя файла и данные OCR
+    (инструкции и шаблон ответа - в неизменном LLM_SYSTEM_PROMPT)
+    """
+    return f"""Название_файла: {filename}
+
+ДОКУМЕНТ:
+{structured_data}"""
+
+
+def build_llm_messages(prompt):
+    """Сообщения запроса: общий системный префикс + сообщение документа"""
+    return [
+        {"role": "system", "content": LLM_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def analyze_document(filename, truncated_data, llm_settings, model_name, timings=None):
+    """Обработка документа с LLM (timings - сетевые замеры запроса, см. llm_client)"""
+    try:
+        # Проверка наличия данных
+        if not truncated_data or len(truncated_data) == 0:
+            return {"error": "Пустые данные OCR"}
+        
+        encoding = llm_settings.get('prompt_encoding', 'json')
+        structured_data = encode_lines(truncated_data, encoding)
+        
+        # Логируем размер данных для отладки
+        data_size = len(structured_data)
+        print(f"📊 Отправляем в LLM: {filename}, размер {data_size} байт ({encoding})")
+        
+        # Экономия токенов относительно прежнего JSON с отступами
+        if timings is not None:
+            timings["data_tokens"] = estimate_tokens(structured_data)
+            timings["json_tokens"] = (timings["data_tokens"] if encoding == "json"
+                                      else estimate_tokens(encode_lines(truncated_data, "json")))
+        
+        # Генерируем промпт
+        prompt = generate_llm_prompt(filename, truncated_data, structured_data)
+        
+        # Ключ кеша - по данным документа без имени файла: дубликаты сканов под другими
+        # именами не отправляются повторно (пакеты кешируются с именами - по ним разбор ответа)
+        result = send_to_llm(prompt, llm_settings, model_name, timings, cache_prompt=structured_data)
+        if "error" not in result:
+            result.pop("Название файла", None)
+            result["Название_файла"] = filename  # Ответ из кеша мог быть получен для копии
+        return result
+        
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def analyze_with_llm_worker(filename, truncated_data, llm_settings, model_name, timings=None):
+    """Основная функция анализа документа с LLM"""
+    return analyze_document(filename, truncated_data, llm_settings, model_name, timings)
+
+
+# Температура генерации (входит в ключ кеша ответов)
+LLM_TEMPERATURE = 0.1
+# Ожидаемая длина ответа для оценки TPM до запроса (уточняется по usage)
+LLM_EXPECTED_COMPLETION_TOKENS = 800
+
+
+def open_llm_cache(llm_settings):
+    """Кеш ответов LLM из настроек (None - кеш выключен или недоступен)"""
+    if not llm_settings.get('cache_dir'):
+        return None
+    try:
+        return get_llm_cache(llm_settings['cache_dir'],
+                             llm_settings.get('cache_max_mb', 512),
+                             llm_settings.get('cache_ttl_hours', 720))
+    except Exception as e:
+        print(f"⚠️ Кеш LLM недоступен: {e}")
+        return None
+
+
+def build_llm_payload(prompt, llm_settings, model_name, expect_array=False):
+    """
+    Тело запроса chat/completions без параметров потока
+    (по нему же строится ключ кеша ответов)
+    """
+    data = {
+        "model": model_name,
+        "messages": build_llm_messages(prompt),
+        "temperature": LLM_TEMPERATURE,
+        "max_tokens": llm_settings.get('max_tokens', 16000)
+    }
+    
+    # Строгий вывод: схема 14 полей в response_format, max_tokens по размеру схемы
+    if llm_settings.get('structured_output', False):
+        documents = llm_settings.get('batch_docs', 1) if expect_array else 1
+        data["response_format"] = build_response_format(batch=expect_array)
+        data["max_tokens"] = structured_max_tokens(data["max_tokens"], documents)
+    return data
+
+
+def send_to_llm(prompt, llm_settings, model_name, timings=None, expect_array=False, cache_prompt=None):
+    """
+    Отправка промпта в LLM через кеш ответов
+    Идентичный запрос для той же модели/настроек не отправляется повторно;
+    llm_settings['cache_bypass'] - принудительный повторный анализ (ответ перезаписывается в кеше)
+    expect_array - ответ JSON массив (пакет документов), возвращается как {"batch": [...]}
+    cache_prompt - часть промпта для ключа кеша вместо prompt (данные документа без имени
+    файла: копия скана под другим именем берется из кеша)
+    """
+    llm_cache = open_llm_cache(llm_settings)
+    cache_key = None
+    if llm_cache is not None:
+        cache_key = llm_cache.make_key(
+            llm_settings.get('provider', 'LM Studio'),
+            build_llm_payload(prompt if cache_prompt is None else cache_prompt,
+                              llm_settings, model_name, expect_array), expect_array
+        )
+        if not llm_settings.get('cache_bypass'):
+            cached = llm_cache.get(cache_key)
+            if cached is not None:
+                return cached
+    
+    result = request_llm(prompt, llm_settings, model_name, timings, expect_array)
+    
+    # Кешируем только успешно распарсенные ответы
+    if llm_cache is not None and "error" not in result:
+        llm_cache.put(cache_key, result)
+    return result
+
+
+_SYSTEM_PROMPT_TOKENS = None
+
+
+def get_system_prompt_tokens():
+    """Токены системного сообщения (считаются один раз на процесс)"""
+    global _SYSTEM_PROMPT_TOKENS
+    if _SYSTEM_PROMPT_TOKENS is None:
+        _SYSTEM_PROMPT_TOKENS = estimate_tokens(LLM_SYSTEM_PROMPT)
+    return _SYSTEM_PROMPT_TOKENS
+
+
+def post_with_rate_limit(endpoint, data, headers, llm_settings, prompt, timings=None):
+    """
+    Запрос к LLM с учетом лимитов частоты
+    
+    Для OpenAI перед отправкой ждем место в ведрах RPM/TPM (оценка токенов промпта
+    через estimate_tokens + ожидаемый ответ). Ответы 429 и 5xx повторяются здесь же
+    с паузой из Retry-After или экспоненциальной паузой с джиттером, а не уходят
+    сразу в очередь повтора.
+    """
+    limiter = get_llm_rate_limiter(endpoint, data['model'], llm_settings)
+    estimated_tokens = (get_system_prompt_tokens() + estimate_tokens(prompt)
+                        + min(data['max_tokens'], LLM_EXPECTED_COMPLETION_TOKENS))
+    rate_retries = llm_settings.get('rate_retries', 5)
+    rate_wait = 0.0
+    
+    for attempt in range(rate_retries + 1):
+        if limiter is not None:
+            rate_wait += limiter.acquire(estimated_tokens)
+        response = post_json(endpoint, data, headers, llm_settings, timings, stream=data.get('stream', False))
+        if limiter is not None:
+            limiter.on_response(response.status_code, response.headers)
+        
+        if response.status_code not in RETRY_STATUS_CODES or attempt == rate_retries:
+            break
+        # 429/5xx: пауза перед повтором (сервер подсказывает, сколько ждать)
+        delay = get_retry_after(response.headers)
+        if delay is None:
+            delay = backoff_delay(attempt)
+        response.close()  # Потоковый ответ не дочитан - освобождаем соединение пула
+        time.sleep(delay)
+        rate_wait += delay
+    
+    # В потоковом режиме тело читает вызывающий - поправку по usage делает record_stream_usage
+    if limiter is not None and response.status_code == 200 and not data.get('stream'):
+        try:
+            usage = response.json().get('usage') or {}
+            limiter.record_usage(estimated_tokens, usage.get('total_tokens'))
+        except ValueError:
+            pass
+    if timings is not None:
+        timings["rate_wait"] = rate_wait
+        timings["rate_retries"] = attempt
+        timings["estimated_tokens"] = estimated_tokens
+    return response
+
+
+def get_llm_rate_limiter(endpoint, model_name, llm_settings):
+    """Ограничитель частоты процесса для OpenAI (None - LM Studio или лимиты не заданы)"""
+    if llm_settings.get('provider', 'LM Studio') != 'OpenAI':
+        return None
+    share = llm_settings.get('rate_share', 1.0)  # Доля лимита на процесс воркера
+    return get_rate_limiter(endpoint, model_name, llm_settings.get('rpm_limit', 0),
+                            llm_settings.get('tpm_limit', 0), share)
+
+
+def record_stream_usage(endpoint, model_name, llm_settings, usage, timings):
+    """
+    Поправка лимита TPM по usage потокового ответа (чанк usage дочитывается после JSON)
+    Без usage в ведре остается оценка токенов - отмечается в timings["usage_missing"]
+    """
+    limiter = get_llm_rate_limiter(endpoint, model_name, llm_settings)
+    if limiter is None:
+        return
+    if not usage:
+        timings["usage_missing"] = True
+        return
+    limiter.record_usage(timings.get("estimated_tokens", 0), usage.get('total_tokens'))
+
+
+def record_prompt_cache_usage(result, timings):
+    """
+    Сколько токенов промпта сервер взял из кеша префикса:
+    OpenAI - usage.prompt_tokens_details.cached_tokens, llama.cpp - timings.cache_n
+    """
+    usage = result.get('usage') or {}
+    timings["prompt_tokens"] = usage.get('prompt_tokens')
+    cached = (usage.get('prompt_tokens_details') or {}).get('cached_tokens')
+    if cached is None:
+        cached = (result.get('timings') or {}).get('cache_n')
+    timings["cached_tokens"] = cached
+
+
+def wrap_llm_json(parsed, expect_array):
+    """Разобранный ответ в виде словаря результата (массив пакета - под ключом batch)"""
+    if not expect_array:
+        return parsed
+    if isinstance(parsed, dict) and isinstance(parsed.get("documents"), list):
+        parsed = parsed["documents"]  # Пакет по JSON схеме
+    if not isinstance(parsed, list):
+        return {"error": "Ответ на пакет документов - не JSON массив"}
+    return {"batch": parsed}
+
+
+def request_llm(prompt, llm_settings, model_name, timings=None, expect_array=False):
+    """Отправка промпта в LLM (через пул соединений процесса) и надежная обработка JSON-ответов"""
+    timings = {} if timings is None else timings
+    try:
+        # Поддержка OpenAI и LM Studio
+        provider = llm_settings.get('provider', 'LM Studio')
+        
+        if provider == 'OpenAI':
+            # Настройки для OpenAI
+            api_key = llm_settings.get('api_key', '')
+            if not api_key:
+                return {"error": "Не указан OpenAI API ключ"}
+                
+            headers = {
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {api_key}"
+            }
+            endpoint = "https://api.openai.com/v1/chat/completions"
+        else:
+            # Настройки для LM Studio
+            headers = {"Content-Type": "application/json"}
+            endpoint = f"{llm_settings.get('endpoint', 'http://localhost:1234')}/v1/chat/completions"
+        
+        data = build_llm_payload(prompt, llm_settings, model_name, expect_array)
+        structured = "response_format" in data
+        
+        # Потоковый ответ: чтение обрывается, как только JSON закрыт
+        stream = llm_settings.get('stream', False)
+        if stream:
+            data["stream"] = True
+            if provider == 'OpenAI':
+                data["stream_options"] = {"include_usage": True}
+        
+        try:
+            response = post_with_rate_limit(endpoint, data, headers, llm_settings, prompt, timings)
+        except requests.exceptions.Timeout:
+            return {"error": f"Таймаут соединения с {provider} (более 180с)"}
+        except requests.exceptions.ConnectionError:
+            return {"error": f"Не удалось подключиться к {provider} - проверьте LM Studio"}
+        except Exception as e:
+            return {"error": f"Ошибка связи с {provider}: {e}"}
+        
+        if response.status_code == 200:
+            try:
+                if stream:
+                    open_char = '[' if expect_array and not structured else '{'
+                    # OpenAI присылает usage последним чанком - дочитываем поток после JSON
+                    content, last_chunk = read_stream_content(response, timings, open_char,
+                                                              drain_usage=provider == 'OpenAI')
+                    result = {
+                        "choices": [{"message": {"content": content}}],
+                        "usage": last_chunk.get('usage'),
+                        "timings": last_chunk.get('timings')
+                    }
+                    record_stream_usage(endpoint, model_name, llm_settings, result["usage"], timings)
+                else:
+                    result = response.json()
+                record_prompt_cache_usage(result, timings)
+                content = result.get('choices', [{}])[0].get('message', {}).get('content', '')
+                
+                if not content:
+                    return {"error": "Пустой ответ от модели"}
+                
+                # Терпимый разбор за один проход: текст вокруг JSON, комментарии, кавычки,
+                # висячие запятые, оборванный конец (по схеме - сразу быстрый путь json)
+                open_char = '[' if expect_array and not structured else '{'
+                try:
+                    return wrap_llm_json(parse_json_lenient(content, open_char), expect_array)
+                except ValueError as e:
+                    return {"error": f"{e}: {content[:200]}..."}
+                
+            except json.JSONDecodeError as e:
+                return {"error": f"Ошибка парсинга JSON: {e}"}
+            except Exception as e:
+                return {"error": f"Неизвестная ошибка при обработке ответа: {e}"}
+                
+        elif response.status_code == 400:
+            # Ошибка превышения контекста (LM Studio)
+            try:
+                error_detail = response.json().get('error', '')
+                if 'context' in error_detail.lower() or 'token' in error_detail.lower():
+                    return {"error": "prediction-error: Превышен контекст модели"}
+                else:
+                    return {"error": f"prediction-error: {error_detail}"}
+            except:
+                return {"error": "prediction-error: Превышен контекст модели"}
+        elif response.status_code == 422:
+            # Ошибка превышения контекста (OpenAI)
+            try:
+                error_detail = response.json().get('detail', '')
+                if 'context' in error_detail.lower() or 'token' in error_detail.lower():
+                    return {"error": "prediction-error: Превышен контекст модели"}
+                else:
+                    return {"error": f"prediction-error: {error_detail}"}
+            except:
+                return {"error": "prediction-error: Превышен контекст модели"}
+        else:
+            try:
+                error_detail = response.json()
+                return {"error": f"HTTP {response.status_code}: {error_detail}"}
+            except:
+                return {"error": f"HTTP {response.status_code}: {response.text[:200]}"}
+        
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def validate_llm_result(llm_result, original_text, text_index=None, known_fields=None):
+    """
+    Валидация результатов LLM и исправление форматирования ключей и значений
+    text_index - готовый TextIndex текста документа (общий с другими проверками)
+    known_fields - поля, извлеченные по pages_data правилами (rule_based_result)
+    """
+    if "error" in llm_result:
+        return llm_result
+        
+    try:
+        index = text_index or TextIndex(original_text)
+        normalized_result = {}
+        
+        # Нормализация ключей: преобразование всех ключей в формат с подчеркиванием
+        key_mapping = {
+            # Ключи с пробелами -> ключи с подчеркиванием
+            "Тип документа": "Тип_документа",
+            "Номер документа": "Номер_документа",
+            "Дата документа": "Дата_документа",
+            "Название файла": "Название_файла",
+            "Наименование заказчика": "Наименование_заказчика",
+            "Наименование исполнителя": "Наименование_исполнителя",
+            "ИНН заказчика": "ИНН_заказчика",
+            "КПП заказчика": "КПП_заказчика",
+            "Адрес заказчика": "Адрес_заказчика",
+            "ИНН исполнителя": "ИНН_исполнителя",
+            "КПП исполнителя": "КПП_исполнителя",
+            "Адрес исполнителя": "Адрес_исполнителя",
+            "Тип заказчика": "Тип_заказчика",
+            "Тип исполнителя": "Тип_исполнителя"
+        }
+        
+        # Перенос всех значений с нормализацией ключей
+        for key, value in llm_result.items():
+            normalized_key = key_mapping.get(key, key)
+            normalized_result[normalized_key] = value
+        
+        # Если был дублирующий тип документа, исправляем
+        doc_type_keys = ["Тип_документа", "Тип документа"]
+        found_doc_type = None
+        for key in doc_type_keys:
+            if key in normalized_result:
+                found_doc_type = normalized_result[key].lower()
+                # Удаляем ключ с пробелом, оставляем только с подчеркиванием
+                if key == "Тип документа" and "Тип_документа" not in normalized_result:
+                    normalized_result["Тип_документа"] = found_doc_type
+                    del normalized_result[key]
+        
+        # Валидация ИНН (контрольные разряды) и КПП по индексу текста
+        fix_requisites(normalized_result, index,
+                       ["ИНН_заказчика", "ИНН_исполнителя"], ["КПП_заказчика", "КПП_исполнителя"], known_fields)
+        
+        # Очистка номера документа
+        doc_number = normalized_result.get("Номер_документа", "")
+        if doc_number:
+            normalized_result["Номер_документа"] = clean_document_number(doc_number)
+        
+        # Проверка и нормализация типа документа в нижнем регистре
+        doc_type = str(normalized_result.get("Тип_документа") or "").lower()
+        valid_types = ["договор", "акт", "счет", "счет-фактура"]
+        
+        if doc_type not in valid_types:
+            normalized_result["Тип_документа"] = index.guess_document_type() or "неопределен"
+        else:
+            # Убеждаемся, что тип документа в нижнем регистре
+            normalized_result["Тип_документа"] = doc_type.lower()
+            
+        return normalized_result
+        
+    except Exception as e:
+        print(f"Ошибка валидации: {e}")
+        return llm_result
+
+
+def list_pdf_files(pdf_folder):
+    """PDF файлы папки (по имени)"""
+    return sorted(f for f in os.listdir(pdf_folder) if f.lower().endswith('.pdf'))
+
+
+def get_cache_dir(pdf_folder):
+    """Папка кешей OCR и LLM (рядом с папкой PDF, как база результатов OCR)"""
+    return os.path.join(os.path.dirname(pdf_folder), "cache")
+
+
+def assign_llm_models(provider, pool_size, model_name=None):
+    """
+    Модели по LLM воркерам: для OpenAI - одна модель на все воркеры,
+    для LM Studio - local-1/local-2 при двух воркерах, иначе local-model
+    """
+    if provider == 'OpenAI':
+        return [model_name] * pool_size  # Дублируем по количеству потоков
+    if pool_size == 1:
+        return ["local-model"]  # Один воркер
+    if pool_size == 2:
+        return ["local-1", "local-2"]  # Два воркера
+    return ["local-model"] * pool_size  # Больше 2 потоков - используем одну модель
+
+
+class EngineListener:
+    """
+    Получатель событий движка; по умолчанию сообщения печатаются в консоль,
+    статистика не отображается. GUI переопределяет методы и обновляет виджеты.
+    """
+
+    def log(self, message):
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] {message}", flush=True)
+
+    def log_event(self, event):
+        """Событие воркера (PipelineEvent): текст строится только здесь, при выводе"""
+        for line in render_event(event):
+            self.log(line)
+
+    def update_progress(self, current, total):
+        pass
+
+    def update_ocr_stats(self, completed_count, total_count):
+        pass
+
+    def update_llm_stats(self, completed_count, total_count):
+        pass
+
+    def update_document_type_count(self, doc_type):
+        pass
+
+    def idle(self):
+        """Оркестратор ждет сообщений воркеров"""
+        pass
+
+
+class PipelineEngine:
+    """
+    Оркестратор обработки: очереди, процессы OCR/LLM воркеров, писатель результатов,
+    журнал запуска и статистика. Не зависит от Tkinter.
+    
+    run() - обработка списка файлов от начала до конца (GUI, разовый запуск);
+    watch() - демон: воркеры и модели Surya в них остаются загруженными между пакетами
+    (keep_loaded), новые файлы папки обрабатываются по мере появления.
+    """
+
+    def __init__(self, ocr_settings, llm_settings, llm_models, ocr_workers=1, pipeline=True,
+                 pipeline_queue_size=16, date_format="ISO", keep_loaded=False, listener=None):
+        self.ocr_settings = dict(ocr_settings)
+        self.llm_settings = llm_settings
+        self.llm_models = llm_models
+        self.ocr_pool_size = ocr_workers
+        self.pipeline = pipeline
+        self.pipeline_queue_size = pipeline_queue_size  # Максимум документов, ожидающих LLM (backpressure для OCR)
+        self.date_format = date_format
+        self.keep_loaded = keep_loaded
+        self.listener = listener or EngineListener()
+        
+        self.stop_processing = False
+        self.active_processes = []  # Процессы, которые завершаются при остановке
+        self.ocr_processes = []
+        self.llm_processes = []
+        self.llm_stop_signals = 0  # Стоп-сигналов для LLM очереди (по числу потребителей)
+        self.writer_process = None
+        self.backfill_process = None  # Фоновый полный OCR: один процесс на все пакеты
+        self.backfill_queue = None
+        self.backfill_done_queue = None
+        self.journal = None  # Журнал текущего запуска (JobJournal)
+        self.json_folder = None
+        self.pdf_queue = self.ocr_result_queue = self.llm_queue = self.retry_queue = self.result_queue = None
+        self.reset_stats()
+    
+    def reset_stats(self):
+        self.ocr_start_time = 0
+        self.llm_start_time = 0
+        self.ocr_doc_times = []  # Времена обработки каждого документа
+        self.llm_doc_times = []  # Времена обработки LLM
+        self.ocr_pages_count = 0  # Распознано страниц (для стр/сек)
+        self.ocr_cache_hits = 0    # Попадания в OCR кеш
+        self.ocr_cache_misses = 0  # Промахи OCR кеша
+        self.llm_prompt_tokens = 0  # Токены промпта по usage ответов LLM
+        self.llm_cached_tokens = 0  # Из них взято из кеша префикса на сервере
+        self.rule_bypassed = 0
+        self.rule_time = 0.0
+        self.resumed_done = 0
+        self.backfill_files = []  # Файлы для фонового полного OCR (режим извлечения)
+    
+    def log(self, message):
+        self.listener.log(message)
+    
+    def update_ocr_stats(self, completed_count, total_count, doc_time=None):
+        if doc_time:
+            self.ocr_doc_times.append(doc_time)
+        self.listener.update_ocr_stats(completed_count, total_count)
+    
+    def update_llm_stats(self, completed_count, total_count, doc_time=None):
+        if doc_time:
+            self.llm_doc_times.append(doc_time)
+        self.listener.update_llm_stats(completed_count, total_count)
+    
+    def stop(self, wait=False):
+        """Остановка обработки: флаг для цикла оркестратора и завершение процессов воркеров"""
+        self.stop_processing = True
+        for process in self.active_processes:
+            if process.is_alive():
+                self.log(f"Останавливаем процесс PID: {process.pid}")
+                process.terminate()
+                if wait:
+                    process.join(timeout=2)
+                    if process.is_alive():
+                        process.kill()  # Принудительное завершение
+        if wait:
+            self.active_processes.clear()
+    
+    # --- Процессы и очереди ---
+    
+    def start(self, pdf_folder, json_folder):
+        """Очереди и процесс-писатель; OCR и LLM воркеры запускаются при первой надобности"""
+        self.json_folder = json_folder
+        self.pdf_queue = Queue()
+        self.ocr_result_queue = Queue()
+        # В конвейере очередь LLM ограничена: OCR ждет, когда LLM не успевает
+        self.llm_queue = Queue(maxsize=self.pipeline_queue_size) if self.pipeline else Queue()
+        self.retry_queue = Queue() if self.llm_settings.get('auto_retry') else None
+        self.result_queue = Queue()
+        self.writer_process = self.start_results_writer(pdf_folder)
+    
+    def shutdown(self):
+        """
+        Завершение воркеров и писателя (писатель дописывает накопленный пакет и после остановки)
+        Фоновый полный OCR пишет через писателя, поэтому его дожидаемся раньше
+        """
+        self.stop_ocr_workers()
+        self.stop_llm_workers()
+        self.stop_backfill_worker()
+        if self.writer_process is not None:
+            self.stop_results_writer(self.writer_process)
+            self.writer_process = None
+    
+    def ensure_ocr_workers(self):
+        """OCR процессы (модели Surya грузятся при старте процесса); живые не перезапускаются"""
+        self.ocr_processes = [p for p in self.ocr_processes if p.is_alive()]
+        llm_queue = self.llm_queue if self.pipeline else None
+        while len(self.ocr_processes) < self.ocr_pool_size:
+            p = Process(target=ocr_worker_simple, args=(self.pdf_queue, self.ocr_result_queue, llm_queue, self.ocr_settings))
+            p.start()
+            self.ocr_processes.append(p)
+            self.active_processes.append(p)
+    
+    def stop_ocr_workers(self):
+        """Освобождение OCR процессов (и памяти моделей)"""
+        for p in self.ocr_processes:
+            if self.stop_processing:
+                p.terminate()
+            else:
+                self.pdf_queue.put(None)
+        for p in self.ocr_processes:
+            p.join(timeout=5 if self.stop_processing else None)
+        self.ocr_processes = []
+    
+    def ensure_llm_workers(self):
+        """LLM процессы (False - если обработка остановлена)"""
+        if self.llm_processes and all(p.is_alive() for p in self.llm_processes):
+            return True
+        self.stop_llm_workers()
+        processes = self.start_llm_workers(self.llm_queue, self.result_queue, self.json_folder,
+                                           self.llm_settings, self.retry_queue)
+        if processes is None:
+            return False
+        self.llm_processes = processes
+        return True
+    
+    def stop_llm_workers(self):
+        for p in self.llm_processes:
+            if self.stop_processing:
+                p.terminate()
+        if not self.stop_processing:
+            for _ in range(self.llm_stop_signals):
+                self.llm_queue.put(None)
+        for p in self.llm_processes:
+            p.join(timeout=5 if self.stop_processing else None)
+        self.llm_processes = []
+    
+    def start_llm_workers(self, llm_queue, result_queue, json_folder, llm_settings, retry_queue):
+        """
+        Запуск LLM процессов (None - если обработка остановлена)
+        self.llm_stop_signals - сколько стоп-сигналов нужно положить в llm_queue
+        """
+        if llm_settings.get('async'):
+            if self.stop_processing:
+                self.log("Остановка перед запуском LLM")
+                return None
+            self.log(f"Запускаем асинхронный LLM диспетчер: до {llm_settings['concurrency']} запросов, модели {sorted(set(self.llm_models))}")
+            p = Process(target=llm_async_worker, args=(llm_queue, result_queue, json_folder, llm_settings,
+                                                       self.llm_models, retry_queue, llm_settings['concurrency']))
+            p.start()
+            self.active_processes.append(p)
+            self.llm_stop_signals = 1
+            return [p]
+        
+        self.llm_stop_signals = len(self.llm_models)
+        # У каждого процесса свой ограничитель частоты - делим лимит на процессы
+        llm_settings['rate_share'] = 1.0 / len(self.llm_models)
+        self.log(f"Создаем {len(self.llm_models)} LLM воркеров: {self.llm_models}")
+        llm_processes = []
+        for i, model in enumerate(self.llm_models):
+            worker_name = f"LLM-{i+1}" if len(self.llm_models) > 1 else "LLM"
+            # Проверяем флаг остановки
+            if self.stop_processing:
+                self.log("Остановка перед запуском LLM")
+                return None
+                
+            self.log(f"Запускаем воркер: {worker_name} (модель: {model})")
+            p = Process(target=llm_worker, args=(llm_queue, result_queue, json_folder, llm_settings, model, worker_name, retry_queue))
+            p.start()
+            llm_processes.append(p)
+            self.active_processes.append(p)  # Добавляем в список активных
+        return llm_processes
+    
+    def start_results_writer(self, pdf_folder):
+        """Процесс-писатель базы результатов OCR; OCR воркеры получают его очередь через ocr_settings"""
+        results_queue = Queue()
+        writer_process = Process(target=results_writer, args=(results_db_path(pdf_folder), results_queue))
+        writer_process.start()
+        self.ocr_settings['results_queue'] = results_queue
+        return writer_process
+    
+    def stop_results_writer(self, writer_process):
+        """Стоп-сигнал писателю: он дописывает накопленный пакет и завершается"""
+        results_queue = self.ocr_settings.pop('results_queue', None)
+        if results_queue is not None:
+            results_queue.put(None)
+        writer_process.join(timeout=30)
+    
+    def start_backfill(self, files, pdf_folder):
+        """
+        Фоновый полный OCR для CSV архива (после основной обработки пакета)
+        Процесс один на весь запуск: демон передает ему файлы каждого пакета
+        через очередь, модели Surya загружаются в нем один раз.
+        """
+        if self.backfill_process is None or not self.backfill_process.is_alive():
+            self.backfill_queue = Queue()
+            self.backfill_done_queue = Queue()
+            self.backfill_process = Process(target=ocr_backfill_worker,
+                                            args=(self.backfill_queue, self.ocr_settings, self.backfill_done_queue))
+            self.backfill_process.start()
+            self.active_processes.append(self.backfill_process)  # Останавливается вместе с остальными процессами
+        for pdf_file in files:
+            self.backfill_queue.put((pdf_file, pdf_folder, self.date_format))
+        self.log(f"Фоновый полный OCR для CSV: {len(files)} файлов (низкий приоритет, PID {self.backfill_process.pid})")
+    
+    def stop_backfill_worker(self):
+        """Стоп-сигнал фоновому OCR и ожидание оставшихся файлов (при остановке - завершение сразу)"""
+        process = self.backfill_process
+        if process is None:
+            return
+        if not self.stop_processing:
+            self.backfill_queue.put(None)
+            if process.is_alive():
+                self.log("Ждем завершения фонового полного OCR...")
+        while process.is_alive():
+            if self.stop_processing:
+                process.terminate()
+            process.join(timeout=1)
+            self.collect_backfill_done()
+        self.collect_backfill_done(timeout=0.5)
+        self.backfill_process = self.backfill_queue = self.backfill_done_queue = None
+    
+    def collect_backfill_done(self, timeout=0):
+        """
+        Отметки фонового OCR в журнале: полный OCR файла записан в архив
+        Файлы с ошибкой или не дошедшие до фонового OCR остаются в журнале
+        с archive_pending и дописываются при продолжении запуска
+        """
+        if self.backfill_done_queue is None:
+            return
+        while True:
+            try:
+                pdf_file, error = self.backfill_done_queue.get(timeout=timeout) if timeout else \
+                    self.backfill_done_queue.get_nowait()
+            except queue.Empty:
+                return
+            if error is None and self.journal is not None:
+                self.journal.mark_archive(pdf_file, False)
+    
+    # --- Сообщения воркеров ---
+    
+    def forward_retries(self, retry_queue, llm_queue, message="Добавлен повтор в очередь"):
+        """Перекладывает повторы из retry_queue в очередь LLM, возвращает их количество"""
+        forwarded = 0
+        while not retry_queue.empty():
+            try:
+                retry_item = retry_queue.get_nowait()
+                llm_queue.put(retry_item)
+                forwarded += 1
+                self.log(f"{message}: {retry_item[0]}")
+            except queue.Empty:
+                break
+        return forwarded
+    
+    def handle_llm_event(self, event):
+        """
+        Событие LLM воркера: лог, журнал запуска, токены промпта и типы документов
+        Возвращает (документ_завершен, время_обработки)
+        """
+        self.listener.log_event(event)
+        self.journal_event(event)
+        
+        # Учет токенов промпта, взятых сервером из кеша префикса
+        self.llm_prompt_tokens += event.prompt_tokens
+        self.llm_cached_tokens += event.cached_tokens
+        
+        # Завершенными считаем только итоговые события (не повторы)
+        if not event.final:
+            return False, 0
+        if event.status == STATUS_DONE and event.doc_type and event.doc_type != "Неопределен":
+            self.listener.update_document_type_count(event.doc_type)
+        return True, event.processing_time
+    
+    def journal_event(self, event):
+        """Состояние файла в журнале запуска по итоговым событиям LLM воркера"""
+        if self.journal is None or event.filename is None:
+            return
+        if event.status == STATUS_DONE:
+            self.journal.mark(event.filename, LLM_DONE)
+        elif event.status == STATUS_RETRY:
+            self.journal.mark(event.filename, llm_retry=True)  # Не попытка запуска: предел демона не расходует
+        elif event.status == STATUS_FAILED:
+            self.journal.mark(event.filename, FAILED, error=event.error)
+    
+    def plan_resume(self, pdf_files, pdf_folder, label="ПРОДОЛЖЕНИЕ"):
+        """
+        Продолжение прерванного запуска по журналу:
+        готовые файлы пропускаются, файлы с готовым OCR берут его из базы результатов
+        (если хеш PDF совпадает с распознанным) и идут сразу в LLM, остальные распознаются заново.
+        Возвращает (файлы_для_OCR, подготовленные_данные_для_LLM).
+        """
+        db_path = results_db_path(pdf_folder)
+        store = ResultsStore(db_path) if os.path.exists(db_path) else None
+        to_ocr, reloaded = [], []
+        done = 0
+        try:
+            for pdf_file in pdf_files:
+                job = self.journal.get(pdf_file)
+                if job and job[0] == LLM_DONE:
+                    done += 1
+                    if job[3] and self.ocr_settings.get('backfill'):
+                        self.backfill_files.append(pdf_file)  # Полный OCR для архива не дописан
+                    continue
+                stored = None
+                if store is not None and job and job[2]:
+                    try:
+                        stored = store.get(pdf_file, file_sha256(os.path.join(pdf_folder, pdf_file)))
+                    except OSError:
+                        pass  # PDF недоступен - распознаем заново (ошибку покажет OCR)
+                if stored is None:
+                    to_ocr.append(pdf_file)
+                    continue
+                ocr_json, combined_text = stored
+                timings = {"model_load_time": 0.0, "inference_time": 0.0}
+                reloaded.append(prepare_llm_input(pdf_file, ocr_json, combined_text, timings, self.ocr_settings))
+                self.journal.mark(pdf_file, OCR_DONE, new_attempt=True)
+        finally:
+            if store is not None:
+                store.close()
+        self.resumed_done += done
+        archive = f", полный OCR для архива {len(self.backfill_files)}" if self.backfill_files else ""
+        self.log(f"{label}: готово ранее {done}, OCR из базы {len(reloaded)}, "
+                 f"к распознаванию {len(to_ocr)}{archive}")
+        return to_ocr, reloaded
+    
+    def save_rule_result(self, result, json_folder):
+        """
+        Документ быстрого пути: JSON по полям правил пишется сразу, без LLM
+        Возвращает (документ_завершен, время_обработки) как handle_llm_event
+        """
+        doc_type = save_llm_item(result['filename'], rule_result_json(result['known_fields']), result['combined_text'],
+                                 json_folder, result['known_fields'])
+        self.rule_bypassed += 1
+        self.rule_time += result.get('rule_time', 0.0)
+        return self.handle_llm_event(PipelineEvent(STAGE_RULES, STATUS_DONE, filename=result['filename'],
+                                                   worker="Правила", doc_type=doc_type,
+                                                   processing_time=result.get('rule_time', 0.0),
+                                                   confidence=result['rule_confidence']))
+    
+    def log_rule_summary(self, completed):
+        """Доля документов быстрого пути и сэкономленное время LLM (по среднему времени документа в LLM)"""
+        bypass_rate = self.rule_bypassed * 100 / completed if completed else 0
+        avg_llm_time = sum(self.llm_doc_times) / len(self.llm_doc_times) if self.llm_doc_times else 0
+        saved = max(0.0, avg_llm_time * self.rule_bypassed - self.rule_time)
+        self.log(f"Без LLM по правилам: {self.rule_bypassed}/{completed} документов ({bypass_rate:.0f}%), "
+                 f"сэкономлено ~{saved:.1f}с LLM (в среднем {avg_llm_time:.1f}с/док, правила {self.rule_time:.2f}с)")
+    
+    def log_ocr_result(self, result, ocr_completed, total):
+        """Логирование результата OCR и обновление статистики OCR"""
+        doc_time = result.get('processing_time', 0)
+        if self.journal is not None:
+            job = self.journal.get(result['filename'])
+            if job and job[0] == LLM_DONE:
+                pass  # В конвейере LLM может завершить документ раньше, чем прочитана сводка OCR
+            elif result["success"]:
+                self.journal.mark(result['filename'], OCR_DONE)
+            else:
+                self.journal.mark(result['filename'], FAILED, error=result.get('error'))
+        if result["success"]:
+            self.ocr_pages_count += result.get('pages', 0)
+            if result.get('extraction_only') and self.ocr_settings.get('backfill'):
+                self.backfill_files.append(result['filename'])
+                if self.journal is not None:
+                    self.journal.mark_archive(result['filename'], True)
+            if result.get('cache_hit'):
+                self.ocr_cache_hits += 1
+            elif 'cache_hit' in result and self.ocr_settings.get('cache_dir'):
+                self.ocr_cache_misses += 1
+            batch_info = ""
+            if result.get('batch_files'):
+                batch_info = (f", батч {result['batch_files']} файлов/{result['batch_pages']} стр., "
+                              f"{result['pages_per_sec']:.1f} стр/с")
+            if result.get('cache_hit'):
+                batch_info += ", из кеша"
+            self.log(f"OCR завершен: {result['filename']} ({doc_time:.1f}с: "
+                     f"загрузка моделей {result.get('model_load_time', 0):.1f}с, "
+                     f"распознавание {result.get('inference_time', 0):.1f}с{batch_info})")
+            self.update_ocr_stats(ocr_completed, total, doc_time)
+        else:
+            self.log(f"OCR ошибка: {result['filename']} - {result['error']}")
+            self.update_ocr_stats(ocr_completed, total)
+    
+    # --- Запуск ---
+    
+    def run(self, pdf_files, pdf_folder, json_folder, resume=False):
+        """
+        Обработка файлов от начала до конца
+        resume - продолжение прерванного запуска по журналу, иначе журнал очищается.
+        Возвращает число обработанных файлов или None, если обработка не выполнялась.
+        """
+        self.stop_processing = False
+        self.reset_stats()
+        os.makedirs(json_folder, exist_ok=True)
+        total_files = len(pdf_files)
+        
+        start_time = datetime.now()
+        self.log(f"=== НАЧАЛО ОБРАБОТКИ ===")
+        self.log(f"Время начала: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
+        self.log(f"Найдено {total_files} PDF файлов")
+        self.log(f"OCR потоков: {self.ocr_pool_size}, LLM моделей: {len(self.llm_models)}")
+        
+        # Журнал запуска: новый запуск очищает его, продолжение пропускает готовые файлы
+        self.journal = JobJournal(journal_path(json_folder))
+        try:
+            if resume:
+                pdf_files, reloaded = self.plan_resume(pdf_files, pdf_folder)
+                if not pdf_files and not reloaded and not self.backfill_files:
+                    self.log("Все файлы уже обработаны в прерванном запуске")
+                    return None
+            else:
+                self.journal.reset()
+                reloaded = []
+            self.journal.queue(pdf_files)
+            
+            self.start(pdf_folder, json_folder)
+            try:
+                if pdf_files or reloaded:
+                    outcome = self.process_batch(pdf_files, pdf_folder, json_folder, reloaded)
+                else:
+                    outcome = (0, 0)  # Остался только полный OCR для архива
+                end_time = datetime.now()
+                # Полный OCR для архива - с низким приоритетом; shutdown дожидается его
+                if self.backfill_files and not self.stop_processing:
+                    self.start_backfill(self.backfill_files, pdf_folder)
+            finally:
+                self.shutdown()
+        finally:
+            self.journal.close()
+            self.journal = None
+        if outcome is None:
+            return None
+        llm_completed, retry_added = outcome
+        processed_files = llm_completed + self.resumed_done
+        
+        self.log(f"\n=== ОБРАБОТКА ЗАВЕРШЕНА ===")
+        self.log(f"Время окончания: {end_time.strftime('%Y-%m-%d %H:%M:%S')}")
+        self.log(f"Длительность: {end_time - start_time}")
+        self.log(f"Обработано: {processed_files}/{total_files}")
+        self.log_batch_summary(llm_completed, retry_added)
+        
+        # Очищаем список активных процессов
+        self.active_processes.clear()
+        return processed_files
+    
+    def log_batch_summary(self, llm_completed, retry_added):
+        if retry_added > 0:
+            self.log(f"Повторов выполнено: {retry_added}")
+        if self.llm_prompt_tokens:
+            self.log(f"Токены промпта: {self.llm_prompt_tokens}, из кеша префикса: {self.llm_cached_tokens} "
+                     f"({self.llm_cached_tokens * 100 / self.llm_prompt_tokens:.0f}%)")
+        if self.ocr_settings.get('rule_threshold'):
+            self.log_rule_summary(llm_completed)
+    
+    def watch(self, pdf_folder, json_folder, poll_interval=WATCH_POLL_INTERVAL):
+        """
+        Демон слежения за папкой: новые PDF обрабатываются пакетами, пока не вызван stop()
+        Воркеры (и модели Surya в OCR процессах) остаются загруженными между пакетами.
+        Файл берется в работу, когда его размер и время изменения не поменялись
+        с прошлого опроса (копирование завершено). Готовые файлы пропускаются по журналу,
+        поэтому перезапуск демона продолжает с места остановки.
+        """
+        self.keep_loaded = True
+        self.stop_processing = False
+        self.reset_stats()
+        os.makedirs(json_folder, exist_ok=True)
+        self.log(f"=== СЛЕЖЕНИЕ ЗА ПАПКОЙ: {pdf_folder} → {json_folder} (опрос каждые {poll_interval:g}с) ===")
+        
+        self.journal = JobJournal(journal_path(json_folder))
+        self.start(pdf_folder, json_folder)
+        archive_pending = self.journal.archive_pending()
+        if archive_pending and self.ocr_settings.get('backfill'):
+            self.start_backfill(archive_pending, pdf_folder)  # Не дописан до прошлой остановки демона
+        seen = {}
+        processed_files = 0
+        try:
+            while not self.stop_processing:
+                self.collect_backfill_done()
+                ready = self.find_ready_files(pdf_folder, seen)
+                if not ready:
+                    self.listener.idle()
+                    time.sleep(poll_interval)
+                    continue
+                try:
+                    processed_files += self.process_new_files(ready, pdf_folder, json_folder)
+                except Exception as e:
+                    self.log(f"Ошибка обработки пакета: {e}")
+                self.journal.flush()
+        finally:
+            self.shutdown()
+            self.journal.close()
+            self.journal = None
+        self.log(f"=== СЛЕЖЕНИЕ ОСТАНОВЛЕНО: обработано {processed_files} файлов ===")
+        return processed_files
+    
+    def find_ready_files(self, pdf_folder, seen):
+        """
+        PDF, не менявшиеся с прошлого опроса (seen - размеры и время изменения прошлого опроса)
+        и не завершенные по журналу; файл с ошибкой повторяется до WATCH_MAX_ATTEMPTS попыток
+        """
+        current, ready = {}, []
+        for pdf_file in list_pdf_files(pdf_folder):
+            job = self.journal.get(pdf_file)
+            if job and (job[0] == LLM_DONE or (job[0] == FAILED and job[1] >= WATCH_MAX_ATTEMPTS)):
+                continue
+            try:
+                stat = os.stat(os.path.join(pdf_folder, pdf_file))
+            except OSError:
+                continue  # Файл удален между листингом и проверкой
+            current[pdf_file] = (stat.st_size, stat.st_mtime)
+            if seen.get(pdf_file) == current[pdf_file]:
+                ready.append(pdf_file)
+        seen.clear()
+        seen.update(current)
+        return ready
+    
+    def process_new_files(self, pdf_files, pdf_folder, json_folder):
+        """Пакет демона: OCR из базы для файлов с готовым OCR, остальные - полностью"""
+        start_time = time.time()
+        to_ocr, reloaded = self.plan_resume(pdf_files, pdf_folder, label="НОВЫЕ ФАЙЛЫ")
+        self.journal.queue(to_ocr)
+        outcome = self.process_batch(to_ocr, pdf_folder, json_folder, reloaded)
+        if outcome is None:
+            return 0
+        llm_completed, retry_added = outcome
+        self.log(f"Пакет обработан: {llm_completed}/{len(pdf_files)} за {time.time() - start_time:.1f}с")
+        self.log_batch_summary(llm_completed, retry_added)
+        if self.backfill_files and not self.stop_processing:
+            self.start_backfill(self.backfill_files, pdf_folder)
+            self.backfill_files = []
+        return llm_completed
+    
+    def process_batch(self, pdf_files, pdf_folder, json_folder, reloaded=()):
+        """Пакет на запущенных очередях (start): (llm_completed, retry_added) или None при отмене"""
+        if self.pipeline:
+            return self.run_pipelined(pdf_files, pdf_folder, json_folder, reloaded)
+        return self.run_two_phase(pdf_files, pdf_folder, json_folder, reloaded)
+    
+    def run_pipelined(self, pdf_files, pdf_folder, json_folder, reloaded=()):
+        """
+        Конвейерный режим: OCR и LLM работают одновременно
+        
+        OCR воркеры кладут результаты прямо в ограниченную очередь LLM, поэтому
+        общее время близко к max(OCR, LLM), а не к их сумме, и OCR данные
+        всей пачки не копятся в памяти.
+        reloaded - данные для LLM из базы результатов (продолжение запуска), минуют OCR.
+        Возвращает (llm_completed, retry_added) или None при отмене.
+        """
+        auto_retry = self.llm_settings['auto_retry']
+        llm_queue, result_queue, retry_queue = self.llm_queue, self.result_queue, self.retry_queue
+        
+        total = len(pdf_files)
+        self.log(f"КОНВЕЙЕР: OCR ({self.ocr_pool_size}) → LLM ({len(self.llm_models)}), "
+                 f"буфер {self.pipeline_queue_size} документов")
+        
+        self.ocr_start_time = time.time()
+        self.llm_start_time = self.ocr_start_time
+        self.update_ocr_stats(0, total)
+        self.update_llm_stats(0, total)
+        
+        for pdf_file in pdf_files:
+            self.pdf_queue.put((pdf_file, pdf_folder, self.date_format))
+        
+        # LLM воркеры стартуют первыми и ждут документы
+        if not self.ensure_llm_workers():
+            return None
+        if pdf_files:
+            self.ensure_ocr_workers()
+        
+        ocr_completed = 0
+        ocr_success = 0
+        ocr_finished = False
+        llm_completed = 0
+        retry_added = 0
+        
+        # OCR из базы (продолжение запуска): быстрый путь сразу, остальное - в очередь LLM по мере места
+        reused = len(reloaded)
+        pending = []
+        for result in reloaded:
+            if result.get("rule_bypass"):
+                self.save_rule_result(result, json_folder)
+                llm_completed += 1
+            else:
+                pending.append((result["filename"], result["truncated_data"], result["combined_text"], 0,
+                                result["known_fields"]))
+        
+        # Работаем, пока не завершен OCR всех файлов и LLM всех успешных OCR
+        while not self.stop_processing and (ocr_completed < total or llm_completed < ocr_success + reused):
+            got_message = False
+            while pending:
+                try:
+                    llm_queue.put_nowait(pending[0])
+                    pending.pop(0)
+                except queue.Full:
+                    break
+            
+            try:
+                result = self.ocr_result_queue.get_nowait()
+                got_message = True
+                ocr_completed += 1
+                if result["success"]:
+                    ocr_success += 1
+                self.log_ocr_result(result, ocr_completed, total)
+                if result["success"] and result.get("rule_bypass"):
+                    self.save_rule_result(result, json_folder)
+                    llm_completed += 1
+                    self.listener.update_progress(llm_completed + (ocr_completed - ocr_success), total + reused)
+                    self.update_llm_stats(llm_completed, ocr_success + reused)
+            except queue.Empty:
+                pass
+            
+            if not ocr_finished and ocr_completed >= total:
+                ocr_finished = True
+                if not self.keep_loaded:
+                    self.stop_ocr_workers()  # OCR закончен: освобождаем OCR процессы (и память моделей)
+                self.log(f"OCR ЗАВЕРШЕН: {ocr_success}/{total} файлов, LLM продолжает работу")
+            
+            # Повторы - на каждом шаге: событие RETRY и сам повтор идут разными очередями,
+            # повтор может появиться уже после события (для последнего документа - без новых событий)
+            if auto_retry and retry_queue:
+                retry_added += self.forward_retries(retry_queue, llm_queue)
+            
+            try:
+                result = result_queue.get(timeout=0.2)
+                got_message = True
+                finished, doc_time = self.handle_llm_event(result)
+                if finished:
+                    llm_completed += 1
+                    self.listener.update_progress(llm_completed + (ocr_completed - ocr_success), total + reused)
+                    self.update_llm_stats(llm_completed, ocr_success + reused, doc_time if doc_time > 0 else None)
+            except queue.Empty:
+                pass
+            
+            if not got_message:
+                self.listener.idle()
+        
+        return llm_completed, retry_added
+    
+    def run_two_phase(self, pdf_files, pdf_folder, json_folder, reloaded=()):
+        """
+        Двухэтапный режим: сначала OCR всех файлов, затем LLM
+        reloaded - данные для LLM из базы результатов (продолжение запуска), минуют OCR.
+        Возвращает (llm_completed, retry_added) или None при отмене.
+        """
+        auto_retry = self.llm_settings['auto_retry']
+        llm_queue, result_queue, retry_queue = self.llm_queue, self.result_queue, self.retry_queue
+        bypassed_before = self.rule_bypassed
+        
+        # ЭТАП 1: OCR ОБРАБОТКА с очередями (НЕБЛОКИРУЮЩАЯ!)
+        self.log(f"ЭТАП 1: Начинаем OCR обработку в {self.ocr_pool_size} потока...")
+        
+        # Запускаем таймер OCR
+        self.ocr_start_time = time.time()
+        self.update_ocr_stats(0, len(pdf_files))
+        
+        # Заполняем очередь PDF
+        for pdf_file in pdf_files:
+            self.pdf_queue.put((pdf_file, pdf_folder, self.date_format))
+        
+        # Проверяем флаг остановки
+        if self.stop_processing:
+            self.log("Обработка остановлена пользователем")
+            return None
+        
+        if pdf_files:
+            self.ensure_ocr_workers()
+        
+        # Мониторинг OCR результатов (OCR из базы при продолжении - сразу в список для LLM)
+        ocr_completed = 0
+        ocr_data_list = []
+        for result in reloaded:
+            if result.get("rule_bypass"):
+                self.save_rule_result(result, json_folder)
+            else:
+                ocr_data_list.append(result)
+        
+        while ocr_completed < len(pdf_files) and not self.stop_processing:
+            try:
+                result = self.ocr_result_queue.get(timeout=1)
+                
+                # Проверяем флаг остановки
+                if self.stop_processing:
+                    self.log("Остановка OCR обработки...")
+                    break
+                
+                ocr_completed += 1
+                self.log_ocr_result(result, ocr_completed, len(pdf_files))
+                if result["success"] and result.get("rule_bypass"):
+                    self.save_rule_result(result, json_folder)
+                elif result["success"]:
+                    ocr_data_list.append(result)
+                self.listener.update_progress(ocr_completed, len(pdf_files))
+            except queue.Empty:
+                self.listener.idle()
+                continue
+        
+        # Завершаем OCR процессы (демон оставляет их с загруженными моделями)
+        if not self.keep_loaded:
+            self.stop_ocr_workers()
+        
+        self.log(f"ЭТАП 1 ЗАВЕРШЕН: OCR обработано {ocr_completed}/{len(pdf_files)} файлов")
+        
+        bypassed = self.rule_bypassed - bypassed_before
+        if not ocr_data_list:
+            if bypassed:
+                self.log(f"Все {bypassed} документов обработаны правилами, LLM не нужен")
+                return bypassed, 0
+            raise RuntimeError("OCR не обработал ни одного файла")
+        
+        # ЭТАП 2: LLM ОБРАБОТКА (параллельно local-1 и local-2)
+        self.log(f"ЭТАП 2: Начинаем LLM анализ с {len(self.llm_models)} воркерами...")
+        
+        # Запускаем таймер LLM
+        self.llm_start_time = time.time()
+        self.update_llm_stats(0, len(ocr_data_list))
+        
+        # Заполняем очередь OCR данными
+        for ocr_data in ocr_data_list:
+            llm_queue.put((ocr_data['filename'], ocr_data['truncated_data'], ocr_data['combined_text'], 0,
+                           ocr_data.get('known_fields')))
+        
+        # Запуск LLM процессов
+        if not self.ensure_llm_workers():
+            return None
+        
+        # Мониторинг LLM результатов с поддержкой повторов
+        llm_completed = 0
+        retry_added = 0  # Счетчик добавленных повторов
+        
+        while llm_completed < len(ocr_data_list) and not self.stop_processing:
+            # Повторы в основную очередь - на каждом шаге, а не только после события
+            # (повтор может прийти в retry_queue позже своего события RETRY)
+            if auto_retry and retry_queue:
+                retry_added += self.forward_retries(retry_queue, llm_queue)
+            
+            try:
+                result = result_queue.get(timeout=1)
+                
+                # Проверяем флаг остановки
+                if self.stop_processing:
+                    self.log("Остановка LLM обработки...")
+                    break
+                
+                finished, doc_time = self.handle_llm_event(result)
+                if finished:
+                    llm_completed += 1
+                    self.listener.update_progress(llm_completed, len(ocr_data_list))
+                    self.update_llm_stats(llm_completed, len(ocr_data_list), doc_time if doc_time > 0 else None)
+                    
+            except queue.Empty:
+                self.listener.idle()
+                continue
+        
+        # Обработка оставшихся повторов перед завершением
+        if auto_retry and retry_queue:
+            # Проверяем оставшиеся повторы
+            final_retries = self.forward_retries(retry_queue, llm_queue, "Обработка оставшегося повтора")
+                    
+            if final_retries > 0:
+                self.log(f"Обрабатываем {final_retries} оставшихся повторов...")
+                
+                # Ожидаем завершения повторов
+                final_completed = 0
+                while final_completed < final_retries:
+                    try:
+                        event = result_queue.get(timeout=5)
+                        if self.handle_llm_event(event)[0]:
+                            final_completed += 1
+                    except queue.Empty:
+                        self.log("Таймаут ожидания повторов")
+                        break
+        
+        return llm_completed + bypassed, retry_added
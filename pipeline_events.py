@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+События воркеров конвейера для оркестратора
+LLM воркеры кладут в очередь результатов PipelineEvent вместо готовых строк лога:
+оркестратор обновляет журнал и счетчики по полям события, а текст для лога
+строится только при выводе (render_event) - разбора строк нет, имя файла
+с " - " или "(время: " статистику не портит.
+"""
+from dataclasses import dataclass
+from typing import Optional
+
+from llm_client import format_http_timings
+
+# Этапы
+STAGE_OCR = "ocr"
+STAGE_LLM = "llm"
+STAGE_RULES = "rules"  # Быстрый путь без LLM
+
+# Статусы
+STATUS_STARTED = "started"  # Воркер/диспетчер запущен
+STATUS_STOPPED = "stopped"  # Воркер/диспетчер завершен
+STATUS_INFO = "info"        # Промежуточные сведения (задание получено, пакет)
+STATUS_RETRY = "retry"      # Документ поставлен в очередь повтора
+STATUS_DONE = "done"        # Документ завершен, JSON записан
+STATUS_FAILED = "failed"    # Документ завершен с ошибкой (попытки исчерпаны)
+
+FINAL_STATUSES = (STATUS_DONE, STATUS_FAILED)
+
+
+@dataclass
+class PipelineEvent:
+    """
+    Событие воркера (передается между процессами через multiprocessing.Queue)
+    attempt - номер попытки, к которой относится событие (с 1);
+    timings - сетевая часть запроса LLM (http_timings), если запрос был
+    """
+    stage: str
+    status: str
+    filename: Optional[str] = None
+    worker: Optional[str] = None
+    kind: Optional[str] = None  # Уточнение для STARTED/STOPPED/INFO/FAILED: "dispatcher", "assigned", "batch", ...
+    doc_type: Optional[str] = None
+    attempt: int = 1
+    max_attempts: int = 1
+    processing_time: float = 0.0
+    timings: Optional[dict] = None
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    confidence: Optional[float] = None  # Уверенность правил (STAGE_RULES)
+    count: int = 0  # Запросов одновременно / документов диспетчера
+    files: Optional[list] = None  # Документы пакета
+    error: Optional[str] = None
+
+    @property
+    def final(self):
+        """Итог по документу (завершен или ошибка после всех попыток)"""
+        return self.status in FINAL_STATUSES
+
+
+def llm_timing_lines(event):
+    """Сведения о запросе LLM: экономия токенов формата, HTTP, поток, кеш промпта"""
+    timings = event.timings
+    if not timings:
+        return []
+    lines = []
+    tag = f"[{event.worker}] {event.filename}"
+    if timings.get("json_tokens"):
+        saved = timings["json_tokens"] - timings["data_tokens"]
+        lines.append(f"Токены данных {tag}: {timings['data_tokens']} "
+                     f"(JSON с отступами: {timings['json_tokens']}, экономия {saved} / "
+                     f"{saved * 100 / timings['json_tokens']:.0f}%)")
+    if "total_time" in timings:
+        lines.append(f"HTTP {tag}: {format_http_timings(timings)}")
+    if "first_token_time" in timings:
+        complete = f"{timings['json_complete_time']:.1f}с" if "json_complete_time" in timings else "не получен"
+        early = ", генерация остановлена после JSON" if timings.get("stopped_early") else ""
+        if timings.get("usage_missing"):
+            early += ", usage не получен - лимит TPM по оценке токенов"
+        lines.append(f"Поток {tag}: первый токен {timings['first_token_time']:.2f}с, JSON {complete}{early}")
+    if event.prompt_tokens:
+        lines.append(f"Кеш промпта {tag}: {event.cached_tokens}/{event.prompt_tokens} токенов")
+    return lines
+
+
+def render_event(event):
+    """Строки лога для события"""
+    name, filename = event.worker, event.filename
+    if event.status == STATUS_STARTED:
+        if event.kind == "dispatcher":
+            return [f"Запущен LLM диспетчер: {name}, до {event.count} запросов одновременно"]
+        return [f"Запущен LLM воркер: {name}"]
+    if event.status == STATUS_STOPPED:
+        if event.kind == "dispatcher":
+            return [f"Завершаем LLM диспетчер: {name} (документов: {event.count})"]
+        return [f"Завершаем LLM воркер: {name}"]
+    if event.status == STATUS_INFO:
+        files = event.files or []
+        if event.kind == "batch":
+            return [f"Получил пакет [{name}]: {len(files)} документов ({', '.join(files)})"]
+        if event.kind == "batch_http":
+            return [f"HTTP [{name}] пакет {len(files)} док.: {format_http_timings(event.timings)}"]
+        if event.kind == "batch_unparsed":
+            return [f"Пакет [{name}] не разобран: {event.error} - документы поодиночке"]
+        if event.kind == "batch_save_error":
+            return [f"Ошибка сохранения пакета [{name}] {filename}: {event.error}"]
+        if event.kind == "batch_fallback":
+            return [f"Пакет [{name}]: нет ответа для {len(files)} документов - повторяем поодиночке"]
+        return [f"Получил задание [{name}]: {filename} (попытка {event.attempt})"]
+
+    lines = llm_timing_lines(event)
+    if event.status == STATUS_DONE:
+        if event.stage == STAGE_RULES:
+            lines.append(f"Без LLM: {filename} - поля по правилам, уверенность {event.confidence:.2f}")
+        lines.append(f"Завершено [{name}]: {filename} (время: {event.processing_time:.1f}с) - {event.doc_type}")
+    elif event.status == STATUS_RETRY:
+        lines.append(f"Повтор [{name}] для {filename}: {event.error} (попытка {event.attempt + 1}/{event.max_attempts})")
+    elif event.stage == STAGE_OCR:
+        lines.append(f"{filename}: OCR ошибка: {event.error}")
+    elif event.kind == "exception":
+        lines.append(f"Ошибка [{name}] {filename}: {event.error}")
+    else:
+        lines.append(f"Ошибка LLM [{name}] для {filename}: {event.error} "
+                     f"(время: {event.processing_time:.1f}с, попытка {event.attempt}/{event.max_attempts})")
+    return lines
+
+
+if __name__ == "__main__":
+    import pickle
+    import time
+
+    # Имя файла с " - " и "(время: " - прежний разбор строки ломался на таких именах
+    event = PipelineEvent(STAGE_LLM, STATUS_DONE, filename="Акт - 12 (время: 5с).pdf", worker="LLM-1",
+                          doc_type="акт", processing_time=3.2,
+                          timings={"total_time": 3.1, "connect_time": 0.01, "wait_time": 2.9, "read_time": 0.2},
+                          prompt_tokens=1800, cached_tokens=1536)
+    for line in render_event(event):
+        print(line)
+    legacy = f"Завершено [LLM-1]: {event.filename} (время: {event.processing_time:.1f}с) - {event.doc_type}"
+    print(f"Прежний разбор: тип '{legacy.split(' - ')[-1]}', "
+          f"время '{legacy.split('(время: ')[1].split('с)')[0]}'")
+
+    # Передача через очередь (pickle) и обработка в оркестраторе, 100 000 событий
+    count = 100000
+    start = time.perf_counter()
+    for _ in range(count):
+        message = pickle.loads(pickle.dumps(
+            f"Завершено [LLM-1]: doc.pdf (время: {3.2:.1f}с) - акт"))
+        finished = "Завершено" in message or ("Ошибка LLM" in message and "попытка" in message)
+        doc_time = float(message.split("(время: ")[1].split("с)")[0])
+        doc_type = message.split(" - ")[-1].strip()
+    legacy_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(count):
+        received = pickle.loads(pickle.dumps(
+            PipelineEvent(STAGE_LLM, STATUS_DONE, filename="doc.pdf", worker="LLM-1", doc_type="акт",
+                          processing_time=3.2)))
+        finished, doc_time, doc_type = received.final, received.processing_time, received.doc_type
+    event_time = time.perf_counter() - start
+    # Событие передается дольше короткой строки, но это микросекунды на документ против секунд запроса LLM
+    print(f"Строка + разбор: {legacy_time / count * 1e6:.1f} мкс/событие, "
+          f"событие + поля: {event_time / count * 1e6:.1f} мкс/событие")
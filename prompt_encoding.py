@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Форматы представления строк OCR в промпте LLM
+- json: JSON с отступами (прежний формат)
+- json_min: минифицированный JSON, bbox округлены до целых
+- tsv: таблица "стр|x|y|текст" с координатами в целых
+- text: только текст с маркерами страниц
+Компактные форматы экономят токены на пробелах, кавычках и повторяющихся ключах.
+"""
+import json
+
+PROMPT_ENCODINGS = {
+    "json": "JSON с отступами",
+    "json_min": "Минифицированный JSON",
+    "tsv": "Таблица стр|x|y|текст",
+    "text": "Только текст",
+}
+DEFAULT_PROMPT_ENCODING = "json_min"
+
+TSV_HEADER = "стр|x|y|текст\n"
+
+
+def page_marker(page):
+    return f"=== Страница {page} ===\n"
+
+
+def _json_item(line, compact):
+    """Строка для JSON форматов: без служебного номера страницы; в компактном - округленные bbox"""
+    if not isinstance(line, dict):
+        return line
+    item = {key: value for key, value in line.items() if key != 'page'}
+    if compact:
+        if isinstance(item.get('bbox'), (list, tuple)):
+            item['bbox'] = [round(value) for value in item['bbox']]
+        if isinstance(item.get('confidence'), float):
+            item['confidence'] = round(item['confidence'], 2)
+    return item
+
+
+def _line_text(line):
+    text = line.get('text', '') if isinstance(line, dict) else str(line)
+    return str(text).replace('\n', ' ')
+
+
+def encode_item(line, encoding="json"):
+    """
+    Одна строка в выбранном формате - ровно так, как она войдет в промпт
+    (с отступом/разделителем); по этим кускам усечение считает токены
+    """
+    if encoding == "json_min":
+        return json.dumps(_json_item(line, True), ensure_ascii=False, separators=(',', ':')) + ","
+    if encoding == "tsv":
+        text = _line_text(line).replace('|', '/')
+        bbox = line.get('bbox') if isinstance(line, dict) else None
+        if not bbox:
+            return f"||| {text}\n"  # Служебная строка (разделитель пропуска)
+        return f"{line.get('page', '')}|{round(bbox[0])}|{round(bbox[1])}|{text}\n"
+    if encoding == "text":
+        return _line_text(line) + "\n"
+    # json: элемент внутри json.dumps(список, indent=2)
+    return "  " + json.dumps(_json_item(line, False), ensure_ascii=False, indent=2).replace("\n", "\n  ") + ",\n"
+
+
+def chunk_marker(encoding, chunk_type):
+    """Сколько добавляет пометка chunk_type к строке (в табличных форматах не выводится)"""
+    if encoding == "json":
+        return f',\n    "chunk_type": "{chunk_type}"'
+    if encoding == "json_min":
+        return f',"chunk_type":"{chunk_type}"'
+    return ""
+
+
+def encoding_overhead(encoding, lines):
+    """Текст, который формат добавляет помимо строк (скобки, заголовок таблицы, маркеры страниц)"""
+    if encoding == "json":
+        return "[\n]"
+    if encoding == "json_min":
+        return "[]"
+    if encoding == "tsv":
+        return TSV_HEADER
+    pages = sorted({line.get('page') for line in lines if isinstance(line, dict) and line.get('page') is not None})
+    return "".join(page_marker(page) for page in pages)
+
+
+def encode_lines(lines, encoding="json"):
+    """Строки OCR (после усечения) в текст для промпта"""
+    if encoding == "json":
+        return json.dumps([_json_item(line, False) for line in lines], ensure_ascii=False, indent=2)
+    if encoding == "json_min":
+        return json.dumps([_json_item(line, True) for line in lines], ensure_ascii=False, separators=(',', ':'))
+    if encoding == "tsv":
+        return TSV_HEADER + "".join(encode_item(line, "tsv") for line in lines).rstrip("\n")
+    parts = []
+    current_page = None
+    for line in lines:
+        page = line.get('page') if isinstance(line, dict) else None
+        if page is not None and page != current_page:
+            parts.append(page_marker(page))
+            current_page = page
+        parts.append(encode_item(line, "text"))
+    return "".join(parts).rstrip("\n")
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Адаптивный ограничитель частоты запросов к LLM (OpenAI)
+Два ведра токенов - запросы в минуту (RPM) и токены в минуту (TPM).
+Скорость подстраивается по ответам сервера: при 429 снижается вдвое,
+после серии успешных запросов плавно растет до лимита из заголовков x-ratelimit-*.
+"""
+import random
+import re
+import threading
+import time
+
+# Коды ответа, при которых запрос повторяется с паузой
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def parse_duration(value):
+    """
+    Длительность из заголовков в секундах: "20", "1.5", "20ms", "6m0s", "1h2m3.5s"
+    None - если разобрать не удалось
+    """
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if not parts:
+        return None
+    scale = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_retry_after(headers):
+    """Пауза из Retry-After / retry-after-ms (секунды) или None"""
+    if not headers:
+        return None
+    retry_ms = headers.get('retry-after-ms')
+    if retry_ms is not None:
+        delay = parse_duration(retry_ms)
+        return delay / 1000 if delay is not None else None
+    return parse_duration(headers.get('Retry-After'))
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """Экспоненциальная пауза с полным джиттером: случайно от 0 до min(cap, base * 2^attempt)"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class TokenBucket:
+    """Ведро токенов: емкость на минуту, равномерное пополнение"""
+
+    def __init__(self, per_minute):
+        self.rate = float(per_minute)       # Текущая скорость (в минуту)
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Сколько ждать, пока в ведре наберется amount (amount больше емкости - ждем полное ведро)"""
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60.0 / self.rate
+
+    def set_rate(self, per_minute):
+        self.rate = float(per_minute)
+        self.capacity = float(per_minute)
+        self.tokens = min(self.tokens, self.capacity)
+
+
+class AdaptiveRateLimiter:
+    """
+    Ограничитель RPM/TPM для одного эндпоинта и модели (общий для потоков процесса)
+    share - доля лимитов аккаунта на этот процесс (несколько процессов воркеров делят
+    один лимит); к ней приводятся и лимиты из заголовков x-ratelimit-limit-*
+
+    acquire(tokens) - ждет, пока запрос поместится в оба ведра
+    on_response(status, headers, ...) - подстройка скорости по ответу сервера
+    """
+
+    # Параметры подстройки (AIMD)
+    DECREASE_FACTOR = 0.5      # При 429
+    INCREASE_FACTOR = 0.05     # Прирост после серии успехов
+    SUCCESS_STREAK = 20        # Успешных ответов до прироста
+    MIN_SHARE = 0.05           # Нижняя граница скорости от начальной
+
+    def __init__(self, rpm, tpm, share=1.0):
+        self.lock = threading.Lock()
+        self.share = share
+        rpm, tpm = int(rpm * share), int(tpm * share)
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.rpm_ceiling = float(rpm) if rpm else None
+        self.tpm_ceiling = float(tpm) if tpm else None
+        self.rpm_floor = float(rpm) * self.MIN_SHARE if rpm else None
+        self.tpm_floor = float(tpm) * self.MIN_SHARE if tpm else None
+        self.paused_until = 0.0
+        self.success_streak = 0
+        # Статистика
+        self.throttled = 0
+        self.wait_total = 0.0
+
+    def acquire(self, tokens=0):
+        """Блокирует до момента, когда запрос на tokens токенов можно отправить; возвращает время ожидания"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                delay = self.paused_until - now
+                if delay <= 0:
+                    delay = 0.0
+                    for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+                        if bucket is not None:
+                            bucket.refill(now)
+                            delay = max(delay, bucket.wait_time(amount))
+                    if delay <= 0:
+                        if self.requests is not None:
+                            self.requests.tokens -= 1
+                        if self.tokens is not None:
+                            self.tokens.tokens -= tokens
+                        self.wait_total += waited
+                        return waited
+            time.sleep(delay)
+            waited += delay
+
+    def record_usage(self, estimated, actual):
+        """Поправка TPM ведра на реальное количество токенов из usage ответа"""
+        if self.tokens is None or actual is None:
+            return
+        with self.lock:
+            self.tokens.tokens -= actual - estimated
+
+    def on_response(self, status_code, headers=None):
+        """Подстройка скорости по коду ответа и заголовкам x-ratelimit-*"""
+        headers = headers or {}
+        with self.lock:
+            now = time.monotonic()
+            self.apply_headers(headers, now)
+
+            if status_code == 429:
+                self.throttled += 1
+                self.success_streak = 0
+                self.scale(self.DECREASE_FACTOR)
+                retry_after = get_retry_after(headers)
+                if retry_after is not None:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+            elif status_code < 400:
+                self.success_streak += 1
+                if self.success_streak >= self.SUCCESS_STREAK:
+                    self.success_streak = 0
+                    self.scale(1 + self.INCREASE_FACTOR)
+
+    def apply_headers(self, headers, now):
+        """Лимиты и остатки из заголовков OpenAI (лимит аккаунта - в доле процесса)"""
+        limit_requests = parse_int(headers.get('x-ratelimit-limit-requests'))
+        limit_tokens = parse_int(headers.get('x-ratelimit-limit-tokens'))
+        if limit_requests and self.requests is not None:
+            self.rpm_ceiling = limit_requests * self.share
+        if limit_tokens and self.tokens is not None:
+            self.tpm_ceiling = limit_tokens * self.share
+
+        # Остаток исчерпан - ждем сброса окна
+        for remaining_key, reset_key in (('x-ratelimit-remaining-requests', 'x-ratelimit-reset-requests'),
+                                         ('x-ratelimit-remaining-tokens', 'x-ratelimit-reset-tokens')):
+            remaining = parse_int(headers.get(remaining_key))
+            reset = parse_duration(headers.get(reset_key))
+            if remaining == 0 and reset:
+                self.paused_until = max(self.paused_until, now + reset)
+
+    def scale(self, factor):
+        """Умножает текущую скорость на factor в пределах [floor, ceiling]"""
+        if self.requests is not None:
+            rate = min(self.rpm_ceiling, max(self.rpm_floor, self.requests.rate * factor))
+            self.requests.set_rate(rate)
+        if self.tokens is not None:
+            rate = min(self.tpm_ceiling, max(self.tpm_floor, self.tokens.rate * factor))
+            self.tokens.set_rate(rate)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "rpm": self.requests.rate if self.requests else None,
+                "tpm": self.tokens.rate if self.tokens else None,
+                "throttled": self.throttled,
+                "wait_total": self.wait_total,
+            }
+
+
+# Ограничители текущего процесса по (эндпоинт, модель)
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def get_rate_limiter(endpoint, model_name, rpm, tpm, share=1.0):
+    """Общий для потоков процесса ограничитель (None - лимиты не заданы)"""
+    if not rpm and not tpm:
+        return None
+    key = (endpoint, model_name)
+    with _LIMITERS_LOCK:
+        if key not in _LIMITERS:
+            _LIMITERS[key] = AdaptiveRateLimiter(rpm, tpm, share)
+        return _LIMITERS[key]
+
+
+if __name__ == "__main__":
+    # Проверка: 120 RPM → первые 120 запросов сразу, далее ~2 в секунду
+    limiter = AdaptiveRateLimiter(rpm=120, tpm=0)
+    start = time.monotonic()
+    for _ in range(124):
+        limiter.acquire()
+    print(f"124 запроса при 120 RPM: {time.monotonic() - start:.2f}с (ожидается ~2с)")
+    limiter.on_response(429, {'Retry-After': '1'})
+    print(f"После 429: {limiter.stats()}")
+    # Два процесса делят лимит аккаунта: заголовки не поднимают потолок процесса выше половины
+    shared = AdaptiveRateLimiter(rpm=500, tpm=0, share=0.5)
+    shared.on_response(200, {'x-ratelimit-limit-requests': '500'})
+    shared.scale(10)
+    print(f"Доля 1/2 от 500 RPM после заголовков и роста: {shared.stats()['rpm']:.0f} RPM (ожидается 250)")
+    print(f"Пауза из '6m0s': {parse_duration('6m0s')}с, из '20ms': {parse_duration('20ms')}с")
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Персистентный кеш результатов SuperOCR на SQLite
+Ключи - хеши содержимого, значения - JSON (сжатый zlib),
+вытеснение по суммарному размеру в порядке давности использования (LRU)
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+# Хеши файлов текущего процесса: (путь, размер, время изменения) -> SHA-256
+_FILE_HASHES = {}
+_FILE_HASHES_MAX = 1024
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    """
+    SHA-256 содержимого файла (читаем блоками, без загрузки целиком)
+    Неизмененный файл повторно не читается: воркер считает хеш для ключа кеша OCR
+    и для строки базы результатов один раз.
+    """
+    stat = os.stat(path)
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    cached = _FILE_HASHES.get(memo_key)
+    if cached is not None:
+        return cached
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    if len(_FILE_HASHES) >= _FILE_HASHES_MAX:
+        _FILE_HASHES.clear()
+    _FILE_HASHES[memo_key] = digest.hexdigest()
+    return _FILE_HASHES[memo_key]
+
+
+def get_surya_version():
+    """Версия surya-ocr (входит в ключ кеша - новая версия дает новый OCR)"""
+    try:
+        from importlib.metadata import version
+        return version("surya-ocr")
+    except Exception:
+        return "unknown"
+
+
+class SQLiteLRUCache:
+    """Кеш ключ → JSON в SQLite с ограничением размера и счетчиками попаданий"""
+
+    def __init__(self, db_path, max_bytes):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Кеш используют несколько процессов: WAL + ожидание блокировки;
+        # внутри процесса соединение общее для потоков (асинхронный LLM диспетчер)
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY,"
+            " value BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_access ON entries(last_access)")
+        self.conn.commit()
+
+    def get(self, key, max_age=None):
+        """
+        Значение по ключу или None; обновляет время последнего доступа
+        max_age - срок жизни записи в секундах (устаревшая запись удаляется)
+        """
+        try:
+            with self.lock:
+                row = self.conn.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                if max_age is not None and time.time() - row[1] > max_age:
+                    self.delete(key)
+                    self.misses += 1
+                    return None
+                self.conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+                self.conn.commit()
+                self.hits += 1
+            return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+        except Exception as e:
+            print(f"⚠️ Ошибка чтения кеша {os.path.basename(self.db_path)}: {e}")
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """Сохраняет значение и вытесняет старые записи при превышении размера"""
+        try:
+            blob = zlib.compress(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+            now = time.time()
+            with self.lock:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, size, created, last_access) VALUES (?, ?, ?, ?, ?)",
+                    (key, blob, len(blob), now, now)
+                )
+                self.conn.commit()
+                self.evict()
+        except Exception as e:
+            print(f"⚠️ Ошибка записи в кеш {os.path.basename(self.db_path)}: {e}")
+
+    def delete(self, key):
+        with self.lock:
+            self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.conn.commit()
+
+    def evict(self):
+        """LRU вытеснение: удаляем давно неиспользуемые записи до 90% лимита"""
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+        target = int(self.max_bytes * 0.9)
+        doomed = []
+        for key, size in self.conn.execute("SELECT key, size FROM entries ORDER BY last_access"):
+            if total <= target:
+                break
+            doomed.append((key,))
+            total -= size
+        self.conn.executemany("DELETE FROM entries WHERE key = ?", doomed)
+        self.conn.commit()
+        return len(doomed)
+
+    def stats(self):
+        """Счетчики этого процесса и размер кеша на диске"""
+        with self.lock:
+            entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "size_bytes": size}
+
+    def close(self):
+        self.conn.close()
+
+
+class OCRCache(SQLiteLRUCache):
+    """
+    Кеш OCR: ключ = хеш PDF + версия Surya + настройки OCR,
+    значение = ocr_json (pages_data, full_text)
+    """
+
+    def make_key(self, pdf_path, extraction_pages=None):
+        settings = {
+            "surya": get_surya_version(),
+            "task": "ocr_with_boxes",
+            "math_mode": False,
+            "extraction_pages": list(extraction_pages) if extraction_pages else None,
+        }
+        raw = file_sha256(pdf_path) + json.dumps(settings, sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class LLMResponseCache(SQLiteLRUCache):
+    """
+    Кеш ответов LLM: ключ = провайдер + хеш итогового тела запроса (модель, сообщения,
+    temperature, max_tokens, response_format) + форма ответа (объект/массив),
+    значение = распарсенный JSON ответа. Записи живут ttl секунд.
+    Для одиночного документа в ключ идут только данные документа, без имени файла
+    (дубликаты сканов под другими именами попадают в кеш).
+    """
+
+    def __init__(self, db_path, max_bytes, ttl=None):
+        super().__init__(db_path, max_bytes)
+        self.ttl = ttl
+
+    def make_key(self, provider, payload, expect_array=False):
+        raw = json.dumps([provider, payload, expect_array], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key, max_age=None):
+        return super().get(key, max_age if max_age is not None else self.ttl)
+
+
+# Открытые кеши текущего процесса (одно соединение на файл базы)
+_OPEN_CACHES = {}
+_OPEN_CACHES_LOCK = threading.Lock()
+
+
+def get_ocr_cache(cache_dir, max_mb=2048):
+    """OCR кеш в cache_dir (открывается один раз на процесс)"""
+    db_path = os.path.join(cache_dir, "ocr_cache.sqlite")
+    with _OPEN_CACHES_LOCK:
+        if db_path not in _OPEN_CACHES:
+            _OPEN_CACHES[db_path] = OCRCache(db_path, int(max_mb * 1024 * 1024))
+    return _OPEN_CACHES[db_path]
+
+
+def get_llm_cache(cache_dir, max_mb=512, ttl_hours=720):
+    """Кеш ответов LLM в cache_dir (открывается один раз на процесс)"""
+    db_path = os.path.join(cache_dir, "llm_cache.sqlite")
+    with _OPEN_CACHES_LOCK:
+        if db_path not in _OPEN_CACHES:
+            ttl = ttl_hours * 3600 if ttl_hours else None
+            _OPEN_CACHES[db_path] = LLMResponseCache(db_path, int(max_mb * 1024 * 1024), ttl)
+    return _OPEN_CACHES[db_path]
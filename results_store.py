@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Хранилище результатов OCR на SQLite (замена дозаписи в ocr_result.csv)
+OCR воркеры не пишут в файл сами: строки уходят в очередь единственного
+процесса-писателя, который вставляет их пакетами в одной транзакции.
+Ключ - (имя файла, хеш содержимого PDF); ocr_json хранится сжатым (zlib).
+CSV в прежнем формате выгружается по запросу (export_csv).
+"""
+import csv
+import json
+import os
+import queue
+import sqlite3
+import sys
+import time
+import zlib
+
+from result_cache import file_sha256
+
+RESULTS_DB_NAME = "ocr_results.sqlite"
+CSV_COLUMNS = ['filename', 'recognition_date', 'ocr_json', 'ocr_text']
+
+# Писатель сбрасывает пакет, когда набралось столько строк или прошло столько секунд
+WRITER_BATCH_SIZE = 64
+WRITER_FLUSH_INTERVAL = 1.0
+
+
+def results_db_path(pdf_folder):
+    """База результатов рядом с папкой PDF (там, где раньше лежал ocr_result.csv)"""
+    return os.path.join(os.path.dirname(pdf_folder), RESULTS_DB_NAME)
+
+
+def make_row(pdf_file, pdf_folder, date_format, ocr_json, combined_text):
+    """
+    Строка для писателя; хеш содержимого PDF считает воркер (тот же, что для ключа
+    кеша OCR), писатель только вставляет строки
+    """
+    date_str = time.strftime("%Y-%m-%d" if date_format == "ISO" else "%d.%m.%Y")
+    pdf_path = os.path.join(pdf_folder, pdf_file)
+    try:
+        content_hash = file_sha256(pdf_path)
+    except OSError:
+        content_hash = ""  # PDF уже удален/перемещен - храним без хеша
+    return {
+        "filename": pdf_file,
+        "pdf_path": pdf_path,
+        "content_hash": content_hash,
+        "recognition_date": date_str,
+        "extraction_only": bool(ocr_json.get("extraction_only", False)),
+        "ocr_json": ocr_json,
+        "ocr_text": combined_text.strip(),
+    }
+
+
+class ResultsStore:
+    """Таблица результатов OCR: запись пакетами, чтение по имени файла, выгрузка в CSV"""
+
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS ocr_results ("
+            " filename TEXT NOT NULL,"
+            " content_hash TEXT NOT NULL,"
+            " recognition_date TEXT NOT NULL,"
+            " extraction_only INTEGER NOT NULL,"
+            " ocr_json BLOB NOT NULL,"
+            " ocr_text TEXT NOT NULL,"
+            " updated REAL NOT NULL,"
+            " PRIMARY KEY (filename, content_hash))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_ocr_results_hash ON ocr_results(content_hash)")
+        self.conn.commit()
+
+    def write_many(self, rows):
+        """
+        Пакет строк одной транзакцией; повтор того же файла заменяет запись
+        (полный OCR фонового прохода заменяет результат режима извлечения)
+        """
+        records = []
+        for row in rows:
+            records.append((
+                row["filename"], row["content_hash"], row["recognition_date"], int(row["extraction_only"]),
+                zlib.compress(json.dumps(row["ocr_json"], ensure_ascii=False).encode('utf-8')),
+                row["ocr_text"], time.time(),
+            ))
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO ocr_results"
+                " (filename, content_hash, recognition_date, extraction_only, ocr_json, ocr_text, updated)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                records
+            )
+        return len(records)
+
+    def get(self, filename, content_hash=None):
+        """
+        Последний результат OCR файла: (ocr_json, ocr_text) или None
+        content_hash - хеш текущего PDF: результат для прежнего содержимого файла
+        (PDF заменен под тем же именем) не возвращается
+        """
+        if content_hash is None:
+            row = self.conn.execute(
+                "SELECT ocr_json, ocr_text FROM ocr_results WHERE filename = ? ORDER BY updated DESC LIMIT 1",
+                (filename,)
+            ).fetchone()
+        else:
+            row = self.conn.execute(
+                "SELECT ocr_json, ocr_text FROM ocr_results WHERE filename = ? AND content_hash = ?"
+                " ORDER BY updated DESC LIMIT 1",
+                (filename, content_hash)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]).decode('utf-8')), row[1]
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM ocr_results").fetchone()[0]
+
+    def export_csv(self, csv_path):
+        """Выгрузка в CSV прежнего формата построчно (без загрузки всей базы в память)"""
+        exported = 0
+        with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_COLUMNS)
+            cursor = self.conn.execute(
+                "SELECT filename, recognition_date, ocr_json, ocr_text FROM ocr_results ORDER BY filename, updated"
+            )
+            for filename, recognition_date, blob, ocr_text in cursor:
+                writer.writerow([filename, recognition_date, zlib.decompress(blob).decode('utf-8'), ocr_text])
+                exported += 1
+        return exported
+
+    def close(self):
+        self.conn.close()
+
+
+def write_ocr_result(row, ocr_settings=None):
+    """
+    Передача результата OCR на запись: в очередь писателя, если он запущен,
+    иначе - напрямую в базу (одиночные процессы: фоновый OCR, пул файлов)
+    """
+    results_queue = (ocr_settings or {}).get('results_queue')
+    if results_queue is not None:
+        results_queue.put(row)
+        return
+    store = ResultsStore(results_db_path(os.path.dirname(row["pdf_path"])))
+    try:
+        store.write_many([row])
+    finally:
+        store.close()
+
+
+def results_writer(db_path, results_queue, batch_size=WRITER_BATCH_SIZE, flush_interval=WRITER_FLUSH_INTERVAL):
+    """
+    Процесс-писатель: единственный, кто пишет в базу результатов
+    Копит строки из очереди и сбрасывает пакетом по размеру или по времени; None - стоп
+    """
+    store = ResultsStore(db_path)
+    pending = []
+    last_flush = time.monotonic()
+    written = 0
+    stop = False
+    while not stop:
+        try:
+            row = results_queue.get(timeout=flush_interval)
+            if row is None:
+                stop = True
+            else:
+                pending.append(row)
+        except queue.Empty:
+            pass
+        if pending and (stop or len(pending) >= batch_size or time.monotonic() - last_flush >= flush_interval):
+            try:
+                written += store.write_many(pending)
+            except Exception as e:
+                print(f"⚠️ Ошибка записи результатов OCR ({len(pending)} строк): {e}")
+            pending = []
+            last_flush = time.monotonic()
+    store.close()
+    print(f"🗄️ Писатель результатов OCR завершен: {written} записей в {os.path.basename(db_path)}")
+
+
+if __name__ == "__main__":
+    # Выгрузка по запросу: python results_store.py <ocr_results.sqlite> <ocr_result.csv>
+    if len(sys.argv) != 3:
+        print("Использование: python results_store.py <ocr_results.sqlite> <ocr_result.csv>")
+        sys.exit(1)
+    store = ResultsStore(sys.argv[1])
+    print(f"Выгружено строк: {store.export_csv(sys.argv[2])}")
+    store.close()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Быстрый путь без LLM: классификация документа и заполнение полей по правилам
+Тип документа определяется по ключевым словам заголовка с учетом положения
+и размера строки (bbox) и уверенности OCR, поля - детерминированным
+извлечением field_extraction. Документы с уверенностью не ниже порога
+записываются сразу, остальные идут в LLM.
+"""
+import re
+import statistics
+
+from field_extraction import extract_document_fields
+from llm_schema import LLM_RESULT_FIELDS
+
+# Рекомендуемый порог уверенности при включении быстрого пути
+# (по умолчанию быстрый путь выключен: rule_threshold = 0 в настройках)
+RULE_CONFIDENCE_THRESHOLD = 0.85
+
+# Правила типа документа: (тип, выражение по тексту строки в нижнем регистре)
+DOC_TYPE_RULES = [
+    ("счет-фактура", re.compile(r'счет-фактура|универсальный передаточный документ')),
+    ("акт", re.compile(r'\bакт\b')),
+    ("счет", re.compile(r'\bсчет\b(?!-)')),
+    ("договор", re.compile(r'\bдоговор\b|\bсоглашение\b')),
+]
+
+# Верхняя доля первой страницы, где ожидается заголовок
+HEADER_ZONE = 0.35
+# Вес строки вне зоны заголовка
+BODY_WEIGHT = 0.2
+
+# Поля, которые в результате без LLM могут остаться пустыми (у ИП и физлиц нет КПП);
+# без любого другого поля LLM_RESULT_FIELDS документ идет в LLM
+OPTIONAL_FIELDS = ("КПП_заказчика", "КПП_исполнителя")
+
+
+def line_confidence(line):
+    confidence = line.get('confidence')
+    return confidence if isinstance(confidence, (int, float)) else 1.0
+
+
+def classify_document(pages_data):
+    """
+    Тип документа по первой странице и доля его веса среди всех совпавших правил
+    Вес строки: зона заголовка x размер шрифта (высота bbox к медиане) x уверенность OCR
+    Возвращает (тип, оценка 0..1) или (None, 0.0)
+    """
+    if not pages_data:
+        return None, 0.0
+    lines = [line for line in pages_data[0].get('text_lines', []) if line.get('text') and line.get('bbox')]
+    if not lines:
+        return None, 0.0
+    page_bottom = max(line['bbox'][3] for line in lines) or 1
+    median_height = statistics.median(line['bbox'][3] - line['bbox'][1] for line in lines) or 1
+
+    weights = {}
+    for line in lines:
+        text = line['text'].lower().replace('ё', 'е')
+        for doc_type, pattern in DOC_TYPE_RULES:
+            if not pattern.search(text):
+                continue
+            zone = 1.0 if line['bbox'][1] <= page_bottom * HEADER_ZONE else BODY_WEIGHT
+            size = min(2.0, max(0.5, (line['bbox'][3] - line['bbox'][1]) / median_height))
+            weights[doc_type] = weights.get(doc_type, 0.0) + zone * size * line_confidence(line)
+            break  # Одна строка - один тип (правила в порядке приоритета)
+    if not weights:
+        return None, 0.0
+    doc_type, weight = max(weights.items(), key=lambda item: item[1])
+    return doc_type, weight / sum(weights.values())
+
+
+def rule_based_result(pages_data, filename=None):
+    """
+    Поля результата по правилам и уверенность 0..1
+    Уверенность = оценка типа x средняя уверенность OCR первой страницы;
+    0 - если не заполнено хотя бы одно поле LLM_RESULT_FIELDS, кроме OPTIONAL_FIELDS
+    """
+    fields = extract_document_fields(pages_data, filename)
+    doc_type, type_score = classify_document(pages_data)
+    header_type = fields.get("Тип_документа")
+    if header_type and doc_type and header_type != doc_type:
+        type_score *= 0.5  # Заголовок "№ ... от ..." и ключевые слова расходятся
+    elif header_type:
+        type_score = max(type_score, 0.95)  # Заголовок с номером и датой подтверждает тип
+    if doc_type and not header_type:
+        fields["Тип_документа"] = doc_type
+
+    if not all(fields.get(field) for field in LLM_RESULT_FIELDS if field not in OPTIONAL_FIELDS):
+        return fields, 0.0
+    first_page = pages_data[0].get('text_lines', []) if pages_data else []
+    ocr_confidence = statistics.mean(line_confidence(line) for line in first_page) if first_page else 0.0
+    return fields, type_score * ocr_confidence
+
+
+def rule_result_json(fields):
+    """Результат быстрого пути по схеме: все ключи LLM_RESULT_FIELDS, незаполненные - пустая строка"""
+    return {field: fields.get(field, "") for field in LLM_RESULT_FIELDS}
+
+
+if __name__ == "__main__":
+    import time
+
+    def line(text, x, y, width=400, height=12, confidence=0.97):
+        return {"text": text, "bbox": [x, y, x + width, y + height], "confidence": confidence}
+
+    invoice = [{"page": 1, "text_lines": [
+        line("Счет на оплату № 125 от 12 марта 2024 г.", 40, 20, height=18),
+        line("Поставщик: ООО \"Ромашка\", ИНН 7707083893, КПП 770701001, 125009, г. Москва, ул. Тверская, д. 1", 40, 60, 520),
+        line("Покупатель: ИП Иванов Иван Иванович, ИНН 500100732259, 141000, г. Мытищи, ул. Мира, д. 5", 40, 110, 520),
+        line("Оплата счета означает согласие с условиями поставки товара", 40, 700),
+    ]}]
+    contract = [{"page": 1, "text_lines": [
+        line("ДОГОВОР ПОСТАВКИ", 200, 20, 200, 18),
+        line("г. Москва                                  1 марта 2024 г.", 40, 50, 520),
+        line("ООО \"Ромашка\", именуемое в дальнейшем Поставщик, в лице директора...", 40, 80, 520, confidence=0.8),
+    ]}]
+
+    # Без адреса заказчика документ идет в LLM, как бы ни были уверены остальные поля
+    no_address = [{"page": 1, "text_lines": [
+        invoice[0]["text_lines"][0], invoice[0]["text_lines"][1],
+        line("Покупатель: ИП Иванов Иван Иванович, ИНН 500100732259", 40, 110, 520),
+    ]}]
+
+    for name, pages in (("счет", invoice), ("договор", contract), ("счет без адреса", no_address)):
+        start = time.perf_counter()
+        fields, confidence = rule_based_result(pages, f"{name}.pdf")
+        elapsed = (time.perf_counter() - start) * 1000
+        verdict = "без LLM" if confidence >= RULE_CONFIDENCE_THRESHOLD else "в LLM"
+        print(f"{name}: тип {classify_document(pages)}, уверенность {confidence:.2f} → {verdict} ({elapsed:.2f} мс)")
@@ -23,6 +23,9 @@ if TIKTOKEN_AVAILABLE:
 else:
     TOKEN_ENCODER = None
 
+# Форматы строк OCR в промпте (усечение считает токены в выбранном формате)
+from prompt_encoding import encode_item, encode_lines, encoding_overhead, chunk_marker
+
 def estimate_tokens(text):
     """
     Точный подсчет токенов с помощью tiktoken
@@ -70,9 +73,139 @@ def check_context_limit(lines_data, max_tokens=16000):
     
     return exceeds_limit, token_count
 
-def smart_truncate_for_llm(lines_data, max_tokens=12000):
+def estimate_tokens_batch(texts):
+    """
+    Подсчет токенов для списка строк за один вызов энкодера
+    Без tiktoken - приблизительная оценка (дробная, чтобы сумма не занижалась)
+    """
+    if TIKTOKEN_AVAILABLE and TOKEN_ENCODER:
+        try:
+            return [len(tokens) for tokens in TOKEN_ENCODER.encode_ordinary_batch(texts)]
+        except Exception as e:
+            print(f"⚠️ Ошибка tiktoken, используем приблизительный подсчет: {e}")
+    return [len(text) / 4.2 for text in texts]
+
+def _mark_chunk(line, chunk_type):
+    """Копия строки с пометкой chunk_type (строки-не-словари оборачиваются)"""
+    if isinstance(line, dict):
+        line_copy = line.copy()
+        line_copy['chunk_type'] = chunk_type
+        return line_copy
+    return {'text': str(line), 'chunk_type': chunk_type}
+
+def _prefix_costs(lines, budget, encoding="json", chunk_type=None, batch_size=256):
+    """
+    Префиксные суммы токенов строк (в формате промпта encoding, с пометкой chunk_type)
+    Считаются пачками и только пока сумма не превысит budget - дальше они не нужны
+    """
+    prefix = [0.0]
+    for start in range(0, len(lines), batch_size):
+        batch = lines[start:start + batch_size]
+        if chunk_type:
+            batch = [_mark_chunk(line, chunk_type) for line in batch]
+        for cost in estimate_tokens_batch([encode_item(line, encoding) for line in batch]):
+            prefix.append(prefix[-1] + cost)
+            if prefix[-1] > budget:
+                return prefix
+    return prefix
+
+# Доля заголовка среди оставленных строк (как у прежних пропорций: 10-20% начала, 15-25% конца)
+HEADER_SHARE = 0.4
+MIN_CHUNK_LINES = 5
+
+def smart_truncate_for_llm(lines_data, max_tokens=12000, encoding="json"):
+    """
+    Умное усечение документа для LLM с учетом реального размера строк в промпте
+    
+    Однопроходный вариант:
+    1. Каждая строка кодируется и токенизируется один раз (в том виде, в каком
+       она окажется в промпте в формате encoding), по ним строятся префиксные суммы
+       начала и суффиксные суммы конца документа - только до исчерпания лимита
+    2. Если весь документ помещается в max_tokens - он отдается как есть
+    3. Иначе бинарным поиском подбирается наибольшее число строк начала (header)
+       и конца (footer), которое вместе с разделителем помещается в лимит
+    Разметка chunk_type (header / separator / footer) - та же, что у прежнего варианта.
+    
+    encoding - формат строк в промпте (prompt_encoding.PROMPT_ENCODINGS: json, json_min,
+    tsv, text) - лимит считается по тому тексту, который действительно уйдет в LLM.
+    """
+    total_lines = len(lines_data)
+    # Обертка формата: скобки списка, заголовок таблицы или маркеры страниц
+    list_overhead = estimate_tokens(encoding_overhead(encoding, lines_data))
+    budget = max_tokens - list_overhead
+    
+    whole = _prefix_costs(lines_data, budget, encoding)
+    if len(whole) == total_lines + 1 and whole[-1] <= budget:
+        return lines_data, int(whole[-1] + list_overhead), False  # документ, токены, был_усечен
+    
+    # Документ слишком большой - применяем усечение
+    print(f"⚠️ Документ превышает лимит: более {max_tokens} токенов")
+    
+    max_chunk = total_lines // 3  # Как и раньше: не больше трети документа на каждую часть
+    if max_chunk < MIN_CHUNK_LINES:
+        # Крайний случай - возвращаем только первые 10 строк
+        minimal_lines = lines_data[:10]
+        minimal_tokens = estimate_tokens(encode_lines(minimal_lines, encoding))
+        print(f"🚨 Крайний случай: возвращаем только {len(minimal_lines)} строк, {minimal_tokens} токенов")
+        return minimal_lines, minimal_tokens, True
+    
+    # Префиксные суммы начала и суффиксные суммы конца документа.
+    # Начало уже посчитано без пометки - для словарей пометка добавляет постоянное число токенов
+    head = lines_data[:min(max_chunk, len(whole) - 1)]
+    if all(isinstance(line, dict) for line in head):
+        marker_cost = estimate_tokens_batch([chunk_marker(encoding, 'header')])[0] if chunk_marker(encoding, 'header') else 0
+        header_prefix = [cost + count * marker_cost for count, cost in enumerate(whole[:len(head) + 1])]
+    else:
+        header_prefix = _prefix_costs(lines_data[:max_chunk], budget, encoding, 'header')
+    footer_suffix = _prefix_costs(lines_data[total_lines - max_chunk:][::-1], budget, encoding, 'footer')
+    
+    def split(kept):
+        header_count = min(max_chunk, max(MIN_CHUNK_LINES, round(kept * HEADER_SHARE)))
+        footer_count = min(max_chunk, max(MIN_CHUNK_LINES, kept - header_count))
+        return header_count, footer_count
+    
+    def separator(header_count, footer_count):
+        return {
+            'text': f'[... ПРОПУЩЕНО {total_lines - header_count - footer_count} СТРОК ...]',
+            'chunk_type': 'separator'
+        }
+    
+    def cost(kept):
+        header_count, footer_count = split(kept)
+        if header_count >= len(header_prefix) or footer_count >= len(footer_suffix):
+            return float('inf')  # Одна из частей уже больше лимита
+        separator_cost = estimate_tokens(encode_item(separator(header_count, footer_count), encoding))
+        return header_prefix[header_count] + footer_suffix[footer_count] + separator_cost + list_overhead
+    
+    # Бинарный поиск наибольшего числа оставленных строк, помещающегося в лимит
+    low, high = 2 * MIN_CHUNK_LINES, 2 * max_chunk
+    if cost(low) <= max_tokens:
+        while low < high:
+            middle = (low + high + 1) // 2
+            if cost(middle) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+    kept = low
+    
+    header_count, footer_count = split(kept)
+    truncated_lines = [_mark_chunk(line, 'header') for line in lines_data[:header_count]]
+    truncated_lines.append(separator(header_count, footer_count))
+    truncated_lines.extend(_mark_chunk(line, 'footer') for line in lines_data[total_lines - footer_count:])
+    
+    final_token_count = cost(kept)
+    if final_token_count <= max_tokens:
+        print(f"✅ Документ успешно усечен до {int(final_token_count)} токенов "
+              f"({header_count} + {footer_count} строк)")
+    else:
+        # Даже минимальные начало и конец не помещаются - считаем фактический размер
+        final_token_count = estimate_tokens(encode_lines(truncated_lines, encoding))
+        print(f"⚠️ Не удалось уместить в лимит, возвращаем лучший результат: {final_token_count} токенов")
+    return truncated_lines, int(final_token_count), True
+
+def smart_truncate_iterative(lines_data, max_tokens=12000):
     """
-    Умное усечение документа для LLM с учетом реального размера JSON структуры
+    Прежний итеративный вариант усечения (оставлен для сравнения в бенчмарке)
     
     Стратегия:
     1. Проверяем реальный размер JSON структуры
@@ -178,3 +311,37 @@ if __name__ == "__main__":
     print(f"Текст: '{test_text}'")
     print(f"Символов: {len(test_text)}")
     print(f"Токенов (оценка): {tokens}")
+
+    # Бенчмарк усечения: прежний итеративный вариант против однопроходного
+    import contextlib
+    import io
+    import random
+    import time as time_module
+
+    def synthetic_document(line_count):
+        words = ["ООО", "Ромашка", "ИНН", "7707083893", "Счет", "на", "оплату", "№", "125", "от",
+                 "12.03.2024", "Итого", "к", "оплате", "руб.", "НДС", "20%", "Поставщик", "Покупатель"]
+        lines = []
+        for i in range(line_count):
+            text = " ".join(random.choice(words) for _ in range(random.randint(2, 9)))
+            lines.append({
+                "text": text,
+                "bbox": [random.randint(0, 600), i % 800, random.randint(600, 1200), i % 800 + 12],
+                "confidence": round(random.random(), 3),
+                "page": i // 50 + 1
+            })
+        return lines
+
+    random.seed(42)
+    print("\nБенчмарк smart_truncate_for_llm (лимит 12000 токенов):")
+    for line_count in (1_000, 10_000, 100_000):
+        document = synthetic_document(line_count)
+        results = {}
+        for name, truncate in (("прежний", smart_truncate_iterative), ("однопроходный", smart_truncate_for_llm)):
+            start = time_module.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                lines, token_count, _ = truncate(document, 12000)
+            results[name] = (time_module.perf_counter() - start, len(lines), token_count)
+        old, new = results["прежний"], results["однопроходный"]
+        print(f"  {line_count:>7} строк: прежний {old[0]:.3f}с ({old[1]} строк, {old[2]} ток.), "
+              f"однопроходный {new[0]:.3f}с ({new[1]} строк, {new[2]} ток.), ускорение x{old[0] / new[0]:.1f}")